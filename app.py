@@ -1,35 +1,208 @@
 """This file contains the method for creating an application instance and the routes for the main Bloggit application."""
-from flask import Flask, request, render_template, redirect, flash, jsonify, session, make_response
+from flask import Flask, Response, request, render_template, redirect, flash, jsonify, session, make_response, abort, \
+    current_app, stream_with_context
+import calendar
+import json
+import os
+from datetime import datetime
+from time import perf_counter
 from flask_debugtoolbar import DebugToolbarExtension
-from models import db, connect_db, User, Post, Tag, PostTag
-
-def create_app(db_name, testing=False):
-    """Create an instance of the app so I can have a production database and a separate testing database."""
+from sqlalchemy import select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import defer, joinedload, selectinload
+from models import db, connect_db, ArchiveMonth, User, Post, Tag, PostTag
+from pagination import keyset_paginate, page_url
+from config import PROFILES, engine_options
+from instrumentation import Instrumentation
+from catalog import TagCatalog
+from search import search_posts
+from cache import ResponseCache, depends_on
+from related import forget_tag, refresh_related_posts, top_related_posts
+from trending import record_tag_activity, trending_tags, window_start
+from feeds import atom_time, render_feed
+from rendering import render_post
+from compression import Compression
+from assets import Assets
+from replicas import ReplicaRouter
+from moderation import BulkSelection, NO_PROGRESS, add_tags, delete_posts, remove_tags, run_in_chunks, \
+    tag_ids_from_json
+from commands import bloggit_cli
+
+def month_bounds(year, month):
+    """Returns the first moment of a month and of the month after it. Aborts with a 404 error if there is no such month."""
+    try:
+        start = datetime(year, month, 1)
+        end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    except ValueError:
+        abort(404)
+    return start, end
+
+def get_selected_tag_ids():
+    """Returns the set of tag ids checked on the add/edit post form, validated with a single query. Aborts with a 404 error if any
+    of them isn't an existing tag."""
+    try:
+        tag_ids = {int(tag_id) for tag_id in request.form.getlist('selected_tag_ids')}
+    except ValueError:
+        abort(404)
+    if tag_ids and Tag.existing_ids(tag_ids) != tag_ids:
+        abort(404)
+    return tag_ids
+
+def api_page(query, columns, descending=False):
+    """Returns one page of the rows of query as JSON, along with the cursors of the next and previous pages. With ?format=ndjson
+    every row is exported instead, see export_ndjson."""
+    if request.args.get('format') == 'ndjson':
+        return export_ndjson(query.order_by(*columns))
+    page = keyset_paginate(query, columns, after=request.args.get('after'), before=request.args.get('before'),
+                           per_page=current_app.config['PAGE_SIZE'], descending=descending)
+    return jsonify(results=[row.to_dict() for row in page.items], next_cursor=page.next_cursor, prev_cursor=page.prev_cursor)
+
+def export_ndjson(query):
+    """Streams every row of query as one JSON object per line. Rows are fetched API_EXPORT_BATCH_SIZE at a time from a
+    server-side cursor and written out as they arrive, so exporting millions of rows takes constant memory."""
+    rows = query.yield_per(current_app.config['API_EXPORT_BATCH_SIZE'])
+    def generate():
+        for row in rows:
+            yield json.dumps(row.to_dict()) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def api_not_found():
+    return jsonify(error='Not found'), 404
+
+def bulk_moderation(operation, affected, with_tags=False):
+    """Runs a bulk moderation operation from moderation.py over the posts selected by the JSON body, one committed chunk at a
+    time, and answers with the totals: the number of chunks and posts handled and the number of rows affected, under the name
+    affected. With ?format=ndjson the totals are streamed as one line per chunk as it is committed instead, so a long cleanup
+    reports its progress, and the last line has "done": true. with_tags means the body must also list existing tag_ids, which
+    are handed to operation after the post ids."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error='The body must be a JSON object'), 400
+    try:
+        selection = BulkSelection.from_json(data)
+        tag_ids = tag_ids_from_json(data) if with_tags else None
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    if with_tags:
+        if Tag.existing_ids(tag_ids) != tag_ids:
+            return api_not_found()
+        apply = lambda post_ids: operation(post_ids, sorted(tag_ids))
+    else:
+        apply = operation
+    progress = run_in_chunks(selection, apply, current_app.config['BULK_CHUNK_SIZE'],
+                             current_app.extensions['response_cache'].invalidate)
+
+    def report(totals):
+        return {'chunks': totals['chunks'], 'posts': totals['posts'], affected: totals['affected'], 'last_id': totals['last_id']}
+
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            totals = NO_PROGRESS
+            for totals in progress:
+                yield json.dumps(report(totals)) + '\n'
+            yield json.dumps(dict(report(totals), done=True)) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    totals = NO_PROGRESS
+    for totals in progress:
+        pass
+    return jsonify(report(totals))
+
+def warm_up(app):
+    """Opens every connection of the pool and compiles every template, so the first requests a worker serves don't wait for
+    either. Call it after connect_db, in each worker process (connections can't be shared with forked workers)."""
+    started = perf_counter()
+    with app.app_context():
+        engine = db.engine
+        connections = [engine.connect() for i in range(max(1, getattr(engine.pool, 'size', lambda: 1)()))]
+        for connection in connections:
+            connection.execute(text('SELECT 1'))
+            connection.close()
+    for template_name in app.jinja_env.list_templates(filter_func=lambda name: name.endswith(('.html', '.xml'))):
+        app.jinja_env.get_template(template_name)
+    instrumentation = app.extensions.get('instrumentation')
+    if instrumentation is not None:
+        instrumentation.startup['warm_up_ms'] = (perf_counter() - started) * 1000
+
+def create_app(db_name='bloggit', testing=False, profile=None, replica_urls=None):
+    """Create an instance of the app so I can have a production database and a separate testing database. The profile picks one of
+    the configurations in config.py ("development", "testing", "production" or "benchmark"). It defaults to "testing" for testing
+    apps and otherwise to the BLOGGIT_PROFILE environment variable, or "development" if that isn't set. db_name defaults
+    to the main database so `flask --app app` can build the app for the commands in commands.py. db_name can also be a full
+    database URI, like "sqlite://" for an in-memory SQLite database, which is used as is. replica_urls overrides the
+    profile's DATABASE_REPLICA_URLS, the read replicas GET requests are sent to (see replicas.py)."""
+    started = perf_counter()
     app = Flask(__name__)
     app.testing = testing
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql:///{db_name}'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    app.config["SECRET_KEY"] = "oh-so-secret"
-    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-    debug = DebugToolbarExtension(app)
-    if app.testing:
-        app.config['SQLALCHEMY_ECHO'] = False
-        app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+    if profile is None:
+        profile = 'testing' if testing else os.environ.get('BLOGGIT_PROFILE', 'development')
+    app.config.from_object(PROFILES[profile])
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError(f"The {profile} profile needs the SECRET_KEY environment variable, which signs the sessions.")
+    if '://' in db_name:
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_name
     else:
-        app.config['SQLALCHEMY_ECHO'] = True 
+        app.config['SQLALCHEMY_DATABASE_URI'] = app.config['DATABASE_URL'] or f'postgresql:///{db_name}'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config, app.config['SQLALCHEMY_DATABASE_URI'])
+    if replica_urls is not None:
+        app.config['DATABASE_REPLICA_URLS'] = replica_urls
+    app.add_template_global(page_url)
+    app.add_template_filter(atom_time)
+    # Registered before the debug toolbar, so responses are compressed after the toolbar has been added to them.
+    Compression(app)
+    Assets(app)
+    if app.config['DEBUG_TOOLBAR']:
+        debug = DebugToolbarExtension(app)
+    if app.config['INSTRUMENTATION']:
+        Instrumentation(app, started=started)
+    tag_catalog = TagCatalog(app)
+    response_cache = ResponseCache(app)
+    ReplicaRouter(app)
+    app.cli.add_command(bloggit_cli)
 
     @app.route('/')
+    @response_cache.cached
     def show_homepage():
         """Home page. This will show the 5 most recent blog posts from any user and list the title, content, and date/time of 
-        creation for each one."""
-        recent_posts = Post.query.order_by(Post.id.desc()).limit(5)
-        return render_template('home.html', posts=recent_posts)
+        creation for each one. Authors are joined in and tags are loaded with one extra query, so the page always costs the same
+        number of queries no matter how many posts it shows. A sidebar lists the tags trending over TRENDING_SIDEBAR_WINDOW."""
+        recent_posts = (Post.query
+                        .options(joinedload(Post.author), selectinload(Post.tags), defer(Post.content_html))
+                        .order_by(Post.created_at.desc(), Post.id.desc())
+                        .limit(5)
+                        .all())
+        window = app.config['TRENDING_SIDEBAR_WINDOW']
+        trending = trending_tags(app.config['TRENDING_WINDOWS'][window], app.config['TRENDING_TAGS_SHOWN'])
+        depends_on('post-list', 'trending', *[f'post:{post.id}' for post in recent_posts],
+                   *[f'user:{post.user_id}' for post in recent_posts],
+                   *[f'tag:{tag.id}' for post in recent_posts for tag in post.tags], *[f'tag:{tag.id}' for tag, _ in trending])
+        return render_template('home.html', posts=recent_posts, trending=trending, trending_window=window)
+
+    @app.route('/feed')
+    @response_cache.cached
+    def show_feed():
+        """Atom feed of the newest posts from any user."""
+        posts = (Post.query
+                 .options(joinedload(Post.author), selectinload(Post.tags))
+                 .order_by(Post.created_at.desc(), Post.id.desc())
+                 .limit(app.config['FEED_SIZE'])
+                 .all())
+        depends_on('post-list', *[f'post:{post.id}' for post in posts], *[f'user:{post.user_id}' for post in posts],
+                   *[f'tag:{tag.id}' for post in posts for tag in post.tags])
+        return render_feed("Bloggit", "/", posts)
 
     @app.route('/users')
     def list_all_users():
-        """Lists all users by their full name (first name then last name) currently in the database."""
-        users = User.query.order_by(User.last_name, User.first_name).all()
-        return render_template('users_list.html', users=users)
+        """Lists all users by their full name (first name then last name) currently in the database, one page at a time. Pages are
+        keyed on (last name, first name, id) so deep pages cost the same as the first one. With ?sort=popular the users with the
+        most posts come first instead, keyed on (post count, id)."""
+        sort = request.args.get('sort')
+        if sort == 'popular':
+            columns, descending = [User.post_count, User.id], True
+        else:
+            columns, descending = [User.last_name, User.first_name, User.id], False
+        page = keyset_paginate(User.query, columns, after=request.args.get('after'), before=request.args.get('before'),
+                               per_page=app.config['PAGE_SIZE'], descending=descending)
+        return render_template('users_list.html', users=page.items, page=page, sort=sort)
 
     @app.route('/users/new')
     def add_user_form():
@@ -57,13 +230,30 @@ def create_app(db_name, testing=False):
         return redirect('/users')
 
     @app.route('/users/<int:user_id>')
+    @response_cache.cached
     def show_user_details(user_id):
         """Shows detailed information about the user on their own page, including the user's profile picture and their full name, with
         buttons to edit the user information as well as delete the user from the database. Also shows a list of their posts as links
-        to pages where users can see each post, and finally a button to add a new post."""
+        to pages where users can see each post, and finally a button to add a new post. Posts are shown newest first, one page at a time."""
         user = User.query.get_or_404(user_id)
-        posts = Post.query.filter_by(user_id=user_id).order_by(Post.id.desc()).all()
-        return render_template("user_details.html", user=user, posts=posts)
+        page = keyset_paginate(Post.query.filter_by(user_id=user_id), [Post.id], after=request.args.get('after'),
+                               before=request.args.get('before'), per_page=app.config['PAGE_SIZE'], descending=True)
+        depends_on(f'user:{user_id}', *[f'post:{post.id}' for post in page.items])
+        return render_template("user_details.html", user=user, posts=page.items, page=page)
+
+    @app.route('/users/<int:user_id>/feed')
+    @response_cache.cached
+    def show_user_feed(user_id):
+        """Atom feed of the user's newest posts."""
+        user = User.query.get_or_404(user_id)
+        posts = (Post.query
+                 .filter_by(user_id=user_id)
+                 .options(selectinload(Post.tags))
+                 .order_by(Post.id.desc())
+                 .limit(app.config['FEED_SIZE'])
+                 .all())
+        depends_on(f'user:{user_id}', *[f'post:{post.id}' for post in posts], *[f'tag:{tag.id}' for post in posts for tag in post.tags])
+        return render_feed(f"Bloggit: {user.get_full_name()}", f"/users/{user_id}", posts)
 
     @app.route('/users/<int:user_id>/edit')
     def edit_user_form(user_id):
@@ -89,6 +279,7 @@ def create_app(db_name, testing=False):
 
         db.session.add(updated_user)
         db.session.commit()
+        response_cache.invalidate(f'user:{user_id}')
 
         flash("User successfully updated!")
         return redirect('/users')
@@ -98,8 +289,11 @@ def create_app(db_name, testing=False):
         """Deletes the user with the specific user_id's information from the database, redirects you to the users list page."""
         user_to_delete = User.query.get_or_404(user_id)
 
+        Post.release_post_counts(select(Post.id).where(Post.user_id == user_id), authors=False)
         db.session.delete(user_to_delete)
         db.session.commit()
+        # Every cached page that shows or links to one of the user's posts, related posts included, depends on the user too.
+        response_cache.invalidate(f'user:{user_id}', 'post-list')
 
         flash("User successfully deleted!")
         return redirect('/users')
@@ -109,7 +303,7 @@ def create_app(db_name, testing=False):
         """Displays the form for adding a new post for the user whose id is user_id. There are 2 fields in this form: Title and content.
         Both are required and the title can't be more than 50 characters."""
         user = User.query.get_or_404(user_id)
-        tags = Tag.query.all()
+        tags = tag_catalog.all()
         return render_template("add_post_form.html", user=user, tags=tags)
     
     @app.route('/users/<int:user_id>/posts/new', methods=["POST"])
@@ -136,34 +330,36 @@ def create_app(db_name, testing=False):
         if error_count > 0:
             return redirect(f'/users/{user_id}/posts/new')
         
-        # Add post to database
-        new_post = Post(title=title, content=content, user_id=user_id)
-        db.session.add(new_post)
-        db.session.commit()
+        tag_ids = get_selected_tag_ids()
 
-        # Add tag associations
-        for tag_id in request.form.getlist('selected_tag_ids'):
-            new_post_tag = PostTag(post_id=new_post.id, tag_id=tag_id)
-            db.session.add(new_post_tag)
+        # Add post and its tag associations to the database in one transaction
+        new_post, related_post_ids = Post.add(title, content, user_id, tag_ids, app.config['RELATED_POSTS_KEPT'])
         db.session.commit()
+        response_cache.invalidate('post-list', 'trending', f'user:{user_id}', *[f'tag:{tag_id}' for tag_id in tag_ids],
+                                  *[f'related:{post_id}' for post_id in related_post_ids])
 
         flash("Post successfully added!")
         return redirect(f'/users/{user_id}')
     
     @app.route('/posts/<int:post_id>')
+    @response_cache.cached
     def show_post_details(post_id):
         """Show the details for the post with the id of post_id. Includes the title, content, author, and links to go to the 
         detailed author page, edit the post, and delete the post."""
-        post = Post.query.get_or_404(post_id)
+        post = Post.query.options(joinedload(Post.author), selectinload(Post.tags)).get_or_404(post_id)
         tags = post.tags
-        return render_template("post_details.html", post=post, tags=tags)
+        related_posts = top_related_posts(post_id, app.config['RELATED_POSTS_SHOWN'])
+        depends_on(f'post:{post_id}', f'user:{post.user_id}', f'related:{post_id}', *[f'tag:{tag.id}' for tag in tags],
+                   *[f'post:{related_post.id}' for related_post in related_posts],
+                   *[f'user:{related_post.user_id}' for related_post in related_posts])
+        return render_template("post_details.html", post=post, tags=tags, related_posts=related_posts)
     
     @app.route('/posts/<int:post_id>/edit')
     def edit_post_form(post_id):
         """Display the form that allows the user to update a particular post with the title and content fields already prefilled
         with the title and content of the current version of the post."""
-        post = Post.query.get_or_404(post_id)
-        all_tags = Tag.query.all()
+        post = Post.query.options(joinedload(Post.author), selectinload(Post.tags)).get_or_404(post_id)
+        all_tags = tag_catalog.all()
         post_tag_ids = []
         for post_tag in post.tags:
             post_tag_ids.append(post_tag.id)
@@ -191,14 +387,20 @@ def create_app(db_name, testing=False):
         if error_count > 0:
             return redirect(f'/posts/{post_id}/edit')
         
+        tag_ids = get_selected_tag_ids()
         post.title = request.form["title"]
         post.content = request.form["content"]
-        post.tags.clear()
-        for tag_id in request.form.getlist('selected_tag_ids'):
-            tag_to_add = Tag.query.get_or_404(tag_id)
-            post.tags.append(tag_to_add)
+        render_post(post)
         db.session.add(post)
+        added_tag_ids, removed_tag_ids = post.set_tags(tag_ids)
+        related_post_ids = set()
+        if added_tag_ids or removed_tag_ids:
+            related_post_ids = refresh_related_posts(post_id, app.config['RELATED_POSTS_KEPT'])
+        record_tag_activity(added_tag_ids)
         db.session.commit()
+        response_cache.invalidate(f'post:{post_id}', *(['trending'] if added_tag_ids else []),
+                                  *[f'tag:{tag_id}' for tag_id in added_tag_ids | removed_tag_ids],
+                                  *[f'related:{related_post_id}' for related_post_id in related_post_ids])
         flash("Post successfully updated!")
         return redirect(f'/posts/{post_id}')
     
@@ -208,24 +410,174 @@ def create_app(db_name, testing=False):
         post_to_delete = Post.query.get_or_404(post_id)
         author_id = post_to_delete.user_id
 
+        Post.release_post_counts([post_id])
         db.session.delete(post_to_delete)
         db.session.commit()
+        response_cache.invalidate(f'post:{post_id}', 'post-list', f'user:{author_id}')
 
         flash("Post successfully deleted!")
         return redirect(f'/users/{author_id}')
     
+    @app.route('/archive')
+    @response_cache.cached
+    def show_archive():
+        """Lists every month that has posts, newest first, with how many posts were created in it. The counts come from the
+        archive_months table, so this page never counts posts."""
+        months = (ArchiveMonth.query
+                  .filter(ArchiveMonth.posts > 0)
+                  .order_by(ArchiveMonth.year.desc(), ArchiveMonth.month.desc())
+                  .all())
+        depends_on('post-list')
+        return render_template('archive.html', months=months, month_names=calendar.month_name)
+
+    @app.route('/archive/<int:year>/<int:month>')
+    @response_cache.cached
+    def show_archive_month(year, month):
+        """Shows the posts created in a month, newest first and one page at a time. Pages are keyed on (created_at, id), so every
+        page is one range of the created_at index no matter how many posts the month or the whole blog has."""
+        start, end = month_bounds(year, month)
+        query = Post.query.options(joinedload(Post.author)).filter(Post.created_at >= start, Post.created_at < end)
+        page = keyset_paginate(query, [Post.created_at, Post.id], after=request.args.get('after'),
+                               before=request.args.get('before'), per_page=app.config['PAGE_SIZE'], descending=True)
+        depends_on('post-list', *[f'post:{post.id}' for post in page.items], *[f'user:{post.user_id}' for post in page.items])
+        return render_template('archive_month.html', posts=page.items, page=page, year=year, month=month,
+                               month_name=calendar.month_name[month])
+
+    @app.route('/search')
+    def search():
+        """Shows the search form and, once a search has been submitted, the posts that match it best first with the matching words
+        highlighted. The results can be narrowed down to a tag and to an author, and are shown one page at a time."""
+        query_text = request.args.get('q', '').strip()
+        tag_id = request.args.get('tag', type=int)
+        author_id = request.args.get('author', type=int)
+        author = User.query.get_or_404(author_id) if author_id is not None else None
+        page = None
+        if query_text:
+            page = search_posts(query_text, tag_id=tag_id, author_id=author_id, after=request.args.get('after'),
+                                before=request.args.get('before'), per_page=app.config['PAGE_SIZE'])
+        return render_template('search_results.html', query_text=query_text, tag_id=tag_id, author=author,
+                               tags=tag_catalog.all(), page=page)
+
+    @app.route('/api/search')
+    def search_api():
+        """Returns the same search results as the search page as JSON, along with the cursors of the next and previous pages."""
+        query_text = request.args.get('q', '').strip()
+        if not query_text:
+            return jsonify(results=[], next_cursor=None, prev_cursor=None)
+        page = search_posts(query_text, tag_id=request.args.get('tag', type=int), author_id=request.args.get('author', type=int),
+                            after=request.args.get('after'), before=request.args.get('before'), per_page=app.config['PAGE_SIZE'])
+        return jsonify(results=[result.to_dict() for result in page.items], next_cursor=page.next_cursor,
+                       prev_cursor=page.prev_cursor)
+
+    @app.route('/api/posts')
+    def list_posts_api():
+        """Lists posts as JSON, newest first, one page at a time. ?author= and ?tag= narrow them down to an author's posts or the
+        posts with a tag, and ?format=ndjson exports all of them."""
+        query = Post.query.options(selectinload(Post.tags))
+        author_id = request.args.get('author', type=int)
+        if author_id is not None:
+            query = query.filter(Post.user_id == author_id)
+        tag_id = request.args.get('tag', type=int)
+        if tag_id is not None:
+            query = query.filter(Post.id.in_(select(PostTag.post_id).where(PostTag.tag_id == tag_id)))
+        return api_page(query, [Post.id], descending=True)
+
+    @app.route('/api/posts/<int:post_id>')
+    def show_post_api(post_id):
+        """Returns a post as JSON."""
+        post = Post.query.options(selectinload(Post.tags)).filter_by(id=post_id).first()
+        return jsonify(post.to_dict()) if post else api_not_found()
+
+    @app.route('/api/posts/bulk/delete', methods=["POST"])
+    def bulk_delete_posts():
+        """Deletes every post selected by the JSON body: a list of post_ids, and/or the filters author, tag, min_id and max_id,
+        for moderators cleaning up spam. See bulk_moderation for the answer."""
+        return bulk_moderation(delete_posts, 'deleted')
+
+    @app.route('/api/posts/bulk/add-tags', methods=["POST"])
+    def bulk_add_tags():
+        """Adds the tags in the JSON body's tag_ids to every post it selects, like bulk_delete_posts."""
+        return bulk_moderation(add_tags, 'added', with_tags=True)
+
+    @app.route('/api/posts/bulk/remove-tags', methods=["POST"])
+    def bulk_remove_tags():
+        """Removes the tags in the JSON body's tag_ids from every post it selects, like bulk_delete_posts."""
+        return bulk_moderation(remove_tags, 'removed', with_tags=True)
+
+    @app.route('/api/users')
+    def list_users_api():
+        """Lists users as JSON in the order they signed up, one page at a time, or all of them with ?format=ndjson."""
+        return api_page(User.query, [User.id])
+
+    @app.route('/api/users/<int:user_id>')
+    def show_user_api(user_id):
+        """Returns a user as JSON."""
+        user = db.session.get(User, user_id)
+        return jsonify(user.to_dict()) if user else api_not_found()
+
+    @app.route('/api/tags')
+    def list_tags_api():
+        """Lists tags as JSON in the order they were created, one page at a time, or all of them with ?format=ndjson."""
+        return api_page(Tag.query, [Tag.id])
+
+    @app.route('/api/tags/trending')
+    def trending_tags_api():
+        """Lists the tags given to the most posts recently as JSON, with how many posts got each one. ?window picks one of
+        TRENDING_WINDOWS (the sidebar's window by default)."""
+        windows = app.config['TRENDING_WINDOWS']
+        window = request.args.get('window', app.config['TRENDING_SIDEBAR_WINDOW'])
+        if window not in windows:
+            return jsonify(error=f"window must be one of {', '.join(windows)}"), 400
+        trending = trending_tags(windows[window], app.config['TRENDING_TAGS_SHOWN'])
+        return jsonify(window=window, since=window_start(windows[window]).isoformat(),
+                       results=[dict(tag.to_dict(), recent_posts=posts) for tag, posts in trending])
+
+    @app.route('/api/tags/<int:tag_id>')
+    def show_tag_api(tag_id):
+        """Returns a tag as JSON."""
+        tag = db.session.get(Tag, tag_id)
+        return jsonify(tag.to_dict()) if tag else api_not_found()
+
     @app.route('/tags')
     def show_tags():
-        """Shows a list of all current tags. Each tag name is also a link to a more detailed page about that tag."""
-        tags = Tag.query.all()
-        return render_template('tags_list.html', tags=tags)
+        """Shows a list of all current tags with how many posts have each one, in alphabetical order or, with ?sort=popular, most
+        used first, one page at a time. Each tag name is also a link to a more detailed page about that tag."""
+        sort = request.args.get('sort')
+        if sort == 'popular':
+            columns, descending = [Tag.post_count, Tag.id], True
+        else:
+            columns, descending = [Tag.name], False
+        page = keyset_paginate(Tag.query, columns, after=request.args.get('after'), before=request.args.get('before'),
+                               per_page=app.config['PAGE_SIZE'], descending=descending)
+        return render_template('tags_list.html', tags=page.items, page=page, sort=sort)
     
     @app.route('/tags/<int:tag_id>')
+    @response_cache.cached
     def show_tag_details(tag_id):
-        """Shows the list of posts associated with the specific tag."""
+        """Shows the list of posts associated with the specific tag, newest first and one page at a time. Each page of posts is loaded
+        together with its authors in a single query instead of one lazy load per post."""
         current_tag = Tag.query.get_or_404(tag_id)
-        posts = current_tag.posts
-        return render_template('tag_details.html', tag=current_tag, posts=posts)
+        posts_query = Post.query.join(Post.tag_associations).filter(PostTag.tag_id == tag_id).options(joinedload(Post.author))
+        page = keyset_paginate(posts_query, [PostTag.post_id], after=request.args.get('after'), before=request.args.get('before'),
+                               per_page=app.config['PAGE_SIZE'], descending=True, row_key=lambda post: [post.id])
+        depends_on(f'tag:{tag_id}', *[f'post:{post.id}' for post in page.items], *[f'user:{post.user_id}' for post in page.items])
+        return render_template('tag_details.html', tag=current_tag, posts=page.items, page=page)
+
+    @app.route('/tags/<int:tag_id>/feed')
+    @response_cache.cached
+    def show_tag_feed(tag_id):
+        """Atom feed of the newest posts with the tag."""
+        current_tag = Tag.query.get_or_404(tag_id)
+        posts = (Post.query
+                 .join(Post.tag_associations)
+                 .filter(PostTag.tag_id == tag_id)
+                 .options(joinedload(Post.author), selectinload(Post.tags))
+                 .order_by(PostTag.post_id.desc())
+                 .limit(app.config['FEED_SIZE'])
+                 .all())
+        depends_on(f'tag:{tag_id}', *[f'post:{post.id}' for post in posts], *[f'user:{post.user_id}' for post in posts],
+                   *[f'tag:{tag.id}' for post in posts for tag in post.tags])
+        return render_feed(f"Bloggit: posts tagged {current_tag.name}", f"/tags/{tag_id}", posts)
     
     @app.route('/tags/new')
     def add_tag_form():
@@ -247,18 +599,22 @@ def create_app(db_name, testing=False):
         elif len(tag_name) > 50:
             error_count += 1
             flash("The tag name can't be more than 50 characters.")
-        all_tags = Tag.query.all()
-        for tag in all_tags:
-            if tag_name == tag.name:
-                error_count += 1
-                flash("The tag name must be unique! Please enter a tag name that doesn't already exist.")
-                break;
+        elif Tag.name_taken(tag_name, case_insensitive=app.config['TAG_NAMES_CASE_INSENSITIVE']):
+            error_count += 1
+            flash("The tag name must be unique! Please enter a tag name that doesn't already exist.")
         
         if error_count > 0:
             return redirect(f'/tags/new')
         new_tag = Tag(name=tag_name)
         db.session.add(new_tag)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another request added the same name between the check and the insert, so the unique constraint caught it.
+            db.session.rollback()
+            flash("The tag name must be unique! Please enter a tag name that doesn't already exist.")
+            return redirect(f'/tags/new')
+        tag_catalog.invalidate()
 
         flash("Tag successfully added!")
         return redirect('/tags')
@@ -284,18 +640,22 @@ def create_app(db_name, testing=False):
         elif len(tag_name) > 50:
             error_count += 1
             flash("The tag name can't be more than 50 characters.")
-        all_tags = Tag.query.all()
-        for tag in all_tags:
-            if tag.id != tag_id and tag_name == tag.name:
-                error_count += 1
-                flash("The tag name must be unique! Please enter a tag name that doesn't already exist.")
-                break
+        elif Tag.name_taken(tag_name, exclude_id=tag_id, case_insensitive=app.config['TAG_NAMES_CASE_INSENSITIVE']):
+            error_count += 1
+            flash("The tag name must be unique! Please enter a tag name that doesn't already exist.")
         
         if error_count > 0:
             return redirect(f'/tags/{tag_id}/edit')
         tag_to_update.name = tag_name
         db.session.add(tag_to_update)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash("The tag name must be unique! Please enter a tag name that doesn't already exist.")
+            return redirect(f'/tags/{tag_id}/edit')
+        tag_catalog.invalidate()
+        response_cache.invalidate(f'tag:{tag_id}')
 
         flash("Tag successfully updated!")
         return redirect('/tags')
@@ -303,9 +663,13 @@ def create_app(db_name, testing=False):
     @app.route('/tags/<int:tag_id>/delete', methods=["POST"])
     def delete_tag(tag_id):
         """Deletes the tag and deletes any associations between this tag and all posts."""
-        tag_to_delete = Tag.query.get_or_404(tag_id)
+        # Lock the tag before forget_tag changes the related posts rows, in the same order as the post writes.
+        tag_to_delete = Tag.query.with_for_update().get_or_404(tag_id)
+        forget_tag(tag_id)
         db.session.delete(tag_to_delete)
         db.session.commit()
+        tag_catalog.invalidate()
+        response_cache.invalidate(f'tag:{tag_id}')
 
         flash("Tag successfully deleted!")
         return redirect('/tags')
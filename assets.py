@@ -0,0 +1,109 @@
+"""This file contains the static asset pipeline. `flask bloggit build-assets` copies every file in static/ to static/dist/ under a
+name that contains a hash of its content (styles.css becomes styles.3f2a9c1e0b.css), writes gzip and brotli compressed copies next
+to the compressible ones, and records the names in static/dist/manifest.json.
+
+Templates link to assets with asset_url("styles.css"), which points at the hashed copy. A hashed name never changes content, so
+those responses carry a one year, immutable Cache-Control and browsers never ask for them again; a changed file gets a new name.
+The pre-compressed copy the client accepts is sent as is, so workers never compress static files. Without a manifest (before the
+first build) asset_url falls back to the plain /static/ URL."""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from flask import abort, request, send_from_directory, url_for
+from compression import COMPRESSIBLE_MIMETYPES
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = "manifest.json"
+ONE_YEAR = 365 * 24 * 60 * 60
+
+def hashed_name(name, content):
+    """Returns name with a hash of content inserted before its extension."""
+    root, extension = os.path.splitext(name)
+    return f"{root}.{hashlib.blake2b(content, digest_size=5).hexdigest()}{extension}"
+
+def build_assets(static_folder, dist_folder, min_size=500):
+    """Writes a hashed, and for compressible files of at least min_size bytes a gzip and a brotli compressed, copy of every file
+    in static_folder to dist_folder, replacing what was there, and returns the manifest mapping each name to its hashed name."""
+    static_folder, dist_folder = os.path.abspath(static_folder), os.path.abspath(dist_folder)
+    if os.path.isdir(dist_folder):
+        shutil.rmtree(dist_folder)
+    os.makedirs(dist_folder)
+    manifest = {}
+    for directory, subdirectories, files in os.walk(static_folder):
+        subdirectories[:] = [name for name in subdirectories if os.path.join(directory, name) != dist_folder]
+        for file_name in sorted(files):
+            path = os.path.join(directory, file_name)
+            name = os.path.relpath(path, static_folder).replace(os.sep, "/")
+            with open(path, "rb") as source:
+                content = source.read()
+            built = hashed_name(name, content)
+            target = os.path.join(dist_folder, built)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as output:
+                output.write(content)
+            if mimetypes.guess_type(name)[0] in COMPRESSIBLE_MIMETYPES and len(content) >= min_size:
+                with open(target + ".gz", "wb") as output:
+                    output.write(gzip.compress(content, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    with open(target + ".br", "wb") as output:
+                        output.write(brotli.compress(content, quality=11))
+            manifest[name] = built
+    with open(os.path.join(dist_folder, MANIFEST), "w") as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+    return manifest
+
+def read_manifest(dist_folder):
+    """Returns the manifest written by build_assets, or an empty one if the assets haven't been built."""
+    try:
+        with open(os.path.join(dist_folder, MANIFEST)) as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return {}
+
+class Assets:
+    """Flask extension that serves the built assets at /assets/<hashed name> and adds asset_url to the templates. The manifest is
+    read once, when the app is created, so build the assets before starting the workers."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.dist_folder = app.config.get("ASSETS_FOLDER") or os.path.join(app.static_folder, "dist")
+        self.manifest = read_manifest(self.dist_folder)
+        app.add_url_rule("/assets/<path:filename>", "asset", self.send_asset)
+        app.add_template_global(self.asset_url)
+        app.extensions["assets"] = self
+
+    def asset_url(self, name):
+        """Returns the URL of the built copy of the static file name, or its plain static URL if it hasn't been built."""
+        built = self.manifest.get(name)
+        if built is None:
+            return url_for("static", filename=name)
+        return url_for("asset", filename=built)
+
+    def send_asset(self, filename):
+        """Sends a built asset with far-future caching headers, pre-compressed when the client accepts brotli or gzip and a
+        compressed copy was built."""
+        if filename.endswith((".gz", ".br")) or filename == MANIFEST:
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        encodings = {"br": filename + ".br", "gzip": filename + ".gz"}
+        available = [encoding for encoding, path in encodings.items() if os.path.isfile(os.path.join(self.dist_folder, path))]
+        encoding = request.accept_encodings.best_match(available) if available else None
+        response = send_from_directory(self.dist_folder, encodings[encoding] if encoding else filename, mimetype=mimetype,
+                                       max_age=ONE_YEAR)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if available:
+            response.vary.add("Accept-Encoding")
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
@@ -0,0 +1,301 @@
+"""This file contains the route benchmark. It builds the app with create_app on its own database, fills it with a synthetic dataset
+from loader.py, then drives every route in app.py (the pages, the forms and the form POSTs) with a fixed number of concurrent
+clients. For each route it reports the throughput, p50/p99 latency and queries per request, writes the results as JSON, and exits
+with an error when a stored baseline has regressed by more than the threshold, or as soon as a route fails with a server error.
+
+The benchmark wipes its database, so it refuses to run while DATABASE_URL is set, and uses the "benchmark" profile by default:
+production's settings, but with the database given by --db (a name on the local Postgres server, or a full URI).
+
+    python benchmark.py --users 2000 --tags 200 --requests 300 --concurrency 8 --output results.json
+    python benchmark.py --skip-load --baseline results.json --threshold 0.25
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from time import perf_counter
+from flask import current_app
+from sqlalchemy import event, select
+from app import create_app
+from models import db, connect_db, User, Post, Tag, PostTag
+from loader import BulkWriter, Distribution, generate
+from instrumentation import percentile
+
+# Endpoints that aren't part of the app itself.
+IGNORED_ENDPOINTS = {"static", "asset", "metrics"}
+
+class Scenario:
+    """How to make one kind of request. path(rng, row_id) builds the URL, form(rng) the posted form data and json(rng, row_id) the
+    posted JSON body. Routes that delete a row get a fresh one from prepare(), which runs before the request is timed."""
+
+    def __init__(self, endpoint, method, path, form=None, prepare=None, json=None):
+        self.endpoint = endpoint
+        self.method = method
+        self.path = path
+        self.form = form
+        self.prepare = prepare
+        self.json = json
+
+    @property
+    def name(self):
+        return f"{self.method} {self.endpoint}"
+
+def make_user():
+    user = User(first_name="Bench", last_name="Mark")
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+def add_post(user_id, content, tag_ids=()):
+    """Adds a post through Post.add and commits it, like the add_post route, so the routes that delete or retag it leave a
+    consistent dataset behind. Returns the post id."""
+    post, related_post_ids = Post.add("Bench", content, user_id, tag_ids, current_app.config["RELATED_POSTS_KEPT"])
+    db.session.commit()
+    return post.id
+
+def make_post(user_ids):
+    return add_post(random.choice(user_ids), "To be deleted")
+
+def make_posts(user_ids, tag_ids=None, count=20):
+    """Adds count posts by random authors for the bulk moderation routes, all given one random tag if tag_ids is given. Returns
+    the post ids, and the tag id if there is one. Each post is committed on its own: adding several in one transaction would lock
+    their authors' and month's rows in a different order than the requests running meanwhile, and deadlock with them."""
+    tag_id = random.choice(tag_ids) if tag_ids is not None else None
+    post_ids = [add_post(random.choice(user_ids), "To be moderated", [tag_id] if tag_id is not None else [])
+                for i in range(count)]
+    return post_ids if tag_ids is None else (post_ids, tag_id)
+
+def make_tag():
+    tag = Tag(name=f"bench-{uuid.uuid4().hex[:12]}")
+    db.session.add(tag)
+    db.session.commit()
+    return tag.id
+
+def build_scenarios(user_ids, post_ids, tag_ids):
+    """Returns a Scenario for every route in app.py, picking the users, posts and tags to request at random from the given ids."""
+    user = lambda rng: rng.choice(user_ids)
+    post = lambda rng: rng.choice(post_ids)
+    tag = lambda rng: rng.choice(tag_ids)
+    unique_name = lambda rng: f"bench-{uuid.uuid4().hex[:12]}"
+    # The (year, month) of the last 12 months, which the generated posts are spread over.
+    today = date.today()
+    months = [divmod(today.year * 12 + today.month - 1 - i, 12) for i in range(12)]
+    months = [(year, month + 1) for year, month in months]
+    post_form = lambda rng: {"title": "Benchmarked", "content": "Some words about horses.",
+                             "selected_tag_ids": [str(tag_id) for tag_id in rng.sample(tag_ids, min(2, len(tag_ids)))]}
+    return [
+        Scenario("show_homepage", "GET", lambda rng, row: "/"),
+        Scenario("show_feed", "GET", lambda rng, row: "/feed"),
+        Scenario("list_all_users", "GET", lambda rng, row: "/users"),
+        Scenario("add_user_form", "GET", lambda rng, row: "/users/new"),
+        Scenario("add_user", "POST", lambda rng, row: "/users/new",
+                 lambda rng: {"first_name": "Bench", "last_name": "Mark", "image_url": ""}),
+        Scenario("show_user_details", "GET", lambda rng, row: f"/users/{user(rng)}"),
+        Scenario("show_user_feed", "GET", lambda rng, row: f"/users/{user(rng)}/feed"),
+        Scenario("edit_user_form", "GET", lambda rng, row: f"/users/{user(rng)}/edit"),
+        Scenario("update_user", "POST", lambda rng, row: f"/users/{user(rng)}/edit",
+                 lambda rng: {"first_name": "Bench", "last_name": "Mark", "image_url": ""}),
+        Scenario("delete_user", "POST", lambda rng, row: f"/users/{row}/delete", prepare=make_user),
+        Scenario("add_post_form", "GET", lambda rng, row: f"/users/{user(rng)}/posts/new"),
+        Scenario("add_post", "POST", lambda rng, row: f"/users/{user(rng)}/posts/new", post_form),
+        Scenario("show_post_details", "GET", lambda rng, row: f"/posts/{post(rng)}"),
+        Scenario("edit_post_form", "GET", lambda rng, row: f"/posts/{post(rng)}/edit"),
+        Scenario("update_post", "POST", lambda rng, row: f"/posts/{post(rng)}/edit", post_form),
+        Scenario("delete_post", "POST", lambda rng, row: f"/posts/{row}/delete", prepare=lambda: make_post(user_ids)),
+        Scenario("search", "GET", lambda rng, row: "/search?q=horse"),
+        Scenario("search_api", "GET", lambda rng, row: "/api/search?q=horse"),
+        Scenario("list_posts_api", "GET", lambda rng, row: "/api/posts"),
+        Scenario("show_post_api", "GET", lambda rng, row: f"/api/posts/{post(rng)}"),
+        Scenario("bulk_delete_posts", "POST", lambda rng, row: "/api/posts/bulk/delete", prepare=lambda: make_posts(user_ids),
+                 json=lambda rng, row: {"post_ids": row}),
+        Scenario("bulk_add_tags", "POST", lambda rng, row: "/api/posts/bulk/add-tags", prepare=lambda: make_posts(user_ids),
+                 json=lambda rng, row: {"post_ids": row, "tag_ids": [tag(rng)]}),
+        Scenario("bulk_remove_tags", "POST", lambda rng, row: "/api/posts/bulk/remove-tags",
+                 prepare=lambda: make_posts(user_ids, tag_ids), json=lambda rng, row: {"post_ids": row[0], "tag_ids": [row[1]]}),
+        Scenario("list_users_api", "GET", lambda rng, row: "/api/users"),
+        Scenario("show_user_api", "GET", lambda rng, row: f"/api/users/{user(rng)}"),
+        Scenario("list_tags_api", "GET", lambda rng, row: "/api/tags"),
+        Scenario("show_tag_api", "GET", lambda rng, row: f"/api/tags/{tag(rng)}"),
+        Scenario("trending_tags_api", "GET", lambda rng, row: f"/api/tags/trending?window={rng.choice(['hour', 'day', 'week'])}"),
+        Scenario("show_archive", "GET", lambda rng, row: "/archive"),
+        Scenario("show_archive_month", "GET", lambda rng, row: "/archive/{}/{}".format(*rng.choice(months))),
+        Scenario("show_tags", "GET", lambda rng, row: "/tags"),
+        Scenario("show_tag_details", "GET", lambda rng, row: f"/tags/{tag(rng)}"),
+        Scenario("show_tag_feed", "GET", lambda rng, row: f"/tags/{tag(rng)}/feed"),
+        Scenario("add_tag_form", "GET", lambda rng, row: "/tags/new"),
+        Scenario("add_tag", "POST", lambda rng, row: "/tags/new", lambda rng: {"tag_name": unique_name(rng)}),
+        Scenario("edit_tag_form", "GET", lambda rng, row: f"/tags/{tag(rng)}/edit"),
+        Scenario("update_tag", "POST", lambda rng, row: f"/tags/{tag(rng)}/edit", lambda rng: {"tag_name": unique_name(rng)}),
+        Scenario("delete_tag", "POST", lambda rng, row: f"/tags/{row}/delete", prepare=make_tag),
+    ]
+
+def load_dataset(users, tags, posts_per_user, tags_per_post, seed):
+    """Recreates the tables and fills them with a synthetic dataset, with its related posts index. Must be called inside an app
+    context."""
+    db.drop_all()
+    db.create_all()
+    rng = random.Random(seed)
+    writer = BulkWriter(batch_size=10000)
+    generate(writer, rng, users, tags, Distribution(posts_per_user, rng), Distribution(tags_per_post, rng),
+             Distribution("normal:800:300", rng), tag_skew=1.0, days=365)
+    writer.finish()
+
+def dataset_ids(limit=5000):
+    """Returns some user, post and tag ids for the scenarios to pick from. Must be called inside an app context."""
+    ids = lambda model: list(db.session.execute(select(model.id).limit(limit)).scalars())
+    return ids(User), ids(Post), ids(Tag)
+
+class ServerError(Exception):
+    """Raised when a benchmarked request fails with a server error, which means the app has a bug rather than a slow route."""
+
+def run_scenario(app, scenario, requests, concurrency, warmup=0, seed=0):
+    """Sends requests requests for scenario from concurrency threads, after warmup untimed ones, and returns its statistics.
+    Responses with a client error are counted as errors, and the first server error raises ServerError."""
+    query_counts = threading.local()
+    def count_query(*args):
+        query_counts.value = getattr(query_counts, "value", 0) + 1
+    with app.app_context():
+        engine = db.engine
+
+    def worker(worker_index, count, timed):
+        rng = random.Random(seed * 1000 + worker_index)
+        samples, errors = [], 0
+        with app.app_context():
+            for i in range(count):
+                row = scenario.prepare() if scenario.prepare else None
+                db.session.remove()
+                # A new client for every request, so flashed messages from the form POSTs never end up on the pages.
+                client = app.test_client()
+                path = scenario.path(rng, row)
+                form = scenario.form(rng) if scenario.form else None
+                body = scenario.json(rng, row) if scenario.json else None
+                query_counts.value = 0
+                started = perf_counter()
+                resp = client.open(path, method=scenario.method, data=form, json=body)
+                elapsed = perf_counter() - started
+                if resp.status_code >= 500:
+                    raise ServerError(f"{scenario.name}: {scenario.method} {path} returned {resp.status}")
+                if resp.status_code >= 400:
+                    errors += 1
+                samples.append((elapsed, query_counts.value))
+        return samples if timed else [], errors if timed else 0
+
+    event.listen(engine, "before_cursor_execute", count_query)
+    try:
+        with ThreadPoolExecutor(concurrency) as pool:
+            worker(0, warmup, False)
+            shares = [requests // concurrency + (index < requests % concurrency) for index in range(concurrency)]
+            started = perf_counter()
+            results = list(pool.map(lambda index: worker(index, shares[index], True), range(concurrency)))
+            elapsed = perf_counter() - started
+    finally:
+        event.remove(engine, "before_cursor_execute", count_query)
+
+    samples = [sample for worker_samples, errors in results for sample in worker_samples]
+    latencies = sorted(sample[0] * 1000 for sample in samples)
+    return {
+        "requests": len(samples),
+        "errors": sum(errors for worker_samples, errors in results),
+        "throughput": round(len(samples) / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50), 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99), 3) if latencies else None,
+        "queries_per_request": round(sum(sample[1] for sample in samples) / len(samples), 2) if samples else None,
+    }
+
+def run_benchmark(app, scenarios, requests, concurrency, warmup=0, seed=0, report=print):
+    """Runs every scenario in turn and returns the results, keyed by scenario name."""
+    results = {}
+    for scenario in scenarios:
+        stats = run_scenario(app, scenario, requests, concurrency, warmup, seed)
+        results[scenario.name] = stats
+        report(f"{scenario.name:<26} {stats['throughput']:>9.1f} req/s  p50 {stats['p50_ms']:>8.2f}ms  "
+               f"p99 {stats['p99_ms']:>8.2f}ms  {stats['queries_per_request']:>5.1f} queries  {stats['errors']} errors")
+    return results
+
+def uncovered_endpoints(app, scenarios):
+    """Returns the app's endpoints that no scenario requests, so new routes don't silently go unbenchmarked."""
+    covered = {(scenario.endpoint, scenario.method) for scenario in scenarios}
+    return sorted(f"{method} {rule.endpoint}" for rule in app.url_map.iter_rules() for method in rule.methods & {"GET", "POST"}
+                  if rule.endpoint not in IGNORED_ENDPOINTS and not rule.endpoint.startswith("debugtoolbar")
+                  and (rule.endpoint, method) not in covered)
+
+def find_regressions(results, baseline, threshold):
+    """Compares results against a baseline from an earlier run and describes every endpoint whose p99 latency or queries per
+    request grew, or whose throughput dropped, by more than threshold (0.25 means 25%)."""
+    regressions = []
+    for name, base in baseline.items():
+        current = results.get(name)
+        if current is None or not current["requests"]:
+            continue
+        if current["p99_ms"] > base["p99_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p99 {base['p99_ms']}ms -> {current['p99_ms']}ms")
+        if current["throughput"] < base["throughput"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {base['throughput']} -> {current['throughput']} req/s")
+        if current["queries_per_request"] > base["queries_per_request"] * (1 + threshold):
+            regressions.append(f"{name}: queries per request {base['queries_per_request']} -> {current['queries_per_request']}")
+        if current["errors"] > base["errors"]:
+            regressions.append(f"{name}: {current['errors']} errors")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every Bloggit route.")
+    parser.add_argument("--db", default="bloggit_bench",
+                        help="Database to (re)create for the benchmark: a name on the local Postgres server, or a full URI.")
+    parser.add_argument("--profile", default="benchmark", help="Configuration profile from config.py.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tags", type=int, default=100)
+    parser.add_argument("--posts-per-user", default="pareto:1.5:200")
+    parser.add_argument("--tags-per-post", default="uniform:0:4")
+    parser.add_argument("--skip-load", action="store_true", help="Reuse the data already in the database.")
+    parser.add_argument("--requests", type=int, default=200, help="Timed requests per route.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=10, help="Untimed requests per route, to fill caches first.")
+    parser.add_argument("--only", nargs="*", help="Only benchmark these endpoints.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Fail if the results regressed against this earlier JSON output.")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed regression against the baseline (0.25 = 25%%).")
+    args = parser.parse_args(argv)
+    if os.environ.get("DATABASE_URL"):
+        parser.error("DATABASE_URL is set, and the benchmark drops every table of the database it runs on. Unset it and pick the "
+                     "benchmark's database with --db.")
+
+    database_uri = args.db if "://" in args.db else f"postgresql:///{args.db}"
+    app = create_app(database_uri, profile=args.profile)
+    connect_db(app)
+    with app.app_context():
+        if not args.skip_load:
+            load_dataset(args.users, args.tags, args.posts_per_user, args.tags_per_post, args.seed)
+        scenarios = build_scenarios(*dataset_ids())
+        dataset = {model.__tablename__: db.session.query(model).count() for model in (User, Post, Tag, PostTag)}
+    for endpoint in uncovered_endpoints(app, scenarios):
+        print(f"warning: {endpoint} is not benchmarked")
+    if args.only:
+        scenarios = [scenario for scenario in scenarios if scenario.endpoint in args.only]
+
+    try:
+        results = run_benchmark(app, scenarios, args.requests, args.concurrency, args.warmup, args.seed)
+    except ServerError as error:
+        print(f"ERROR {error}", file=sys.stderr)
+        return 2
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"profile": args.profile, "dataset": dataset, "requests": args.requests,
+                       "concurrency": args.concurrency, "endpoints": results}, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = find_regressions(results, json.load(file)["endpoints"], args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,250 @@
+"""This file contains the rendered page cache. The busiest read pages are stored after they are rendered, together with an ETag and
+a Last-Modified time, so repeat visits are answered without touching the database, and readers that already have the page get a
+304 Not Modified. Every cached page lists the rows it was built from (like "post:12" or "user:3") and the write routes invalidate
+exactly the pages that depend on the rows they changed.
+
+Pages are kept in a bounded in-process LRU by default. Each worker process then has its own copy and only sees its own
+invalidations, so RESPONSE_CACHE_TTL bounds how stale other workers can be. With RESPONSE_CACHE_BACKEND = "redis" every worker
+shares one cache instead."""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from functools import wraps
+from itertools import count
+from time import monotonic, time
+from flask import Response, g, make_response, request, session
+
+class CachedPage:
+    """A rendered page, as stored in the cache."""
+    __slots__ = ("body", "mimetype", "etag", "last_modified", "deps")
+
+    def __init__(self, body, mimetype, etag, last_modified, deps):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = etag
+        self.last_modified = last_modified
+        self.deps = deps
+
+    def to_json(self):
+        return json.dumps({"body": self.body.decode("utf-8"), "mimetype": self.mimetype, "etag": self.etag,
+                           "last_modified": self.last_modified, "deps": sorted(self.deps)})
+
+    @classmethod
+    def from_json(cls, data):
+        fields = json.loads(data)
+        return cls(fields["body"].encode("utf-8"), fields["mimetype"], fields["etag"], fields["last_modified"], set(fields["deps"]))
+
+class MemoryBackend:
+    """Keeps up to max_entries pages in this process, evicting the least recently used one when full and expiring pages after
+    ttl seconds."""
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.keys_by_dep = {}
+        # When each dependency was last invalidated, as (sequence, time) and oldest first. Only the most recent ones are
+        # remembered; a page that started rendering before the oldest remembered invalidation is simply not stored.
+        self.invalidated_at = OrderedDict()
+        self.forgotten_through = 0
+        self.forgotten_time = 0.0
+        self.sequence = count(1)
+        self.last_sequence = 0
+        self.lock = threading.Lock()
+
+    def current_sequence(self):
+        """Returns a number that grows with every invalidation, so a page rendered before an invalidation can be recognised."""
+        return self.last_sequence
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            page, expires_at = item
+            if monotonic() > expires_at:
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return page
+
+    def set(self, key, page, rendered_at_sequence, data_as_of=None):
+        """Stores a page, unless one of the rows it depends on was invalidated while it was being rendered or, when data_as_of
+        is given, after that time (see ResponseCache.cached)."""
+        with self.lock:
+            if rendered_at_sequence < self.forgotten_through:
+                return
+            if data_as_of is not None and self.forgotten_time > data_as_of:
+                return
+            for dep in page.deps:
+                sequence, invalidated_time = self.invalidated_at.get(dep, (0, 0.0))
+                if sequence > rendered_at_sequence or (data_as_of is not None and invalidated_time > data_as_of):
+                    return
+            self.remove(key)
+            self.entries[key] = (page, monotonic() + self.ttl)
+            for dep in page.deps:
+                self.keys_by_dep.setdefault(dep, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self.remove(next(iter(self.entries)))
+
+    def invalidate(self, deps):
+        with self.lock:
+            self.last_sequence = next(self.sequence)
+            for dep in deps:
+                self.invalidated_at.pop(dep, None)
+                self.invalidated_at[dep] = (self.last_sequence, time())
+                for key in self.keys_by_dep.pop(dep, ()):
+                    self.remove(key)
+            while len(self.invalidated_at) > 10 * self.max_entries:
+                self.forgotten_through, self.forgotten_time = self.invalidated_at.popitem(last=False)[1]
+
+    def remove(self, key):
+        """Drops a page and its dependency links. The caller must hold the lock."""
+        item = self.entries.pop(key, None)
+        if item is not None:
+            for dep in item[0].deps:
+                keys = self.keys_by_dep.get(dep)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.keys_by_dep[dep]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_dep.clear()
+
+class RedisBackend:
+    """Keeps the pages in Redis so every worker process shares them and sees every invalidation. Redis evicts pages itself
+    (configure it with an LRU maxmemory-policy) and expires them after ttl seconds. client can be any object with the redis-py
+    interface, such as a local stand-in for tests; otherwise one is created from url, which requires the redis package."""
+
+    def __init__(self, url=None, ttl=300, client=None, prefix="bloggit:cache:"):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def current_sequence(self):
+        return int(self.client.get(self.prefix + "sequence") or 0)
+
+    def get(self, key):
+        data = self.client.get(self.prefix + "page:" + key)
+        return CachedPage.from_json(data) if data is not None else None
+
+    def set(self, key, page, rendered_at_sequence, data_as_of=None):
+        """Stores a page like MemoryBackend.set does. The invalidation keys of its rows are watched while they are checked, so
+        an invalidation from another worker that lands before the page is stored makes the store fail instead."""
+        from redis.exceptions import WatchError
+        deps = sorted(page.deps)
+        invalidation_keys = [self.prefix + "inv:" + dep for dep in deps]
+        with self.client.pipeline() as pipe:
+            try:
+                if deps:
+                    pipe.watch(*invalidation_keys)
+                    for invalidated in pipe.mget(invalidation_keys):
+                        if invalidated is None:
+                            continue
+                        if isinstance(invalidated, bytes):
+                            invalidated = invalidated.decode()
+                        sequence, invalidated_time = invalidated.split(":", 1)
+                        if int(sequence) > rendered_at_sequence or (data_as_of is not None and
+                                                                    float(invalidated_time) > data_as_of):
+                            return
+                    pipe.multi()
+                pipe.set(self.prefix + "page:" + key, page.to_json(), ex=self.ttl)
+                for dep in deps:
+                    pipe.sadd(self.prefix + "dep:" + dep, key)
+                    pipe.expire(self.prefix + "dep:" + dep, self.ttl)
+                pipe.execute()
+            except WatchError:
+                pass
+
+    def invalidate(self, deps):
+        """Drops the pages that depend on deps, and records when each of them was invalidated under a key of its own that
+        expires with the pages, so the records don't outgrow the cache."""
+        sequence = self.client.incr(self.prefix + "sequence")
+        invalidated = f"{sequence}:{time()}"
+        pipe = self.client.pipeline()
+        for dep in deps:
+            pipe.set(self.prefix + "inv:" + dep, invalidated, ex=self.ttl)
+            pipe.smembers(self.prefix + "dep:" + dep)
+            pipe.delete(self.prefix + "dep:" + dep)
+        results = pipe.execute()
+        keys = {key.decode() if isinstance(key, bytes) else key for members in results[1::3] for key in members}
+        if keys:
+            self.client.delete(*[self.prefix + "page:" + key for key in keys])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+def depends_on(*deps):
+    """Records that the page being rendered shows the given rows, like depends_on(f"post:{post.id}")."""
+    deps_so_far = g.get("cache_deps")
+    if deps_so_far is not None:
+        deps_so_far.update(deps)
+
+class ResponseCache:
+    """Flask extension that caches the pages of the views decorated with cached. The backend is picked with
+    RESPONSE_CACHE_BACKEND, and RESPONSE_CACHE_ENABLED can be switched off at any time to render every page afresh."""
+
+    def __init__(self, app=None, backend=None):
+        self.backend = backend
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        if self.backend is None:
+            ttl = app.config.get("RESPONSE_CACHE_TTL", 300)
+            if app.config.get("RESPONSE_CACHE_BACKEND", "memory") == "redis":
+                self.backend = RedisBackend(app.config["RESPONSE_CACHE_REDIS_URL"], ttl=ttl)
+            else:
+                self.backend = MemoryBackend(app.config.get("RESPONSE_CACHE_MAX_ENTRIES", 1000), ttl=ttl)
+        app.extensions["response_cache"] = self
+
+    def cached(self, view):
+        """Decorator that serves a GET view from the cache, and answers conditional requests for it with 304 Not Modified. Pages
+        that show flashed messages are always rendered afresh and never stored, since they are meant to be seen only once.
+
+        A page read from a replica (see replicas.py) may miss writes made up to REPLICA_STICKY_SECONDS before it started
+        rendering, on any worker, so it isn't stored if one of its rows was invalidated since then. Otherwise a worker could put
+        a stale page back right after another worker's write invalidated it, where it would stay until RESPONSE_CACHE_TTL."""
+        @wraps(view)
+        def cached_view(*args, **kwargs):
+            if not self.app.config.get("RESPONSE_CACHE_ENABLED", True) or request.method != "GET" or session.get("_flashes"):
+                return view(*args, **kwargs)
+
+            # Feeds link back with absolute URLs built from the request's host, so each host gets its own copy.
+            key = request.host_url.rstrip("/") + request.full_path
+            page = self.backend.get(key)
+            if page is None:
+                sequence = self.backend.current_sequence()
+                started = time()
+                g.cache_deps = set()
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                data_as_of = None
+                if g.get("replica_engine") is not None:
+                    data_as_of = started - self.app.config.get("REPLICA_STICKY_SECONDS", 0)
+                body = response.get_data()
+                page = CachedPage(body, response.mimetype, hashlib.blake2b(body, digest_size=16).hexdigest(), int(time()),
+                                  g.cache_deps)
+                self.backend.set(key, page, sequence, data_as_of)
+
+            response = Response(page.body, mimetype=page.mimetype)
+            response.set_etag(page.etag)
+            response.last_modified = page.last_modified
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+        return cached_view
+
+    def invalidate(self, *deps):
+        """Drops every cached page that depends on any of the given rows. Call this after committing a write."""
+        self.backend.invalidate(deps)
@@ -0,0 +1,44 @@
+"""This file contains the tag catalog, a process-local cache of every tag's id and name. The post forms and the tags list all need
+the full list of tags, so they share one copy instead of each reloading the tags table on every request. The tag write routes
+invalidate it, and it also expires after TAG_CATALOG_TTL seconds so other worker processes pick up their writes too."""
+import threading
+from time import monotonic
+from flask import g, has_request_context
+from sqlalchemy import select
+from models import db, Tag
+
+class TagCatalog:
+    """Caches the (id, name) rows of every tag, sorted by name. The rows are read-only tuples, so one copy can safely be handed to
+    every request and thread."""
+
+    def __init__(self, app=None):
+        self.tags = None
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get("TAG_CATALOG_TTL", 60)
+        app.extensions["tag_catalog"] = self
+
+    def all(self):
+        """Returns every tag, loading them from the database only if the cache is empty or has expired. They are always loaded
+        from the primary: the catalog is shared by every request of this process, so a lagging replica (see replicas.py) would
+        otherwise hide a tag from the visitor who just created it until the catalog expired."""
+        tags = self.tags
+        if tags is None or monotonic() - self.loaded_at > self.ttl:
+            with self.lock:
+                if self.tags is None or monotonic() - self.loaded_at > self.ttl:
+                    bind_arguments = {}
+                    if has_request_context() and g.get("replica_engine") is not None:
+                        bind_arguments["bind"] = db.engine
+                    self.tags = db.session.execute(select(Tag.id, Tag.name).order_by(Tag.name),
+                                                   bind_arguments=bind_arguments).all()
+                    self.loaded_at = monotonic()
+                tags = self.tags
+        return tags
+
+    def invalidate(self):
+        """Forgets the cached tags so the next request reloads them. Call this after any write to the tags table."""
+        self.tags = None
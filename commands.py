@@ -0,0 +1,94 @@
+"""This file contains the `flask bloggit` command group, which create_app attaches to every app. Run the commands with
+`flask --app app bloggit <command>`."""
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from models import db, backfill_created_at, ensure_connected, rebuild_archive_months, reconcile_post_counts
+from loader import load
+from migrations import MIGRATIONS, applied_versions, migrate
+from related import rebuild_related_posts
+from trending import prune_tag_activity
+from rendering import RENDER_VERSION, rerender_posts
+from assets import build_assets
+
+bloggit_cli = AppGroup("bloggit", help="Bloggit maintenance commands.")
+bloggit_cli.add_command(load)
+
+@bloggit_cli.command("migrate")
+@click.option("--list", "list_only", is_flag=True, help="Only list the migrations and whether they have been applied.")
+def migrate_command(list_only):
+    """Brings the database schema up to date by applying the migrations in migrations.py. The production profile doesn't create
+    tables when a worker starts, so run this once before each deploy."""
+    ensure_connected(current_app)
+    if list_only:
+        with db.engine.connect() as connection:
+            done = applied_versions(connection)
+            connection.commit()
+        for migration in MIGRATIONS:
+            click.echo(f"{'applied' if migration.version in done else 'pending':<8} {migration.version:>3}  {migration.description}")
+        return
+    try:
+        applied = migrate(db.engine, report=lambda migration: click.echo(f"Applying {migration.version}: {migration.description}"),
+                          case_insensitive_tags=current_app.config["TAG_NAMES_CASE_INSENSITIVE"])
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    click.echo(f"{len(applied)} migration(s) applied." if applied else "The database is up to date.")
+
+@bloggit_cli.command("reconcile-counts")
+def reconcile_counts():
+    """Recounts the posts of every user, tag and archive month and repairs the post counts that drifted, for example after rows
+    were changed by hand."""
+    ensure_connected(current_app)
+    with db.engine.begin() as connection:
+        users_fixed, tags_fixed = reconcile_post_counts(connection)
+        rebuild_archive_months(connection)
+    click.echo(f"Fixed the post counts of {users_fixed} user(s) and {tags_fixed} tag(s), and recounted the archive.")
+
+@bloggit_cli.command("backfill-timestamps")
+def backfill_timestamps():
+    """Repairs the creation times of posts written while every worker stamped its posts with its own start time (see
+    backfill_created_at in models.py), then recounts the archive's months. Safe to run more than once."""
+    ensure_connected(current_app)
+    with db.engine.begin() as connection:
+        fixed = backfill_created_at(connection)
+        months = rebuild_archive_months(connection)
+    click.echo(f"Fixed the creation time of {fixed} post(s); the archive has {months} month(s).")
+
+@bloggit_cli.command("rebuild-related")
+@click.option("--keep", type=int, help="Related posts kept per post (default: RELATED_POSTS_KEPT).")
+@click.option("--block-size", default=2000, show_default=True, help="Posts multiplied at a time; lower it to use less memory.")
+def rebuild_related(keep, block_size):
+    """Recomputes the related posts of every post from their tags. Needs numpy and scipy."""
+    ensure_connected(current_app)
+    try:
+        rows = rebuild_related_posts(keep or current_app.config["RELATED_POSTS_KEPT"], block_size=block_size)
+    except ImportError:
+        raise click.ClickException("Rebuilding the related posts needs numpy and scipy: pip install -r requirements.txt")
+    click.echo(f"Wrote {rows} related post rows.")
+
+@bloggit_cli.command("prune-activity")
+def prune_activity():
+    """Deletes the hourly tag activity that is older than the longest trending window. Run it from cron, daily is plenty."""
+    ensure_connected(current_app)
+    rows = prune_tag_activity(max(current_app.config["TRENDING_WINDOWS"].values()))
+    click.echo(f"Deleted {rows} hours of tag activity.")
+
+@bloggit_cli.command("rerender-posts")
+@click.option("--workers", type=int, help="Rendering processes (default: one per CPU).")
+@click.option("--batch-size", default=500, show_default=True, help="Posts sent to a process at a time.")
+@click.option("--all", "everything", is_flag=True, help="Render every post, not only the ones rendered by an older version.")
+def rerender(workers, batch_size, everything):
+    """Renders the Markdown of the posts whose stored HTML was made by an older RENDER_VERSION of rendering.py. Run it after
+    bumping RENDER_VERSION, and once after migrating a database whose posts were written before Markdown support."""
+    ensure_connected(current_app)
+    rendered = rerender_posts(workers, batch_size, everything, report=lambda count: click.echo(f"{count} posts rendered"))
+    click.echo(f"Rendered {rendered} post(s) with version {RENDER_VERSION}.")
+
+@bloggit_cli.command("build-assets")
+def build_assets_command():
+    """Writes content-hashed and pre-compressed copies of the static files for asset_url to serve. Run it before each deploy,
+    before the workers start."""
+    assets = current_app.extensions["assets"]
+    manifest = build_assets(current_app.static_folder, assets.dist_folder, current_app.config["COMPRESS_MIN_SIZE"])
+    for name, built in sorted(manifest.items()):
+        click.echo(f"{name} -> {built}")
@@ -0,0 +1,88 @@
+"""This file contains the response compression. Every compressible response over COMPRESS_MIN_SIZE bytes is compressed with the
+best encoding the client accepts: brotli when the brotli package is installed, otherwise gzip. Rendered pages usually come out of
+the page cache (see cache.py) with the same body and ETag many times in a row, so their compressed bodies are kept in a small LRU
+keyed on the ETag and each page is only compressed once per encoding.
+
+Static assets are never compressed here: `flask bloggit build-assets` compresses them ahead of time (see assets.py), and file
+responses are skipped."""
+import gzip
+import threading
+from collections import OrderedDict
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {"text/html", "text/css", "text/plain", "text/csv", "application/json", "application/x-ndjson",
+                          "application/atom+xml", "application/xml", "application/javascript", "image/svg+xml"}
+
+def compress(body, encoding, gzip_level=6, brotli_quality=4):
+    """Compresses body with the given encoding, "br" or "gzip"."""
+    if encoding == "br":
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=gzip_level, mtime=0)
+
+class Compression:
+    """Flask extension that compresses responses as they leave the app. Set COMPRESSION = False to send every response as is."""
+
+    def __init__(self, app=None):
+        self.compressed = OrderedDict()
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+        self.max_entries = app.config.get("COMPRESS_CACHE_ENTRIES", 256)
+        app.after_request(self.after_request)
+        app.extensions["compression"] = self
+
+    def after_request(self, response):
+        config = self.app.config
+        if (not config.get("COMPRESSION", True)
+                or response.status_code < 200 or response.status_code in (204, 206) or response.status_code >= 300
+                or response.direct_passthrough or response.is_streamed
+                or "Content-Encoding" in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None or response.content_length is not None and response.content_length < config["COMPRESS_MIN_SIZE"]:
+            return response
+        body = response.get_data()
+        if len(body) < config["COMPRESS_MIN_SIZE"]:
+            return response
+
+        etag, weak = response.get_etag()
+        key = (etag, encoding) if etag and not weak else None
+        compressed = self.cached(key)
+        if compressed is None:
+            compressed = compress(body, encoding, config["COMPRESS_GZIP_LEVEL"], config["COMPRESS_BROTLI_QUALITY"])
+            self.store(key, compressed)
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+        if etag:
+            # The compressed body isn't byte for byte the page the ETag was made for, so it becomes a weak ETag. Conditional
+            # requests compare ETags weakly, so the client sending it back still gets a 304.
+            response.set_etag(etag, weak=True)
+        return response
+
+    def cached(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            compressed = self.compressed.get(key)
+            if compressed is not None:
+                self.compressed.move_to_end(key)
+            return compressed
+
+    def store(self, key, compressed):
+        if key is None:
+            return
+        with self.lock:
+            self.compressed[key] = compressed
+            while len(self.compressed) > self.max_entries:
+                self.compressed.popitem(last=False)
@@ -0,0 +1,147 @@
+"""This file contains the configuration profiles that create_app can build the app with. The development profile keeps the SQL echo
+and the debug toolbar on, the testing profile quiets them down for the test suite, and the production profile turns them off
+completely so only the lightweight instrumentation is left. The benchmark profile is production's, for benchmark.py."""
+import os
+from pagination import DEFAULT_PER_PAGE
+
+class Config:
+    """Settings shared by every profile."""
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SECRET_KEY = "oh-so-secret"
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+    PAGE_SIZE = DEFAULT_PER_PAGE
+    # Number of posts in each Atom feed.
+    FEED_SIZE = 20
+    # Rows fetched per round trip when the JSON API exports a whole table as NDJSON.
+    API_EXPORT_BATCH_SIZE = 1000
+    # Posts handled per transaction by the bulk moderation endpoints, see moderation.py.
+    BULK_CHUNK_SIZE = 1000
+
+    # Treat "Python" and "python" as the same tag name when checking that tag names are unique. `flask bloggit migrate` backs the
+    # check with a unique index on lower(name) while this is on, so two requests adding "Python" and "python" at once can't both
+    # succeed; run it again after turning this on or off.
+    TAG_NAMES_CASE_INSENSITIVE = False
+    # How many seconds a worker may serve its cached list of tags before reloading it, to pick up other workers' writes.
+    TAG_CATALOG_TTL = 60
+    # How many related posts (the ones sharing the most tags) are kept for each post, and how many its page shows.
+    RELATED_POSTS_KEPT = 20
+    RELATED_POSTS_SHOWN = 5
+    # Trending tags, see trending.py: how many hours each window covers, which window the home page shows and how many tags are
+    # listed.
+    TRENDING_WINDOWS = {"hour": 1, "day": 24, "week": 24 * 7}
+    TRENDING_SIDEBAR_WINDOW = "day"
+    TRENDING_TAGS_SHOWN = 10
+
+    # Where the database is. None means create_app's postgresql:///<db_name>.
+    DATABASE_URL = None
+    # Connection pool settings, left to SQLAlchemy's defaults when None. Postgres cancels any statement that runs for longer than
+    # DB_STATEMENT_TIMEOUT_MS, so one runaway query can't hold a connection (and a worker) forever.
+    DB_POOL_SIZE = None
+    DB_MAX_OVERFLOW = None
+    DB_POOL_TIMEOUT = None
+    DB_POOL_RECYCLE = None
+    DB_POOL_PRE_PING = False
+    DB_STATEMENT_TIMEOUT_MS = None
+    # Read replicas that GET requests read from, see replicas.py. Replicas share the DB_* pool settings above. A visitor's reads
+    # stay on the primary for REPLICA_STICKY_SECONDS after they write, and pages read from a replica aren't cached while one of
+    # their rows changed less than REPLICA_STICKY_SECONDS ago. Replicas are checked every REPLICA_HEALTH_CHECK_INTERVAL seconds,
+    # and a Postgres replica more than REPLICA_MAX_LAG_SECONDS behind the primary is left out until it catches up, so keep
+    # REPLICA_STICKY_SECONDS at least as long as REPLICA_MAX_LAG_SECONDS.
+    DATABASE_REPLICA_URLS = []
+    REPLICA_STICKY_SECONDS = 5
+    REPLICA_HEALTH_CHECK_INTERVAL = 5
+    REPLICA_MAX_LAG_SECONDS = 5
+    # Create any missing tables whenever connect_db is called. Production creates them with `flask bloggit migrate`.
+    CREATE_TABLES_ON_CONNECT = True
+    # Open the pool's connections and compile every template before the first request, see warm_up in app.py.
+    WARM_UP = False
+
+    # Attach the Flask debug toolbar and echo every SQL statement to stdout.
+    DEBUG_TOOLBAR = True
+    SQLALCHEMY_ECHO = True
+
+    # Per-request query/template timings, sent back as a Server-Timing header and aggregated per endpoint at METRICS_ENDPOINT.
+    # Set METRICS_ENDPOINT to None to keep collecting timings without exposing them.
+    INSTRUMENTATION = True
+    SERVER_TIMING_HEADER = True
+    METRICS_ENDPOINT = "/metrics"
+    METRICS_WINDOW = 1000
+
+    # Compression of responses of at least COMPRESS_MIN_SIZE bytes, see compression.py. The levels are tuned for speed, since
+    # pages are compressed while the client waits; static assets are compressed at the highest levels by build-assets instead.
+    COMPRESSION = True
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4
+    COMPRESS_CACHE_ENTRIES = 256
+    # Where `flask bloggit build-assets` writes the hashed static files, see assets.py. None means static/dist.
+    ASSETS_FOLDER = None
+
+    # Cache of rendered pages, see cache.py. The backend is "memory" (one LRU per worker process) or "redis" (shared by workers).
+    RESPONSE_CACHE_ENABLED = True
+    RESPONSE_CACHE_BACKEND = "memory"
+    RESPONSE_CACHE_MAX_ENTRIES = 1000
+    RESPONSE_CACHE_TTL = 300
+    RESPONSE_CACHE_REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+class DevelopmentConfig(Config):
+    """Settings for running the app locally."""
+
+class TestingConfig(Config):
+    """Settings for the test suite. The toolbar is still attached but only shows up for a host that never makes requests."""
+    SQLALCHEMY_ECHO = False
+    DEBUG_TB_HOSTS = ["dont-show-debug-toolbar"]
+    # Tests change rows directly, behind the write routes' backs, so only the cache tests turn the page cache on.
+    RESPONSE_CACHE_ENABLED = False
+
+class ProductionConfig(Config):
+    """Settings for serving real traffic. No SQL echo and no debug toolbar, a pool sized for bursts of concurrent requests, and no
+    schema work when a worker starts. Every setting can be overridden with an environment variable of the same name."""
+    # Signs the sessions, which carry the flashed messages and the read replica stickiness, so it must be secret. create_app
+    # refuses to build the app when it isn't set.
+    SECRET_KEY = os.environ.get("SECRET_KEY")
+    DEBUG_TOOLBAR = False
+    SQLALCHEMY_ECHO = False
+    DATABASE_URL = os.environ.get("DATABASE_URL")
+    DATABASE_REPLICA_URLS = [url for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url]
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+    DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 10))
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+    DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+    DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 5000))
+    CREATE_TABLES_ON_CONNECT = False
+    WARM_UP = True
+    # The metrics show SQL text and timings to anyone who asks, so production only serves them where METRICS_ENDPOINT says,
+    # which should be a path the load balancer keeps private.
+    METRICS_ENDPOINT = os.environ.get("METRICS_ENDPOINT") or None
+
+class BenchmarkConfig(ProductionConfig):
+    """Production's settings for the route benchmark in benchmark.py, which drops and refills its database. The database only ever
+    comes from the benchmark's --db option, never from DATABASE_URL, there are no replicas, and its sessions only ever go to the
+    benchmark's own clients, so it keeps the development SECRET_KEY."""
+    SECRET_KEY = Config.SECRET_KEY
+    DATABASE_URL = None
+    DATABASE_REPLICA_URLS = []
+
+PROFILES = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig,
+    "benchmark": BenchmarkConfig,
+}
+
+def engine_options(config, database_uri):
+    """Builds SQLALCHEMY_ENGINE_OPTIONS from a profile's DB_* settings. SQLite databases keep their own pools, and only Postgres
+    understands the statement timeout."""
+    options = {}
+    if not database_uri.startswith("sqlite"):
+        for setting, option in [("DB_POOL_SIZE", "pool_size"), ("DB_MAX_OVERFLOW", "max_overflow"),
+                                ("DB_POOL_TIMEOUT", "pool_timeout"), ("DB_POOL_RECYCLE", "pool_recycle")]:
+            if config.get(setting) is not None:
+                options[option] = config[setting]
+    if config.get("DB_POOL_PRE_PING"):
+        options["pool_pre_ping"] = True
+    if config.get("DB_STATEMENT_TIMEOUT_MS") and database_uri.startswith("postgresql"):
+        options["connect_args"] = {"options": f"-c statement_timeout={int(config['DB_STATEMENT_TIMEOUT_MS'])}"}
+    return options
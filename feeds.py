@@ -0,0 +1,23 @@
+"""This file contains the Atom feeds of the site, of each user and of each tag. Feed readers poll far more often than people
+browse, so the feed routes are cached like the busiest pages (see cache.py): a poll is answered from the cache, and a reader that
+sends back the feed's ETag in If-None-Match gets a 304 Not Modified, both without touching the database. The write routes drop a
+cached feed as soon as one of the posts, users or tags it shows changes."""
+from flask import make_response, render_template, request
+
+ATOM_MIMETYPE = "application/atom+xml"
+# Used as the updated time of a feed without any posts, so an empty feed renders the same way every time.
+EPOCH = "1970-01-01T00:00:00Z"
+
+def atom_time(value):
+    """Formats a naive UTC datetime, like Post.created_at, as an Atom (RFC 3339) timestamp."""
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ") if value is not None else EPOCH
+
+def render_feed(title, alternate_path, posts):
+    """Renders an Atom feed of posts, which should be the newest ones, newest first, with their authors and tags loaded.
+    alternate_path is the page the feed mirrors, like /users/3."""
+    updated = max((post.created_at for post in posts if post.created_at is not None), default=None)
+    base_url = request.host_url.rstrip("/")
+    response = make_response(render_template("feed.xml", title=title, posts=posts, updated=updated, base_url=base_url,
+                                             self_url=request.base_url, alternate_url=base_url + alternate_path))
+    response.mimetype = ATOM_MIMETYPE
+    return response
@@ -0,0 +1,161 @@
+"""This file contains a lightweight performance instrumentation layer. It times every SQL statement through SQLAlchemy engine events
+and every template render through Flask's template signals, reports the totals for each request in a Server-Timing header, and
+keeps a sliding window of recent timings per endpoint so the metrics endpoint can report p50/p95/p99 latencies."""
+import threading
+from collections import deque
+from time import perf_counter
+from flask import g, has_request_context, jsonify, request, request_started, request_finished, before_render_template, \
+    template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SLOWEST_STATEMENT_LENGTH = 500
+
+class RequestStats:
+    """Timings collected while handling a single request. All times are in seconds."""
+    __slots__ = ("started", "query_count", "sql_time", "slowest_time", "slowest_statement", "template_time", "template_starts")
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.query_count = 0
+        self.sql_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+        self.template_time = 0.0
+        self.template_starts = []
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Remembers when a statement was sent to the database, on the statement's own execution context, so a statement that fails
+    (and never gets to after_cursor_execute) leaves nothing behind on the connection."""
+    if context is not None:
+        context.query_start_time = perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Adds the statement's run time to the stats of the request that is being handled, if there is one."""
+    started = getattr(context, "query_start_time", None)
+    if started is None or not has_request_context():
+        return
+    elapsed = perf_counter() - started
+    stats = g.get("request_stats")
+    if stats is None:
+        return
+    stats.query_count += 1
+    stats.sql_time += elapsed
+    if elapsed >= stats.slowest_time:
+        stats.slowest_time = elapsed
+        stats.slowest_statement = statement
+
+def listen_to_engines():
+    """Times the statements of every engine. The listeners are attached to the Engine class only once, no matter how many apps
+    are created, and only record anything while a request is being handled."""
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+def percentile(sorted_samples, fraction):
+    """Returns the nearest-rank percentile of an already sorted list of samples."""
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, max(0, round(fraction * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+class EndpointStats:
+    """A sliding window of the most recent timings of one endpoint, plus the slowest statement it has ever run. Threaded workers
+    record requests of the same endpoint at the same time, so every change and read goes through the lock."""
+
+    def __init__(self, window):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.samples = deque(maxlen=window)
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+
+    def record(self, stats, total_time):
+        with self.lock:
+            self.count += 1
+            self.samples.append((total_time, stats.sql_time, stats.template_time, stats.query_count))
+            if stats.slowest_statement is not None and stats.slowest_time >= self.slowest_time:
+                self.slowest_time = stats.slowest_time
+                self.slowest_statement = stats.slowest_statement[:SLOWEST_STATEMENT_LENGTH]
+
+    def summary(self):
+        """Returns the p50/p95/p99 of each timing over the window, with times in milliseconds."""
+        with self.lock:
+            samples = list(self.samples)
+            count, slowest_time, slowest_statement = self.count, self.slowest_time, self.slowest_statement
+        summary = {"count": count, "window": len(samples)}
+        for position, name, scale in [(0, "total_ms", 1000), (1, "sql_ms", 1000), (2, "template_ms", 1000), (3, "queries", 1)]:
+            values = sorted(sample[position] * scale for sample in samples)
+            summary[name] = {label: percentile(values, fraction)
+                             for label, fraction in [("p50", 0.50), ("p95", 0.95), ("p99", 0.99)]}
+        summary["slowest_statement"] = {"ms": slowest_time * 1000, "sql": slowest_statement}
+        return summary
+
+class Instrumentation:
+    """Flask extension that records per-request query count, total SQL time, slowest statement and template render time.
+    Attach it with Instrumentation(app), the same way as the debug toolbar."""
+
+    def __init__(self, app=None, started=None):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+        # How long the app took to get going, in milliseconds. The time to first request is measured from started (by default,
+        # when the extension was created) to the end of the first request.
+        self.started = perf_counter() if started is None else started
+        self.startup = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.window = app.config.get("METRICS_WINDOW", 1000)
+        app.extensions["instrumentation"] = self
+        listen_to_engines()
+        request_started.connect(self.request_started, app)
+        request_finished.connect(self.request_finished, app)
+        before_render_template.connect(self.before_render_template, app)
+        template_rendered.connect(self.template_rendered, app)
+        if app.config.get("METRICS_ENDPOINT"):
+            app.add_url_rule(app.config["METRICS_ENDPOINT"], "metrics", self.show_metrics)
+
+    def request_started(self, sender, **extra):
+        g.request_stats = RequestStats()
+
+    def before_render_template(self, sender, template, context, **extra):
+        stats = g.get("request_stats")
+        if stats is not None:
+            stats.template_starts.append(perf_counter())
+
+    def template_rendered(self, sender, template, context, **extra):
+        stats = g.get("request_stats")
+        if stats is not None and stats.template_starts:
+            stats.template_time += perf_counter() - stats.template_starts.pop()
+
+    def request_finished(self, sender, response, **extra):
+        """Adds the Server-Timing header to the response and records the request's timings under its endpoint."""
+        stats = g.get("request_stats")
+        if stats is None:
+            return
+        total_time = perf_counter() - stats.started
+        if "time_to_first_request_ms" not in self.startup:
+            self.startup["time_to_first_request_ms"] = (perf_counter() - self.started) * 1000
+            sender.logger.info("First request served %.0fms after startup", self.startup["time_to_first_request_ms"])
+        if sender.config.get("SERVER_TIMING_HEADER", True):
+            response.headers["Server-Timing"] = ", ".join([
+                f'db;dur={stats.sql_time * 1000:.2f};desc="{stats.query_count} queries"',
+                f"db-slowest;dur={stats.slowest_time * 1000:.2f}",
+                f"tpl;dur={stats.template_time * 1000:.2f}",
+                f"total;dur={total_time * 1000:.2f}",
+            ])
+        self.endpoint_stats(request.endpoint or "<unmatched>").record(stats, total_time)
+
+    def endpoint_stats(self, endpoint):
+        endpoint_stats = self.endpoints.get(endpoint)
+        if endpoint_stats is None:
+            with self.lock:
+                endpoint_stats = self.endpoints.setdefault(endpoint, EndpointStats(self.window))
+        return endpoint_stats
+
+    def show_metrics(self):
+        """Returns the startup timings and the aggregated timings of every endpoint that has been hit so far as JSON."""
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+        return jsonify(startup=self.startup, endpoints={endpoint: stats.summary() for endpoint, stats in endpoints})
@@ -0,0 +1,243 @@
+"""This file contains the bulk loader behind the `flask bloggit load` command. It either generates a synthetic dataset of any size
+(users, tags, posts and their tags, with configurable distributions) or streams rows in from CSV or NDJSON files, and writes them
+in large batches. On Postgres every batch is sent with COPY; on other databases it falls back to SQLAlchemy bulk inserts, which
+use executemany. Nothing is ever held in memory beyond the current batch, so millions of rows load in minutes.
+
+    flask --app app bloggit load --users 100000 --tags 2000 --posts-per-user pareto:1.2:500 --tags-per-post uniform:0:5
+    flask --app app bloggit load --import posts.ndjson --table posts
+"""
+import csv
+import io
+import json
+import math
+import random
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, insert, select, text
+from models import db, ensure_connected, rebuild_archive_months, reconcile_post_counts, User, Post, Tag, PostTag
+from related import rebuild_related_posts
+
+# Tables in the order their rows have to be written so foreign keys are always satisfied.
+TABLES = {"users": User, "tags": Tag, "posts": Post, "posts_tags": PostTag}
+
+FIRST_NAMES = ["Lucky", "Pru", "Abigail", "Franklin", "Jeffrey", "Kenny", "Maricela", "Bo", "Snips", "Turk", "Kate", "Jim"]
+LAST_NAMES = ["Prescott", "Granger", "Stone", "Kong", "Xu", "Jones", "Smith", "Garcia", "Nguyen", "Okafor", "Rossi", ""]
+WORDS = ("the a horse ranch ride trail saddle spirit free run wind river valley morning startup blog progress weather "
+         "springboard project code python flask postgres query index cache page post tag user friend today week").split()
+
+class Distribution:
+    """A random distribution of non-negative integers, written as a spec like "uniform:0:5". Supported specs are constant:N,
+    uniform:LOW:HIGH, normal:MEAN:STDDEV, poisson:MEAN and pareto:SHAPE[:MAX] (a long tail: most values small, a few huge)."""
+
+    def __init__(self, spec, rng):
+        name, *params = spec.split(":")
+        try:
+            params = [float(param) for param in params]
+        except ValueError:
+            raise click.BadParameter(f"{spec!r} has a parameter that isn't a number")
+        samplers = {
+            "constant": (1, lambda value: value),
+            "uniform": (2, lambda low, high: rng.randint(int(low), int(high))),
+            "normal": (2, lambda mean, stddev: rng.gauss(mean, stddev)),
+            "poisson": (1, lambda mean: self.poisson(rng, mean)),
+            "pareto": (1, lambda shape, maximum=math.inf: min(rng.paretovariate(shape) - 1, maximum)),
+        }
+        if name not in samplers or not samplers[name][0] <= len(params) <= samplers[name][0] + (name == "pareto"):
+            raise click.BadParameter(f"{spec!r} isn't a distribution spec, see --help")
+        self.sampler = samplers[name][1]
+        self.params = params
+
+    def sample(self):
+        return max(0, int(round(self.sampler(*self.params))))
+
+    @staticmethod
+    def poisson(rng, mean):
+        """Knuth's method for small means, and a normal approximation for large ones."""
+        if mean > 50:
+            return rng.gauss(mean, math.sqrt(mean))
+        limit, k, p = math.exp(-mean), 0, rng.random()
+        while p > limit:
+            k += 1
+            p *= rng.random()
+        return k
+
+class BulkWriter:
+    """Buffers rows per table and writes every buffer, in foreign key order, once any of them holds batch_size rows. Each
+    flush is its own transaction, so a long load can be watched (and stopped) part way."""
+
+    def __init__(self, batch_size, use_copy=None):
+        self.batch_size = batch_size
+        self.use_copy = db.engine.dialect.name == "postgresql" if use_copy is None else use_copy
+        self.buffers = {table: [] for table in TABLES}
+        self.written = {table: 0 for table in TABLES}
+        self.started = perf_counter()
+
+    def add(self, table, row):
+        self.buffers[table].append(row)
+        if len(self.buffers[table]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for table, rows in self.buffers.items():
+            if rows:
+                for columns, group in split_by_columns(table, rows):
+                    if self.use_copy:
+                        self.copy(table, group, columns)
+                    else:
+                        db.session.execute(insert(TABLES[table]), group)
+                        db.session.commit()
+                self.written[table] += len(rows)
+                self.buffers[table] = []
+        elapsed = perf_counter() - self.started
+        click.echo(", ".join(f"{count} {table}" for table, count in self.written.items()) +
+                   f" written in {elapsed:.1f}s ({sum(self.written.values()) / max(elapsed, 1e-9):,.0f} rows/s)")
+
+    def copy(self, table, rows, columns):
+        """Sends rows, which all have the given columns, to Postgres with COPY ... FROM STDIN, the fastest way to load data into it.
+        None is sent as NULL."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(["\\N" if row[column] is None else row[column] for column in columns])
+        buffer.seek(0)
+        connection = db.session.connection().connection
+        with connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+        db.session.commit()
+
+    def finish(self):
+        """Writes what is left in the buffers, moves the id sequences past the ids that were written explicitly and brings the
+        users', tags' and archive months' post counts and the related posts index up to date, since bulk inserts bypass the code
+        that maintains them."""
+        self.flush()
+        connection = db.session.connection()
+        reconcile_post_counts(connection)
+        rebuild_archive_months(connection)
+        if db.engine.dialect.name == "postgresql":
+            for table in ("users", "tags", "posts"):
+                db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                                        f"GREATEST((SELECT max(id) FROM {table}), 1))"))
+        db.session.commit()
+        if self.written["posts"] or self.written["posts_tags"]:
+            try:
+                rows = rebuild_related_posts(current_app.config["RELATED_POSTS_KEPT"])
+            except ImportError:
+                click.echo("The related posts weren't rebuilt, which needs numpy and scipy: run `flask bloggit rebuild-related` "
+                           "after pip install -r requirements.txt")
+            else:
+                click.echo(f"Wrote {rows} related post rows.")
+
+def split_by_columns(table, rows):
+    """Groups rows by the columns they have, in the table's column order, keeping the rows' order within each group. Each group
+    is written with its own statement, so a column that some imported rows leave out gets its default in those rows, instead of
+    the column list being taken from the first row alone."""
+    names = TABLES[table].__table__.c.keys()
+    groups = {}
+    for row in rows:
+        groups.setdefault(frozenset(row), []).append(row)
+    return [([name for name in names if name in key], group) for key, group in groups.items()]
+
+def next_id(model):
+    return (db.session.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+def generate(writer, rng, users, tags, posts_per_user, tags_per_post, content_length, tag_skew, days):
+    """Streams a synthetic dataset into writer. Ids are assigned up front so posts and tag associations can refer to rows that
+    are still sitting in a buffer."""
+    first_user_id, first_tag_id, post_id = next_id(User), next_id(Tag), next_id(Post)
+    default_image_url = User.__table__.c.image_url.default.arg
+
+    for user_id in range(first_user_id, first_user_id + users):
+        writer.add("users", {"id": user_id, "first_name": rng.choice(FIRST_NAMES), "last_name": rng.choice(LAST_NAMES),
+                             "image_url": default_image_url})
+    tag_ids = list(range(first_tag_id, first_tag_id + tags))
+    for tag_id in tag_ids:
+        writer.add("tags", {"id": tag_id, "name": f"{rng.choice(WORDS)}-{tag_id}"})
+
+    # Tag popularity follows a Zipf-like curve: the tag at rank r is picked with weight 1 / r ** tag_skew.
+    cumulative_weights, total = [], 0.0
+    for rank in range(1, len(tag_ids) + 1):
+        total += 1 / rank ** tag_skew
+        cumulative_weights.append(total)
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    for user_id in range(first_user_id, first_user_id + users):
+        for i in range(posts_per_user.sample()):
+            length = max(1, content_length.sample())
+            content = " ".join(rng.choice(WORDS) for word in range(max(1, length // 6)))[:length]
+            writer.add("posts", {"id": post_id, "title": " ".join(rng.choices(WORDS, k=4))[:50].capitalize(),
+                                 "content": content, "user_id": user_id,
+                                 "created_at": now - timedelta(seconds=rng.randrange(max(1, days * 86400)))})
+            if tag_ids:
+                wanted, picked = min(tags_per_post.sample(), len(tag_ids)), set()
+                while len(picked) < wanted:
+                    picked.update(rng.choices(tag_ids, cum_weights=cumulative_weights, k=wanted - len(picked)))
+                for tag_id in picked:
+                    writer.add("posts_tags", {"post_id": post_id, "tag_id": tag_id})
+            post_id += 1
+
+def read_rows(path, file_format):
+    """Yields the rows of a CSV file with a header line, or of a file with one JSON object per line, one at a time."""
+    with open(path, newline="") as file:
+        if file_format == "csv":
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+def convert_row(table, row, use_copy, number=None):
+    """Checks an imported row's columns against the table and, for bulk inserts, converts the values to the column types. Rows
+    may leave columns out, and those columns get their defaults. number is the row's position in the file, for the errors."""
+    where = f"row {number}: " if number is not None else ""
+    if not isinstance(row, dict):
+        raise click.UsageError(f"{where}expected an object with one value per column")
+    columns = TABLES[table].__table__.c
+    unknown = set(row) - set(columns.keys())
+    if unknown:
+        raise click.UsageError(f"{where}{table} has no column(s) {', '.join(sorted(unknown))}")
+    if use_copy:
+        return row
+    converted = {}
+    for name, value in row.items():
+        if value in (None, "") and columns[name].nullable:
+            value = None
+        elif columns[name].type.python_type is int:
+            value = int(value)
+        elif columns[name].type.python_type is datetime and isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        converted[name] = value
+    return converted
+
+@click.command("load")
+@with_appcontext
+@click.option("--users", default=0, help="Number of users to generate.")
+@click.option("--tags", default=0, help="Number of tags to generate.")
+@click.option("--posts-per-user", default="pareto:1.5:200", show_default=True, help="Distribution of posts per user.")
+@click.option("--tags-per-post", default="uniform:0:4", show_default=True, help="Distribution of tags per post.")
+@click.option("--content-length", default="normal:800:300", show_default=True, help="Distribution of post length, in characters.")
+@click.option("--tag-skew", default=1.0, show_default=True, help="How much more popular the top tags are (0 picks tags uniformly).")
+@click.option("--days", default=365, show_default=True, help="Spread post creation times over this many past days.")
+@click.option("--seed", type=int, help="Random seed, to generate the same dataset again.")
+@click.option("--import", "import_path", type=click.Path(exists=True, dir_okay=False), help="CSV or NDJSON file to import.")
+@click.option("--table", type=click.Choice(list(TABLES)), help="Table the imported rows go into.")
+@click.option("--format", "file_format", type=click.Choice(["csv", "ndjson"]), help="Import file format (default: from extension).")
+@click.option("--batch-size", default=10000, show_default=True, help="Rows written per batch.")
+def load(users, tags, posts_per_user, tags_per_post, content_length, tag_skew, days, seed, import_path, table, file_format,
+         batch_size):
+    """Generates a synthetic dataset, or imports rows from a CSV/NDJSON file, using COPY on Postgres."""
+    ensure_connected(current_app)
+    writer = BulkWriter(batch_size)
+    if import_path:
+        if table is None:
+            raise click.UsageError("--import needs --table")
+        file_format = file_format or ("csv" if import_path.endswith(".csv") else "ndjson")
+        for number, row in enumerate(read_rows(import_path, file_format), start=1):
+            writer.add(table, convert_row(table, row, writer.use_copy, number))
+    else:
+        rng = random.Random(seed)
+        generate(writer, rng, users, tags, Distribution(posts_per_user, rng), Distribution(tags_per_post, rng),
+                 Distribution(content_length, rng), tag_skew, days)
+    writer.finish()
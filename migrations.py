@@ -0,0 +1,173 @@
+"""This file contains the versioned schema migrations. create_all only creates missing tables and never changes one that already
+exists, so every change to an existing table (a new index, column or constraint) is added here as a Migration with the next version
+number. `flask bloggit migrate` applies the migrations a database hasn't seen yet, in order, and records each one in the
+schema_migrations table.
+
+Migrations run outside of a transaction, one statement at a time, so that on Postgres indexes can be built with CREATE INDEX
+CONCURRENTLY without locking writes out of a live database. A migration that fails part way can't be rolled back, so every step
+is written to be safe to run again."""
+from datetime import datetime, timezone
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table, Text, func, inspect, insert, select, text
+from models import db, rebuild_archive_months, reconcile_post_counts, ArchiveMonth, RelatedPost, Tag, TagActivity, \
+    SEARCH_VECTOR_EXPRESSION
+
+schema_migrations = Table(
+    "schema_migrations", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", Text, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+class Migration:
+    """One version of the schema. steps are functions that take a connection and make the changes."""
+
+    def __init__(self, version, description, *steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+def run_sql(statement, dialect=None):
+    """A step that runs statement, only on the given dialect if there is one."""
+    def step(connection):
+        if dialect is None or connection.dialect.name == dialect:
+            connection.exec_driver_sql(statement)
+    return step
+
+def create_index(name, table, columns, using=None, dialect=None, unique=False):
+    """A step that builds an index unless it already exists. On Postgres it is built CONCURRENTLY, after dropping the invalid
+    index an interrupted earlier build leaves behind."""
+    def step(connection):
+        if dialect is not None and connection.dialect.name != dialect:
+            return
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        if connection.dialect.name == "postgresql":
+            invalid = connection.execute(text("SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                                              "WHERE c.relname = :name AND NOT i.indisvalid"), {"name": name}).first()
+            if invalid:
+                connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY {name}")
+            method = f" USING {using}" if using else ""
+            connection.exec_driver_sql(f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} ON {table}{method} ({columns})")
+        else:
+            connection.exec_driver_sql(f"CREATE {kind} IF NOT EXISTS {name} ON {table} ({columns})")
+    return step
+
+def drop_index(name):
+    """A step that drops an index if it exists, CONCURRENTLY on Postgres."""
+    def step(connection):
+        concurrently = " CONCURRENTLY" if connection.dialect.name == "postgresql" else ""
+        connection.exec_driver_sql(f"DROP INDEX{concurrently} IF EXISTS {name}")
+    return step
+
+def add_column(table, name, definition, dialect=None):
+    """A step that adds a column unless the table already has it."""
+    def step(connection):
+        if dialect is not None and connection.dialect.name != dialect:
+            return
+        if name not in {column["name"] for column in inspect(connection).get_columns(table)}:
+            connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    return step
+
+def cascade_foreign_key(table, column, referenced_table):
+    """Steps that make a Postgres foreign key ON DELETE CASCADE. The new constraint is added NOT VALID and validated separately,
+    so the table is only locked briefly instead of for a full scan."""
+    name = f"{table}_{column}_fkey"
+    return [
+        run_sql(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {name}, ADD CONSTRAINT {name} FOREIGN KEY ({column}) "
+                f"REFERENCES {referenced_table} (id) ON DELETE CASCADE NOT VALID", dialect="postgresql"),
+        run_sql(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}", dialect="postgresql"),
+    ]
+
+def create_tables(connection):
+    db.metadata.create_all(connection)
+
+def create_table(table):
+    """A step that creates a table, with its indexes, unless it already exists."""
+    def step(connection):
+        table.create(connection, checkfirst=True)
+    return step
+
+MIGRATIONS = [
+    Migration(1, "Create the tables", create_tables),
+    Migration(2, "Index tag names case-insensitively", create_index("ix_tags_lower_name", "tags", "lower(name)")),
+    Migration(3, "Full-text search over posts",
+              add_column("posts", "search_vector", f"tsvector GENERATED ALWAYS AS ({SEARCH_VECTOR_EXPRESSION}) STORED",
+                         dialect="postgresql"),
+              create_index("ix_posts_search_vector", "posts", "search_vector", using="GIN", dialect="postgresql")),
+    Migration(4, "Delete posts and tag associations along with their user, post or tag",
+              *cascade_foreign_key("posts", "user_id", "users"),
+              *cascade_foreign_key("posts_tags", "post_id", "posts"),
+              *cascade_foreign_key("posts_tags", "tag_id", "tags")),
+    Migration(5, "Index the user, tag and post listings",
+              create_index("ix_users_name", "users", "last_name, first_name, id"),
+              create_index("ix_posts_user_id_id", "posts", "user_id, id"),
+              create_index("ix_posts_created_at_id", "posts", "created_at, id"),
+              create_index("ix_posts_tags_tag_id_post_id", "posts_tags", "tag_id, post_id")),
+    Migration(6, "Count the posts of every user and tag",
+              add_column("users", "post_count", "INTEGER NOT NULL DEFAULT 0"),
+              add_column("tags", "post_count", "INTEGER NOT NULL DEFAULT 0"),
+              reconcile_post_counts,
+              create_index("ix_users_post_count", "users", "post_count, id"),
+              create_index("ix_tags_post_count", "tags", "post_count, id")),
+    Migration(7, "Index the related posts of every post", create_table(RelatedPost.__table__)),
+    Migration(8, "Count every tag's posts per hour for the trending tags", create_table(TagActivity.__table__)),
+    Migration(9, "Let the database set creation times and browse posts by month",
+              run_sql("ALTER TABLE posts ALTER COLUMN created_at SET DEFAULT TIMEZONE('utc', CURRENT_TIMESTAMP)",
+                      dialect="postgresql"),
+              create_table(ArchiveMonth.__table__),
+              rebuild_archive_months),
+    # Existing posts keep showing their raw content until `flask bloggit rerender-posts` renders them.
+    Migration(10, "Store the rendered HTML and an excerpt of every post",
+              add_column("posts", "content_html", "TEXT"),
+              add_column("posts", "excerpt", "TEXT"),
+              add_column("posts", "render_version", "INTEGER NOT NULL DEFAULT 0")),
+    # The users list is keyset-paginated on last_name, where a NULL would break the cursor and drop out of the comparisons.
+    Migration(11, "Store an empty last name instead of NULL",
+              run_sql("UPDATE users SET last_name = '' WHERE last_name IS NULL"),
+              run_sql("ALTER TABLE users ALTER COLUMN last_name SET DEFAULT '', ALTER COLUMN last_name SET NOT NULL",
+                      dialect="postgresql")),
+]
+
+def case_insensitive_tag_names(enabled):
+    """A step that makes the database reject tag names that only differ in case while TAG_NAMES_CASE_INSENSITIVE is on, with a
+    unique index on lower(name), and drops that index while it is off. The check in the tag routes can't see a tag another
+    request is adding at the same time, the index can. Raises ValueError, without building the index, while some tags' names
+    only differ in case; rename or delete them first."""
+    def step(connection):
+        if not enabled:
+            drop_index("ux_tags_lower_name")(connection)
+            return
+        lower_name = func.lower(Tag.name)
+        clashes = connection.execute(select(lower_name).group_by(lower_name).having(func.count() > 1)).scalars().all()
+        if clashes:
+            raise ValueError(f"These tag names are used more than once, in different cases: {', '.join(sorted(clashes))}")
+        create_index("ux_tags_lower_name", "tags", "lower(name)", unique=True)(connection)
+    return step
+
+def applied_versions(connection):
+    schema_migrations.create(connection, checkfirst=True)
+    return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+def migrate(engine, report=None, case_insensitive_tags=False):
+    """Applies the migrations the database hasn't seen yet, in order, calling report with each one before it runs, then adds or
+    drops the unique index behind case_insensitive_tags (the app's TAG_NAMES_CASE_INSENSITIVE), which follows the setting
+    instead of a version. Returns the migrations that were applied."""
+    applied = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if connection.dialect.name == "postgresql":
+            # Building an index or validating a constraint on a big table outlasts any statement timeout meant for requests.
+            connection.exec_driver_sql("SET statement_timeout = 0")
+        done = applied_versions(connection)
+        for migration in MIGRATIONS:
+            if migration.version in done:
+                continue
+            if report is not None:
+                report(migration)
+            for step in migration.steps:
+                step(connection)
+            connection.execute(insert(schema_migrations).values(version=migration.version, description=migration.description,
+                                                                applied_at=datetime.now(timezone.utc)))
+            applied.append(migration)
+        case_insensitive_tag_names(case_insensitive_tags)(connection)
+        if connection.dialect.name == "postgresql":
+            connection.exec_driver_sql("RESET statement_timeout")
+    return applied
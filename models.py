@@ -1,19 +1,120 @@
 """This file contains the models for the Bloggit app, establishing the tables and columsn in tables in the bloggit database.
 Models include Users and Posts."""
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timezone
+import sqlite3
+from sqlalchemy import select, insert, update, delete, event, extract, func, DDL, DateTime
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores foreign keys, and so the ON DELETE CASCADE rules below, unless they are switched on for each connection."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+class utcnow(FunctionElement):
+    """The current UTC time, computed by the database. Used as a server-side default so every row gets the time it was really
+    inserted at, whichever worker inserted it."""
+    type = DateTime()
+    inherit_cache = True
+
+@compiles(utcnow)
+def compile_utcnow(element, compiler, **kw):
+    # SQLite stores times as text and compares them as strings, so the default must have the format SQLAlchemy binds datetimes
+    # in, down to the microseconds: CURRENT_TIMESTAMP's "YYYY-MM-DD HH:MM:SS" sorts before the same moment bound as
+    # "YYYY-MM-DD HH:MM:SS.000000", which broke keyset pages and month bounds. 'now' is already in UTC.
+    return "(strftime('%Y-%m-%d %H:%M:%f', 'now') || '000')"
+
+@compiles(utcnow, "postgresql")
+def compile_utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+def upsert_counts(model, rows, counter):
+    """Inserts rows into model's table, adding each row's counter column to the existing row's instead when one with the same
+    primary key is already there, in the current transaction."""
+    if not rows:
+        return
+    keys = [column.name for column in model.__table__.primary_key]
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        statement = dialect_insert(model).values(rows)
+        column = getattr(model, counter)
+        db.session.execute(statement.on_conflict_do_update(index_elements=keys,
+                                                           set_={counter: column + getattr(statement.excluded, counter)}))
+        return
+    # Without an upsert, add to the rows that already exist one at a time and insert the rest.
+    for row in rows:
+        key = [getattr(model, name) == row[name] for name in keys]
+        result = db.session.execute(update(model).where(*key).values({counter: getattr(model, counter) + row[counter]}),
+                                    execution_options={'synchronize_session': False})
+        if not result.rowcount:
+            db.session.execute(insert(model), [row])
+
+def upsert_rows(model, rows, columns):
+    """Inserts rows into model's table, overwriting the given columns of the existing row instead when one with the same primary
+    key is already there, for example because a concurrent transaction wrote it first, in the current transaction. The rows are
+    written in primary key order, so concurrent writers lock them in the same order."""
+    if not rows:
+        return
+    keys = [column.name for column in model.__table__.primary_key]
+    rows = sorted(rows, key=lambda row: [row[name] for name in keys])
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        statement = dialect_insert(model).values(rows)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=keys, set_={column: getattr(statement.excluded, column) for column in columns}))
+        return
+    # Without an upsert, update the rows that already exist one at a time and insert the rest.
+    for row in rows:
+        key = [getattr(model, name) == row[name] for name in keys]
+        result = db.session.execute(update(model).where(*key).values({column: row[column] for column in columns}),
+                                    execution_options={'synchronize_session': False})
+        if not result.rowcount:
+            db.session.execute(insert(model), [row])
 
 def connect_db(app):
     with app.app_context():
         db.app = app
         db.init_app(app)
-        db.create_all()
+        if app.config.get('CREATE_TABLES_ON_CONNECT', True):
+            db.create_all()
+
+def ensure_connected(app):
+    """Connects the database to the app, unless that has already been done (the CLI builds the app without connecting it). Every
+    `flask bloggit` command calls this first. Their bulk loads, index builds and rebuilds take far longer than any request, so on
+    Postgres the connections they use have no statement timeout, whatever the profile's DB_STATEMENT_TIMEOUT_MS."""
+    if 'sqlalchemy' not in app.extensions:
+        connect_db(app)
+    engine = db.engine
+    if engine.dialect.name == "postgresql" and not event.contains(engine, "connect", disable_statement_timeout):
+        # Connections the app already opened keep their timeout, so they are closed and opened again.
+        engine.dispose()
+        event.listen(engine, "connect", disable_statement_timeout)
+
+def disable_statement_timeout(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("SET statement_timeout = 0")
+    cursor.close()
+    dbapi_connection.commit()
 
 class User(db.Model):
     """User model. Each user will have an id (primary key), first name, last name, and an image URL for their profile picture.
-    First name is required, but last name is not. Profile picture's url is also optional, users without one will have a default one."""
+    First name is required, but last name can be left empty (it is never NULL, since the users list is sorted and paginated on it).
+    Profile picture's url is also optional, users without one will have a default one."""
     
     __tablename__ = "users"
 
@@ -24,12 +125,33 @@ class User(db.Model):
         """Returns the full name (first name then last name) of a particular user. This method is here for convenience."""
         return f"{self.first_name} {self.last_name}"
 
+    def to_dict(self):
+        """Returns the user as a dictionary for the JSON API."""
+        return {"id": self.id, "first_name": self.first_name, "last_name": self.last_name, "image_url": self.image_url,
+                "post_count": self.post_count}
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     first_name = db.Column(db.Text, nullable=False)
-    last_name = db.Column(db.Text, nullable=True, default="")
+    last_name = db.Column(db.Text, nullable=False, default="", server_default="")
     image_url = db.Column(db.Text, nullable=True, default="https://cdn3.iconfinder.com/data/icons/letters-and-numbers-1/32/letter_B_red-512.png")
+    # How many posts the user has written, kept up to date by the write routes (see adjust_post_count).
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Serve the users list, which is sorted and paginated on (last name, first name, id) or on (post count, id).
+    __table_args__ = (db.Index('ix_users_name', last_name, first_name, id), db.Index('ix_users_post_count', post_count, id))
+
+    @classmethod
+    def adjust_post_count(cls, user_ids, delta):
+        """Adds delta to the post counts of the given users with a single UPDATE, in the current transaction. The addition
+        happens in the database, so concurrent writers can't overwrite each other's changes."""
+        if user_ids:
+            db.session.execute(update(cls).where(cls.id.in_(user_ids)).values(post_count=cls.post_count + delta),
+                               execution_options={'synchronize_session': False})
     
-    posts = db.relationship('Post', cascade='all, delete', backref='author')
+    # Deleting a user deletes their posts (and those posts' tag associations) in the database through ON DELETE CASCADE, so
+    # passive_deletes stops SQLAlchemy from loading and deleting them one at a time first. The same goes for the other
+    # relationships below.
+    posts = db.relationship('Post', cascade='all, delete', passive_deletes=True, backref='author')
 
 class Post(db.Model):
     """Post model. Each post that's created will have an id, title (which can be no longer than 50 characters), content text, 
@@ -40,14 +162,102 @@ class Post(db.Model):
     def __repr__(self):
         return f"<Post id={self.id} title={self.title} Created At: {self.created_at}> by {self.author.first_name} {self.author.last_name}"
 
+    def to_dict(self):
+        """Returns the post as a dictionary for the JSON API. Load the tags eagerly when serializing many posts."""
+        return {"id": self.id, "title": self.title, "content": self.content, "content_html": self.content_html,
+                "excerpt": self.excerpt, "created_at": self.created_at.isoformat() if self.created_at else None, "user_id": self.user_id,
+                "tag_ids": sorted(tag.id for tag in self.tags)}
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String(50), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # content is Markdown. Its sanitized HTML and a plain text excerpt are rendered when the post is saved, by the RENDER_VERSION
+    # of rendering.py stored in render_version. They are None for posts that were never rendered, which show content instead.
+    content_html = db.Column(db.Text, nullable=True)
+    excerpt = db.Column(db.Text, nullable=True)
+    render_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Set by the database when the post is inserted, in UTC, and read back in the same INSERT (see eager_defaults).
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+
+    # (user_id, id) serves a user's posts newest first, and the ON DELETE CASCADE from users. (created_at, id) serves the posts
+    # in date order, newest first on the home page and one month at a time in the archive.
+    __table_args__ = (db.Index('ix_posts_user_id_id', user_id, id), db.Index('ix_posts_created_at_id', created_at, id))
+    __mapper_args__ = {'eager_defaults': True}
+
+    tags = db.relationship('Tag', secondary='posts_tags', passive_deletes=True, backref=db.backref('posts', passive_deletes=True))
+    tag_associations = db.relationship('PostTag', cascade='all, delete', passive_deletes=True, backref='post')
+
+    def set_tags(self, tag_ids, current_tag_ids=None):
+        """Makes tag_ids the exact set of tags on this post. Only the associations that changed are written, as one bulk INSERT
+        and one bulk DELETE, in the current transaction. Pass current_tag_ids if the current tags are already known (an empty
+        set for a new post) to skip looking them up. Returns the sets of added and removed tag ids."""
+        if current_tag_ids is None:
+            current_tag_ids = set(db.session.execute(select(PostTag.tag_id).where(PostTag.post_id == self.id)).scalars())
+        added = set(tag_ids) - current_tag_ids
+        removed = current_tag_ids - set(tag_ids)
+        if added:
+            db.session.execute(insert(PostTag), [{"post_id": self.id, "tag_id": tag_id} for tag_id in added])
+            Tag.adjust_post_count(added, 1)
+        if removed:
+            db.session.execute(delete(PostTag).where(PostTag.post_id == self.id, PostTag.tag_id.in_(removed)))
+            Tag.adjust_post_count(removed, -1)
+        if added or removed:
+            # The tags collection no longer matches the table, so make the next access reload it.
+            db.session.expire(self, ['tags', 'tag_associations'])
+        return added, removed
+
+    @classmethod
+    def add(cls, title, content, user_id, tag_ids, related_posts_kept):
+        """Adds a post by user_id with the given tags in the current transaction. The post is rendered, and the post counts, the
+        archive, the related posts and the trending tags are kept up to date. Returns the new post and the ids of the posts
+        whose related posts changed."""
+        # These modules build on the models, so they can only be imported once the models are defined.
+        from related import refresh_related_posts
+        from rendering import render_post
+        from trending import record_tag_activity
+        post = cls(title=title, content=content, user_id=user_id)
+        render_post(post)
+        db.session.add(post)
+        db.session.flush()
+        User.adjust_post_count([user_id], 1)
+        ArchiveMonth.count_post(post.created_at)
+        post.set_tags(tag_ids, current_tag_ids=set())
+        related_post_ids = refresh_related_posts(post.id, related_posts_kept) if tag_ids else set()
+        record_tag_activity(tag_ids)
+        return post, related_post_ids
+
+    @classmethod
+    def release_post_counts(cls, post_ids, authors=True):
+        """Takes the posts whose ids are post_ids (a list, or a SELECT of ids) off their authors' and tags' post counts, with one
+        UPDATE per table. Call it in the same transaction, right before deleting the posts, while their tag associations still
+        exist. Pass authors=False when the authors are being deleted too. The archive's month counts are lowered as well."""
+        counts = [(Tag, PostTag.tag_id, PostTag.post_id)]
+        if authors:
+            counts.append((User, cls.user_id, cls.id))
+        for model, owner_id, post_id in counts:
+            removed = select(func.count()).where(owner_id == model.id, post_id.in_(post_ids)).scalar_subquery()
+            db.session.execute(update(model).where(model.id.in_(select(owner_id).where(post_id.in_(post_ids))))
+                               .values(post_count=model.post_count - removed),
+                               execution_options={'synchronize_session': False})
+        in_month = [cls.id.in_(post_ids), extract('year', cls.created_at) == ArchiveMonth.year,
+                    extract('month', cls.created_at) == ArchiveMonth.month]
+        removed = select(func.count()).where(*in_month).scalar_subquery()
+        db.session.execute(update(ArchiveMonth).where(select(cls.id).where(*in_month).exists())
+                           .values(posts=ArchiveMonth.posts - removed),
+                           execution_options={'synchronize_session': False})
 
-    tags = db.relationship('Tag', secondary='posts_tags', backref='posts')
-    tag_associations = db.relationship('PostTag', cascade='all, delete', backref='post')
+# On Postgres, posts get a full-text search vector over the title (weighted higher) and the content. It is a generated column,
+# so the database keeps it up to date on every insert and update, and a GIN index serves the searches in search.py. It isn't
+# mapped on the model because other databases have no tsvector type; search.py falls back to LIKE matching there.
+SEARCH_VECTOR_EXPRESSION = ("setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+                            "setweight(to_tsvector('english', coalesce(content, '')), 'B')")
+event.listen(Post.__table__, 'after_create', DDL(
+    f"ALTER TABLE posts ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ({SEARCH_VECTOR_EXPRESSION}) STORED"
+).execute_if(dialect='postgresql'))
+event.listen(Post.__table__, 'after_create', DDL(
+    "CREATE INDEX ix_posts_search_vector ON posts USING GIN (search_vector)"
+).execute_if(dialect='postgresql'))
 
 class Tag(db.Model):
     """Tag model. Each Post can be associated with one or more tags. The name of each tag must be unique 
@@ -57,11 +267,46 @@ class Tag(db.Model):
 
     def __repr__(self):
         return f"<Tag id={self.id} name of tag={self.name}>"
+
+    def to_dict(self):
+        """Returns the tag as a dictionary for the JSON API."""
+        return {"id": self.id, "name": self.name, "post_count": self.post_count}
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(50), nullable=False, unique=True)
 
-    post_associations = db.relationship('PostTag', cascade='all, delete', backref='tag')
+    # How many posts have the tag, kept up to date by Post.set_tags and Post.release_post_counts.
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # The unique constraint already indexes name for exact lookups, this index serves the case-insensitive ones. The post count
+    # index serves the tags list sorted by popularity.
+    __table_args__ = (db.Index('ix_tags_lower_name', db.func.lower(name)), db.Index('ix_tags_post_count', post_count, id))
+
+    @classmethod
+    def adjust_post_count(cls, tag_ids, delta):
+        """Adds delta to the post counts of the given tags with a single UPDATE, in the current transaction."""
+        if tag_ids:
+            db.session.execute(update(cls).where(cls.id.in_(tag_ids)).values(post_count=cls.post_count + delta),
+                               execution_options={'synchronize_session': False})
+
+    @classmethod
+    def name_taken(cls, name, exclude_id=None, case_insensitive=False):
+        """Returns True if a tag other than the one whose id is exclude_id already has this name. This is a single indexed
+        lookup instead of a scan over every tag."""
+        if case_insensitive:
+            query = db.session.query(cls.id).filter(db.func.lower(cls.name) == name.lower())
+        else:
+            query = db.session.query(cls.id).filter(cls.name == name)
+        if exclude_id is not None:
+            query = query.filter(cls.id != exclude_id)
+        return db.session.query(query.exists()).scalar()
+
+    post_associations = db.relationship('PostTag', cascade='all, delete', passive_deletes=True, backref='tag')
+
+    @classmethod
+    def existing_ids(cls, tag_ids):
+        """Returns the subset of tag_ids that belong to existing tags, using a single query."""
+        return set(db.session.execute(select(cls.id).where(cls.id.in_(tag_ids))).scalars())
 
 class PostTag(db.Model):
     """PostTag model, each row in this table associates a specific post with a specific tag by listing the post's id with the tag's id."""
@@ -71,6 +316,95 @@ class PostTag(db.Model):
     def __repr__(self):
         return f"<PostTag post_id={self.post_id} tag_id={self.tag_id}"
     
-    post_id = db.Column(db.Integer, db.ForeignKey("posts.id"), primary_key=True)
-    tag_id = db.Column(db.Integer, db.ForeignKey('tags.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.id", ondelete='CASCADE'), primary_key=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'), primary_key=True)
+
+    # The primary key serves lookups by post, this index serves a tag's posts newest first and the ON DELETE CASCADE from tags.
+    __table_args__ = (db.Index('ix_posts_tags_tag_id_post_id', tag_id, post_id),)
+
+class RelatedPost(db.Model):
+    """RelatedPost model, each row says that the post with related_post_id shares shared_tags tags with the post with post_id.
+    Both directions of a pair are stored, so a post's most related posts are one range of the index below. The rows are kept up
+    to date by related.py."""
+
+    __tablename__ = "related_posts"
+
+    def __repr__(self):
+        return f"<RelatedPost post_id={self.post_id} related_post_id={self.related_post_id} shared_tags={self.shared_tags}>"
+
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True)
+    related_post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True)
+    shared_tags = db.Column(db.Integer, nullable=False)
+
+    # The first index serves a post's most related posts, the second one finds every post a post is listed as related to.
+    __table_args__ = (db.Index('ix_related_posts_rank', post_id, shared_tags.desc(), related_post_id.desc()),
+                      db.Index('ix_related_posts_related_post_id', related_post_id))
+
+class TagActivity(db.Model):
+    """TagActivity model, each row counts the posts that were given a tag during one hour (hour is the start of that hour, in
+    UTC). Summing a tag's recent rows gives how active it is right now without touching posts or posts_tags. The rows are kept
+    up to date by trending.py."""
+
+    __tablename__ = "tag_activity"
+
+    def __repr__(self):
+        return f"<TagActivity tag_id={self.tag_id} hour={self.hour} posts={self.posts}>"
+
+    tag_id = db.Column(db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'), primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True)
+    posts = db.Column(db.Integer, nullable=False, default=0)
+
+    # Serves summing every tag's activity since a given hour straight from the index, and pruning old hours.
+    __table_args__ = (db.Index('ix_tag_activity_hour', hour, tag_id, posts),)
+
+class ArchiveMonth(db.Model):
+    """ArchiveMonth model, each row counts the posts created in one month, so the archive can list every month with its number
+    of posts without counting the posts table. The counts are kept up to date by Post.add and Post.release_post_counts, and
+    rebuilt from the posts by rebuild_archive_months."""
+
+    __tablename__ = "archive_months"
+
+    def __repr__(self):
+        return f"<ArchiveMonth year={self.year} month={self.month} posts={self.posts}>"
+
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    posts = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def count_post(cls, created_at):
+        """Counts one more post in the month of created_at, in the current transaction."""
+        upsert_counts(cls, [{"year": created_at.year, "month": created_at.month, "posts": 1}], "posts")
+
+def rebuild_archive_months(connection):
+    """Recounts the posts of every month from the posts table and replaces the archive's month counts. Returns the number of
+    months with posts."""
+    year, month = extract('year', Post.created_at), extract('month', Post.created_at)
+    connection.execute(delete(ArchiveMonth.__table__))
+    result = connection.execute(insert(ArchiveMonth.__table__).from_select(
+        ["year", "month", "posts"],
+        select(year, month, func.count()).where(Post.created_at.is_not(None)).group_by(year, month)))
+    return result.rowcount
+
+def backfill_created_at(connection):
+    """Repairs creation times written before they were set by the database, when every worker stamped its posts with the time it
+    started. Ids are handed out in creation order, so a post can't be older than any post before it: each post's time is raised
+    to the latest time of the posts up to it, and a missing time is filled in the same way (or with the current time when no
+    earlier post has one). The result is the earliest each post can really have been created. Returns how many posts changed."""
+    running = (select(Post.id, func.max(Post.created_at).over(order_by=Post.id).label("created_at"))
+               .subquery("running"))
+    fixed = func.coalesce(running.c.created_at, utcnow())
+    result = connection.execute(update(Post.__table__).where(Post.__table__.c.id == running.c.id)
+                                .where((Post.__table__.c.created_at < fixed) | Post.__table__.c.created_at.is_(None))
+                                .values(created_at=fixed))
+    return result.rowcount
 
+def reconcile_post_counts(connection):
+    """Recounts every user's and tag's posts and fixes the post counts that drifted, with one UPDATE per table that only touches
+    the rows that are wrong. Returns how many users and how many tags were fixed."""
+    fixed = []
+    for table, owner_id in [(User.__table__, Post.user_id), (Tag.__table__, PostTag.tag_id)]:
+        actual = select(func.count()).where(owner_id == table.c.id).scalar_subquery()
+        result = connection.execute(update(table).where(table.c.post_count != actual).values(post_count=actual))
+        fixed.append(result.rowcount)
+    return tuple(fixed)
@@ -0,0 +1,176 @@
+"""This file contains the bulk moderation operations behind the /api/posts/bulk endpoints: deleting posts, and adding or removing
+tags on them, for every post matched by a list of ids or by filters (author, tag, id range). Posts are handled BULK_CHUNK_SIZE at a
+time in id order. Each chunk takes a few set-based statements, whatever its size, and is committed on its own, so a cleanup of
+100k posts takes a hundred short transactions instead of 100k requests, and never holds its locks for long.
+
+Every chunk keeps the same rows up to date as the single-post routes do: the authors', tags' and months' post counts and the
+related posts index. Shared tag counts of pairs already in the index are raised or lowered as tags come and go, but pairs that
+only start sharing a tag aren't added; `flask bloggit rebuild-related` recomputes the best matches of every post after a large
+retagging. Moderation isn't activity, so bulk retagging doesn't count towards the trending tags."""
+from sqlalchemy import and_, delete, exists, insert, or_, select, update
+from models import db, Post, PostTag, RelatedPost, Tag
+
+class BulkSelection:
+    """The posts a bulk operation applies to: the posts whose ids are in post_ids if given, narrowed down by the filters."""
+
+    def __init__(self, post_ids=None, author_id=None, tag_id=None, min_id=None, max_id=None):
+        self.post_ids = post_ids
+        self.author_id = author_id
+        self.tag_id = tag_id
+        self.min_id = min_id
+        self.max_id = max_id
+
+    @classmethod
+    def from_json(cls, data):
+        """Builds a selection from a request body like {"post_ids": [1, 2], "author": 3, "tag": 4, "min_id": 5, "max_id": 6}.
+        Raises ValueError if a value isn't an integer, or if there are neither ids nor filters, so a mistake can't match every
+        post."""
+        def integer(value):
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+                raise ValueError("post ids and filters must be integers")
+            return value
+        post_ids = data.get("post_ids")
+        if post_ids is not None:
+            if not isinstance(post_ids, list):
+                raise ValueError("post_ids must be a list")
+            post_ids = sorted({integer(post_id) for post_id in post_ids})
+        selection = cls(post_ids, integer(data.get("author")), integer(data.get("tag")), integer(data.get("min_id")),
+                        integer(data.get("max_id")))
+        if post_ids is None and not selection.filters():
+            raise ValueError("give post_ids or at least one of author, tag, min_id and max_id")
+        return selection
+
+    def filters(self):
+        filters = []
+        if self.author_id is not None:
+            filters.append(Post.user_id == self.author_id)
+        if self.tag_id is not None:
+            filters.append(exists().where(PostTag.post_id == Post.id, PostTag.tag_id == self.tag_id))
+        if self.min_id is not None:
+            filters.append(Post.id >= self.min_id)
+        if self.max_id is not None:
+            filters.append(Post.id <= self.max_id)
+        return filters
+
+    def chunks(self, size):
+        """Yields the ids of the selected posts, at most size at a time and in id order. Each chunk is looked up once the previous
+        one has been handled, by position in post_ids or after the last id seen, so deleting the posts as they come is safe."""
+        if self.post_ids is not None:
+            for start in range(0, len(self.post_ids), size):
+                ids = db.session.execute(select(Post.id).where(Post.id.in_(self.post_ids[start:start + size]), *self.filters())
+                                         .order_by(Post.id)).scalars().all()
+                if ids:
+                    yield ids
+            return
+        last_id = None
+        while True:
+            query = select(Post.id).where(*self.filters())
+            if last_id is not None:
+                query = query.where(Post.id > last_id)
+            ids = db.session.execute(query.order_by(Post.id).limit(size)).scalars().all()
+            if not ids:
+                return
+            yield ids
+            last_id = ids[-1]
+
+def shared_tag_pairs(post_ids, tagged):
+    """The related posts rows between a post in post_ids and another post in post_ids or tagged, in either direction. They come
+    as two conditions that don't overlap, one for the rows of the posts themselves, found on the primary key, and one for the rows
+    listing them, found on the related_post_id index, since an OR of the two would have the database scan the whole table."""
+    return [and_(RelatedPost.post_id.in_(post_ids),
+                 or_(RelatedPost.related_post_id.in_(post_ids), RelatedPost.related_post_id.in_(tagged))),
+            and_(RelatedPost.related_post_id.in_(post_ids), RelatedPost.post_id.not_in(post_ids), RelatedPost.post_id.in_(tagged))]
+
+def changed_related_posts(pairs):
+    return set(db.session.execute(select(RelatedPost.post_id).where(pairs).distinct()).scalars())
+
+def shift_shared_tags(pairs, delta):
+    """Adds delta to the shared tag counts of the pairs, deleting the pairs left without a shared tag. Returns the ids of the
+    posts whose related posts changed."""
+    related = set()
+    for condition in pairs:
+        related |= changed_related_posts(condition)
+        db.session.execute(update(RelatedPost).where(condition).values(shared_tags=RelatedPost.shared_tags + delta),
+                           execution_options={"synchronize_session": False})
+        if delta < 0:
+            db.session.execute(delete(RelatedPost).where(condition, RelatedPost.shared_tags <= 0),
+                               execution_options={"synchronize_session": False})
+    return related
+
+def delete_posts(post_ids):
+    """Deletes the posts, taking them off their authors', tags' and months' post counts, in the current transaction. Their tag
+    associations and related posts rows go with them through ON DELETE CASCADE. Returns the number of posts deleted and the
+    cache dependencies to invalidate."""
+    authors = set(db.session.execute(select(Post.user_id).where(Post.id.in_(post_ids)).distinct()).scalars())
+    tags = set(db.session.execute(select(PostTag.tag_id).where(PostTag.post_id.in_(post_ids)).distinct()).scalars())
+    listed_by = changed_related_posts(RelatedPost.related_post_id.in_(post_ids)) - set(post_ids)
+    Post.release_post_counts(post_ids)
+    deleted = db.session.execute(delete(Post).where(Post.id.in_(post_ids)), execution_options={"synchronize_session": False})
+    return deleted.rowcount, ["post-list", *[f"post:{post_id}" for post_id in post_ids],
+                              *[f"user:{user_id}" for user_id in authors], *[f"tag:{tag_id}" for tag_id in tags],
+                              *[f"related:{post_id}" for post_id in listed_by]]
+
+def add_tags(post_ids, tag_ids):
+    """Gives every post the tags it doesn't have yet, in the current transaction: per tag, one UPDATE of the tag's post count,
+    two UPDATEs of the shared tag counts and one INSERT of the missing associations. Returns the number of associations
+    added and the cache dependencies to invalidate."""
+    added_count, posts, related = 0, set(), set()
+    for tag_id in tag_ids:
+        added = db.session.execute(select(Post.id).where(Post.id.in_(post_ids), ~exists().where(
+            PostTag.post_id == Post.id, PostTag.tag_id == tag_id))).scalars().all()
+        if not added:
+            continue
+        # The tag's row is locked before the related posts rows, in the same order as post writes (see Post.add).
+        Tag.adjust_post_count([tag_id], len(added))
+        # Pairs of a newly tagged post and a post that already had the tag, or another newly tagged post, share one more tag.
+        tagged = select(PostTag.post_id).where(PostTag.tag_id == tag_id)
+        related |= shift_shared_tags(shared_tag_pairs(added, tagged), 1)
+        db.session.execute(insert(PostTag), [{"post_id": post_id, "tag_id": tag_id} for post_id in added])
+        added_count += len(added)
+        posts.update(added)
+    deps = [*[f"post:{post_id}" for post_id in posts], *[f"related:{post_id}" for post_id in related]]
+    return added_count, deps + ([f"tag:{tag_id}" for tag_id in tag_ids] if added_count else [])
+
+def remove_tags(post_ids, tag_ids):
+    """Takes the tags off every post that has them, in the current transaction: per tag, one UPDATE of the tag's post count, two
+    UPDATEs and two DELETEs of the shared tag counts, like forget_tag in related.py, and one DELETE of the associations.
+    Returns the number of associations removed and the cache dependencies to invalidate."""
+    removed_count, posts, related = 0, set(), set()
+    for tag_id in tag_ids:
+        removed = db.session.execute(select(PostTag.post_id).where(PostTag.tag_id == tag_id, PostTag.post_id.in_(post_ids))
+                                     ).scalars().all()
+        if not removed:
+            continue
+        Tag.adjust_post_count([tag_id], -len(removed))
+        # Pairs of posts that both had the tag share one less tag once either of them loses it.
+        tagged = select(PostTag.post_id).where(PostTag.tag_id == tag_id)
+        related |= shift_shared_tags(shared_tag_pairs(removed, tagged), -1)
+        db.session.execute(delete(PostTag).where(PostTag.tag_id == tag_id, PostTag.post_id.in_(removed)),
+                           execution_options={"synchronize_session": False})
+        removed_count += len(removed)
+        posts.update(removed)
+    deps = [*[f"post:{post_id}" for post_id in posts], *[f"related:{post_id}" for post_id in related]]
+    return removed_count, deps + ([f"tag:{tag_id}" for tag_id in tag_ids] if removed_count else [])
+
+def tag_ids_from_json(data):
+    """Returns the set of tag ids in a request body like {"tag_ids": [1, 2]}. Raises ValueError if there aren't any."""
+    tag_ids = data.get("tag_ids")
+    if (not isinstance(tag_ids, list) or not tag_ids
+            or any(isinstance(tag_id, bool) or not isinstance(tag_id, int) for tag_id in tag_ids)):
+        raise ValueError("tag_ids must be a non-empty list of tag ids")
+    return set(tag_ids)
+
+NO_PROGRESS = {"chunks": 0, "posts": 0, "affected": 0, "last_id": None}
+
+def run_in_chunks(selection, operation, chunk_size, invalidate):
+    """Applies operation (a function of a list of post ids, like delete_posts) to the selected posts one chunk at a time,
+    committing each chunk and then invalidating the cached pages it changed. Yields the running totals after every chunk: the
+    number of chunks, of posts handled and of rows the operation affected, and the last post id handled."""
+    progress = NO_PROGRESS
+    for post_ids in selection.chunks(chunk_size):
+        affected, deps = operation(post_ids)
+        db.session.commit()
+        invalidate(*deps)
+        progress = {"chunks": progress["chunks"] + 1, "posts": progress["posts"] + len(post_ids),
+                    "affected": progress["affected"] + affected, "last_id": post_ids[-1]}
+        yield progress
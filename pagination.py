@@ -0,0 +1,99 @@
+"""This file contains the helpers for keyset (cursor) pagination used by the listing pages. Instead of skipping rows with OFFSET,
+each page remembers the sort key of its first and last row in an opaque cursor, and the next page asks the database for the rows
+that come right after that key. This lets an index jump straight to the page, so page 1,000 costs the same as page 1."""
+import base64
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from flask import abort, request, url_for
+from sqlalchemy import tuple_
+
+DEFAULT_PER_PAGE = 20
+
+@dataclass
+class Page:
+    """One page of results. next_cursor and prev_cursor are None when there is no page in that direction."""
+    items: list
+    next_cursor: str = None
+    prev_cursor: str = None
+
+def encode_cursor(values):
+    """Turns a list of sort key values into an opaque, URL safe cursor string. Datetimes are stored in ISO 8601 format."""
+    raw = json.dumps(values, separators=(",", ":"), default=datetime.isoformat).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor, length):
+    """Turns a cursor string back into its list of sort key values. Aborts with a 400 error if the cursor was tampered with or
+    does not match the number of sort columns."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        abort(400)
+    if not isinstance(values, list) or len(values) != length:
+        abort(400)
+    return values
+
+def cursor_value(value, column):
+    """Checks that a value read from a cursor has the right Python type for the column it is compared with, so a tampered cursor
+    gets a 400 error instead of a database error."""
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type is float and isinstance(value, int):
+        return float(value)
+    if python_type is datetime and isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            abort(400)
+    if not isinstance(value, python_type) or isinstance(value, bool):
+        abort(400)
+    return value
+
+def keyset_paginate(query, columns, after=None, before=None, per_page=DEFAULT_PER_PAGE, descending=False, row_key=None):
+    """Returns a Page of rows from query sorted by columns, which together must uniquely identify a row (end with a primary key).
+    Pass the next_cursor of a page as after to get the following page, or its prev_cursor as before to get the page preceding it.
+    row_key pulls the sort key values out of a result row, by default by reading each column's attribute from the row."""
+    if row_key is None:
+        row_key = lambda row: [getattr(row, column.key) for column in columns]
+    forward = before is None
+    cursor = after if forward else before
+
+    # Walking backwards means flipping the sort order, then putting the rows back in display order at the end.
+    reverse = descending == forward
+    if cursor is not None:
+        values = [cursor_value(value, column) for value, column in zip(decode_cursor(cursor, len(columns)), columns)]
+        if len(columns) == 1:
+            key, bound = columns[0], values[0]
+        else:
+            key, bound = tuple_(*columns), tuple_(*values)
+        query = query.filter(key < bound if reverse else key > bound)
+    query = query.order_by(*[column.desc() if reverse else column.asc() for column in columns])
+
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if not forward:
+        rows.reverse()
+
+    page = Page(items=rows)
+    if rows:
+        first_key, last_key = encode_cursor(row_key(rows[0])), encode_cursor(row_key(rows[-1]))
+        if forward:
+            page.next_cursor = last_key if has_more else None
+            page.prev_cursor = first_key if cursor is not None else None
+        else:
+            page.next_cursor = last_key
+            page.prev_cursor = first_key if has_more else None
+    return page
+
+def page_url(**cursor):
+    """Builds a link to the current page with the given after/before cursor, keeping any other query string arguments. This is
+    available in every template."""
+    args = request.args.to_dict()
+    args.pop("after", None)
+    args.pop("before", None)
+    args.update(cursor)
+    return url_for(request.endpoint, **request.view_args, **args)
@@ -0,0 +1,126 @@
+"""This file contains the related posts index: for every post, the posts that share the most tags with it, stored in the
+related_posts table so the post details page can show them with one indexed lookup instead of a self-join over posts_tags.
+
+Each post keeps its RELATED_POSTS_KEPT best matches, and no more. The write routes refresh the rows of a post whose tags changed
+(refresh_related_posts) in the same transaction, offering it to the posts it matches, which keep it only if it is among their own
+best matches. `flask bloggit rebuild-related` recomputes the whole index at once with sparse matrix products
+(rebuild_related_posts), which needs numpy and scipy."""
+from sqlalchemy import and_, delete, desc, func, insert, or_, select, tuple_, update
+from sqlalchemy.orm import aliased
+from models import db, upsert_rows, Post, PostTag, RelatedPost
+
+def shared_tag_counts(post_id):
+    """Returns a query for the number of tags every other post shares with the post, as (post_id, shared) rows."""
+    other = aliased(PostTag)
+    shared = func.count().label("shared")
+    return (select(other.post_id, shared)
+            .select_from(PostTag)
+            .join(other, and_(other.tag_id == PostTag.tag_id, other.post_id != PostTag.post_id))
+            .where(PostTag.post_id == post_id)
+            .group_by(other.post_id))
+
+def refresh_related_posts(post_id, keep):
+    """Recomputes the related posts of a post after its tags changed, in the current transaction. The post gets its keep best
+    matches, and the posts that already listed it, or are now listed by it, get its new shared tag count (or lose it if they
+    don't share any tags anymore), then are trimmed back to their keep best matches. Returns the ids of every post whose related
+    posts changed."""
+    counts = shared_tag_counts(post_id)
+    best = db.session.execute(counts.order_by(desc("shared"), counts.selected_columns[0].desc()).limit(keep)).all()
+    listed_by = select(RelatedPost.post_id).where(RelatedPost.related_post_id == post_id)
+    previous = set(db.session.execute(listed_by).scalars())
+    still_shared = db.session.execute(counts.where(counts.selected_columns[0].in_(previous))).all() if previous else []
+
+    db.session.execute(delete(RelatedPost).where(or_(RelatedPost.post_id == post_id, RelatedPost.related_post_id == post_id)))
+    rows = [{"post_id": post_id, "related_post_id": other_id, "shared_tags": shared} for other_id, shared in best]
+    reverse = dict(still_shared)
+    reverse.update(best)
+    rows += [{"post_id": other_id, "related_post_id": post_id, "shared_tags": shared} for other_id, shared in reverse.items()]
+    # A post being refreshed at the same time that shares tags with this one writes the same pairs.
+    upsert_rows(RelatedPost, rows, ["shared_tags"])
+    if reverse:
+        trim_related_posts(list(reverse), keep)
+    return previous | set(reverse) | {post_id}
+
+def trim_related_posts(post_ids, keep):
+    """Deletes all but the keep best matches of each of the posts, with one DELETE, in the current transaction."""
+    rank = func.row_number().over(partition_by=RelatedPost.post_id,
+                                  order_by=(RelatedPost.shared_tags.desc(), RelatedPost.related_post_id.desc()))
+    ranked = (select(RelatedPost.post_id, RelatedPost.related_post_id, rank.label("rank"))
+              .where(RelatedPost.post_id.in_(post_ids))
+              .subquery())
+    extra = select(ranked.c.post_id, ranked.c.related_post_id).where(ranked.c.rank > keep)
+    db.session.execute(delete(RelatedPost).where(tuple_(RelatedPost.post_id, RelatedPost.related_post_id).in_(extra)),
+                       execution_options={"synchronize_session": False})
+
+def forget_tag(tag_id):
+    """Takes a tag that is about to be deleted out of the shared tag counts, with one UPDATE and one DELETE, in the current
+    transaction. Pairs of posts that only shared this tag are removed. Call it before deleting the tag, while its associations
+    still exist."""
+    tagged = select(PostTag.post_id).where(PostTag.tag_id == tag_id)
+    pairs = and_(RelatedPost.post_id.in_(tagged), RelatedPost.related_post_id.in_(tagged))
+    db.session.execute(update(RelatedPost).where(pairs).values(shared_tags=RelatedPost.shared_tags - 1),
+                       execution_options={"synchronize_session": False})
+    db.session.execute(delete(RelatedPost).where(RelatedPost.shared_tags <= 0), execution_options={"synchronize_session": False})
+
+def top_related_posts(post_id, limit):
+    """Returns the limit posts that share the most tags with the post, with one lookup on the related_posts index."""
+    return (Post.query
+            .join(RelatedPost, RelatedPost.related_post_id == Post.id)
+            .filter(RelatedPost.post_id == post_id)
+            .order_by(RelatedPost.shared_tags.desc(), RelatedPost.related_post_id.desc())
+            .limit(limit)
+            .all())
+
+def load_post_tags(batch_size=100000):
+    """Reads every (post id, tag id) pair into two numpy arrays, batch_size rows at a time."""
+    import numpy as np
+    result = db.session.execute(select(PostTag.post_id, PostTag.tag_id).execution_options(yield_per=batch_size))
+    batches = [np.array(rows, dtype=np.int64).reshape(-1, 2) for rows in result.partitions()]
+    pairs = np.concatenate(batches) if batches else np.empty((0, 2), dtype=np.int64)
+    return pairs[:, 0], pairs[:, 1]
+
+def best_matches(post_ids, tag_ids, keep, block_size=2000):
+    """Computes the keep best matches of every post from its tags. Posts are the rows and tags the columns of a sparse incidence
+    matrix A, so A @ A.T counts the tags every pair of posts shares. The product is computed block_size posts at a time, keeping
+    only the best matches of each block, so memory stays bounded however many posts there are. Returns three arrays: post ids,
+    related post ids and shared tag counts."""
+    import numpy as np
+    from scipy import sparse
+
+    posts, post_index = np.unique(post_ids, return_inverse=True)
+    tags, tag_index = np.unique(tag_ids, return_inverse=True)
+    incidence = sparse.csr_matrix((np.ones(len(post_index), dtype=np.int32), (post_index, tag_index)),
+                                  shape=(len(posts), len(tags)))
+    transposed = incidence.T.tocsr()
+
+    found = []
+    for start in range(0, len(posts), block_size):
+        shared = (incidence[start:start + block_size] @ transposed).tocoo()
+        rows, columns, counts = shared.row + start, shared.col, shared.data
+        others = rows != columns
+        rows, columns, counts = rows[others], columns[others], counts[others]
+        # Sort each post's matches by shared tags, then newest post first, and keep the first keep of them.
+        order = np.lexsort((-posts[columns], -counts, rows))
+        rows, columns, counts = rows[order], columns[order], counts[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side="left")
+        best = rank < keep
+        found.append((rows[best], columns[best], counts[best]))
+
+    if not found:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    rows, columns, counts = (np.concatenate(parts) for parts in zip(*found))
+    return posts[rows], posts[columns], counts
+
+def rebuild_related_posts(keep, block_size=2000, batch_size=10000):
+    """Recomputes the whole related posts index and replaces the old one in a single transaction, so pages keep showing the old
+    related posts until the new ones are complete. Returns the number of rows written."""
+    post_ids, related_post_ids, shared = best_matches(*load_post_tags(), keep=keep, block_size=block_size)
+    db.session.execute(delete(RelatedPost))
+    for start in range(0, len(post_ids), batch_size):
+        end = start + batch_size
+        db.session.execute(insert(RelatedPost), [
+            {"post_id": int(post_id), "related_post_id": int(related_post_id), "shared_tags": int(count)}
+            for post_id, related_post_id, count in zip(post_ids[start:end], related_post_ids[start:end], shared[start:end])
+        ])
+    db.session.commit()
+    return len(post_ids)
@@ -0,0 +1,95 @@
+"""This file contains the Markdown rendering of posts. A post's content is written in Markdown and rendered once, when it is saved:
+add_post and update_post store the sanitized HTML (shown on the post's page and in the feeds) and a plain text excerpt (shown on
+the listing pages) next to the source, so no page view ever renders Markdown.
+
+Every stored rendering records the RENDER_VERSION it was made with. Bump RENDER_VERSION whenever the output changes (a new
+Markdown extension, different allowed tags, a longer excerpt) and run `flask bloggit rerender-posts`, which renders the outdated
+posts again on every CPU with a process pool."""
+import html
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import markdown
+import nh3
+from sqlalchemy import bindparam, select, update
+from models import db, Post
+
+RENDER_VERSION = 1
+MARKDOWN_EXTENSIONS = ["fenced_code", "tables", "sane_lists"]
+# Everything Markdown produces, minus raw HTML that could run scripts or break the page around the post.
+ALLOWED_TAGS = {"a", "abbr", "blockquote", "br", "code", "del", "em", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "img", "li",
+                "ol", "p", "pre", "strong", "table", "tbody", "td", "th", "thead", "tr", "ul"}
+ALLOWED_ATTRIBUTES = {"a": {"href", "title"}, "abbr": {"title"}, "img": {"alt", "src", "title"}, "td": {"align"},
+                      "th": {"align"}}
+EXCERPT_LENGTH = 200
+
+def render_markdown(source):
+    """Renders Markdown source to sanitized HTML, and returns the HTML and a plain text excerpt of at most EXCERPT_LENGTH
+    characters."""
+    rendered = markdown.markdown(source, extensions=MARKDOWN_EXTENSIONS, output_format="html")
+    content_html = nh3.clean(rendered, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES, link_rel="nofollow noopener")
+    return content_html, excerpt(content_html)
+
+def excerpt(content_html, length=EXCERPT_LENGTH):
+    """Returns the text of rendered HTML on a single line, cut at a word boundary to at most length characters."""
+    text = " ".join(html.unescape(nh3.clean(content_html, tags=set())).split())
+    if len(text) <= length:
+        return text
+    cut = text[:length - 1]
+    return re.sub(r"\s+\S*$", "", cut) + "…"
+
+def render_post(post):
+    """Renders a post's content and stores the HTML and the excerpt on it, to be saved with the post."""
+    post.content_html, post.excerpt = render_markdown(post.content)
+    post.render_version = RENDER_VERSION
+
+def render_batch(rows):
+    """Renders (id, content) rows. This runs in the worker processes of rerender_posts, so it only gets and returns plain data."""
+    rendered = []
+    for post_id, content in rows:
+        content_html, post_excerpt = render_markdown(content)
+        rendered.append({"post_id": post_id, "source": content, "rendered_html": content_html, "rendered_excerpt": post_excerpt})
+    return rendered
+
+def rerender_posts(workers=None, batch_size=500, everything=False, report=None):
+    """Renders every post whose stored rendering is older than RENDER_VERSION (every post with everything=True) again, batch_size
+    posts at a time, spread over a pool of workers processes (one per CPU by default). Only a few batches are in flight at once, so
+    memory stays flat however many posts there are. A post edited while its batch was being rendered is left alone, since
+    update_post has already rendered the new content. report is called with the number of posts written after each batch.
+    Returns the number of posts rendered."""
+    workers = workers or os.cpu_count() or 1
+    posts = Post.__table__
+    write = (update(posts)
+             .where(posts.c.id == bindparam("post_id"), posts.c.content == bindparam("source"))
+             .values(content_html=bindparam("rendered_html"), excerpt=bindparam("rendered_excerpt"), render_version=RENDER_VERSION))
+
+    def read_batch(after_id):
+        query = select(Post.id, Post.content).where(Post.id > after_id).order_by(Post.id).limit(batch_size)
+        if not everything:
+            query = query.where(Post.render_version != RENDER_VERSION)
+        return db.session.execute(query).all()
+
+    written = 0
+    last_id = 0
+    in_flight = set()
+    with ProcessPoolExecutor(workers) as pool:
+        while True:
+            while last_id is not None and len(in_flight) < 2 * workers:
+                rows = read_batch(last_id)
+                db.session.commit()
+                if not rows:
+                    last_id = None
+                    break
+                last_id = rows[-1].id
+                in_flight.add(pool.submit(render_batch, [tuple(row) for row in rows]))
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                rendered = future.result()
+                db.session.execute(write, rendered)
+                db.session.commit()
+                written += len(rendered)
+                if report is not None:
+                    report(written)
+    return written
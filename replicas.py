@@ -0,0 +1,142 @@
+"""This file contains the read replica routing. With DATABASE_REPLICA_URLS set, the app keeps one engine per replica next to the
+primary's, with the same pool settings, and every GET or HEAD request reads from one of them, picked round-robin among the ones
+that passed their last health check. Everything else (POST requests, writes and anything run outside of a request, like the CLI)
+goes to the primary.
+
+Replicas lag a little behind the primary, and REPLICA_STICKY_SECONDS is how far behind they are assumed to be at most. The visitor
+who made a write reads from the primary for that long, through a marker in their session, so the page they are redirected to
+shows their own edit. Other visitors may still see the old rows from a replica meanwhile, on any worker. The page cache (see
+cache.py) doesn't store a page read from a replica if one of its rows was invalidated within that window, so a stale page isn't
+put back into the cache that every worker shares, and the tag catalog (see catalog.py) is always loaded from the primary."""
+import threading
+from itertools import count
+from time import monotonic, time
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from config import engine_options
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import SQLAlchemyError
+
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+PRIMARY_UNTIL = "_primary_until"
+
+# How far behind the primary a Postgres replica is, in seconds. A replica that has replayed everything it received is not behind,
+# however long ago the primary's last write was.
+POSTGRES_REPLICA_LAG = text("SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                            "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")
+
+class RoutingSession(Session):
+    """The session of the db object. Reads go to the replica the ReplicaRouter picked for the current request, if it picked one.
+    Flushes and every other statement go to the primary, and once one has, the rest of the request stays there too so it reads
+    its own writes."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            # A session given a connection of its own, like the test fixtures' sessions, sends everything to it.
+            bind = self.bind
+        if bind is None and has_request_context():
+            replica = g.get("replica_engine")
+            if replica is not None:
+                if not self._flushing and getattr(clause, "is_select", False):
+                    return replica
+                g.replica_engine = None
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+class ReplicaState:
+    """What the last health check of a replica found."""
+    __slots__ = ("healthy", "checked_at")
+
+    def __init__(self):
+        self.healthy = False
+        self.checked_at = None
+
+class ReplicaRouter:
+    """Flask extension that picks the engine each request reads from. A replica is checked again once its last check is
+    REPLICA_HEALTH_CHECK_INTERVAL seconds old, and is skipped while it can't be reached or is more than REPLICA_MAX_LAG_SECONDS
+    behind the primary. When no replica is healthy, reads go to the primary."""
+
+    def __init__(self, app=None):
+        self.engines = {}
+        self.states = {}
+        self.turn = count()
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        # Engines don't connect until they are first used, so no connection is shared with forked workers.
+        self.engines = {f"replica_{number}": create_engine(url, echo=app.config.get("SQLALCHEMY_ECHO", False),
+                                                           **engine_options(app.config, url))
+                        for number, url in enumerate(app.config.get("DATABASE_REPLICA_URLS") or [])}
+        self.keys = list(self.engines)
+        self.states = {key: ReplicaState() for key in self.keys}
+        for key, engine in self.engines.items():
+            event.listen(engine, "handle_error", lambda context, key=key: self.handle_error(key, context))
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.extensions["replica_router"] = self
+
+    def before_request(self):
+        g.replica_engine = None
+        if self.keys and request.method in SAFE_METHODS and not self.sticky():
+            g.replica_engine = self.choose()
+
+    def after_request(self, response):
+        if self.keys and request.method not in SAFE_METHODS:
+            session[PRIMARY_UNTIL] = time() + self.app.config["REPLICA_STICKY_SECONDS"]
+        return response
+
+    def teardown_request(self, exception=None):
+        g.pop("replica_engine", None)
+
+    def sticky(self):
+        """Whether this request has to read from the primary because its visitor made a write recently."""
+        primary_until = session.get(PRIMARY_UNTIL)
+        if primary_until is None:
+            return False
+        if primary_until > time():
+            return True
+        session.pop(PRIMARY_UNTIL)
+        return False
+
+    def choose(self):
+        """Returns the next healthy replica's engine in round-robin order, or None when there is none."""
+        for _ in range(len(self.keys)):
+            key = self.keys[next(self.turn) % len(self.keys)]
+            if self.is_healthy(key):
+                return self.engines[key]
+        return None
+
+    def is_healthy(self, key):
+        state = self.states[key]
+        interval = self.app.config["REPLICA_HEALTH_CHECK_INTERVAL"]
+        if state.checked_at is None or monotonic() - state.checked_at >= interval:
+            # Claim the check under the lock so that only one thread runs it; the others use the previous result meanwhile.
+            with self.lock:
+                due = state.checked_at is None or monotonic() - state.checked_at >= interval
+                if due:
+                    state.checked_at = monotonic()
+            if due:
+                state.healthy = self.check(self.engines[key])
+        return state.healthy
+
+    def check(self, engine):
+        """Whether a replica answers, and on Postgres whether it is close enough behind the primary."""
+        try:
+            with engine.connect() as connection:
+                if engine.dialect.name == "postgresql":
+                    lag = connection.execute(POSTGRES_REPLICA_LAG).scalar()
+                    return lag is None or lag <= self.app.config["REPLICA_MAX_LAG_SECONDS"]
+                connection.execute(text("SELECT 1"))
+                return True
+        except SQLAlchemyError:
+            return False
+
+    def handle_error(self, key, context):
+        """Takes a replica out of the rotation as soon as a request loses its connection to it, until its next health check."""
+        if context.is_disconnect:
+            state = self.states[key]
+            state.healthy = False
+            state.checked_at = monotonic()
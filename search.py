@@ -0,0 +1,113 @@
+"""This file contains the full-text search over posts used by the /search page and the /api/search endpoint. On Postgres it matches
+the posts' search_vector column (see models.py) with websearch_to_tsquery, which the GIN index answers without scanning the posts
+table, ranks the matches with ts_rank_cd and highlights them with ts_headline. Other databases, like the SQLite databases some
+tests use, fall back to LIKE matching on the title and content with a simple rank and highlighting done in Python."""
+import re
+from markupsafe import Markup, escape
+from sqlalchemy import Float, and_, case, false, func, literal_column, or_, select, type_coerce
+from sqlalchemy.orm import joinedload
+from models import db, Post, PostTag
+from pagination import DEFAULT_PER_PAGE, keyset_paginate
+
+# ts_headline wraps matches in these characters, which then become <mark> tags once the rest of the text has been escaped.
+HIGHLIGHT_START = "\ue000"
+HIGHLIGHT_STOP = "\ue001"
+TITLE_HEADLINE_OPTIONS = f'HighlightAll=true, StartSel="{HIGHLIGHT_START}", StopSel="{HIGHLIGHT_STOP}"'
+CONTENT_HEADLINE_OPTIONS = f'MaxFragments=2, MaxWords=30, MinWords=12, StartSel="{HIGHLIGHT_START}", StopSel="{HIGHLIGHT_STOP}"'
+# Markup in the content is left out of the excerpts, on every database, since ts_headline drops HTML tags by itself.
+TAG_PATTERN = "<[^>]*>"
+MAX_FALLBACK_TERMS = 10
+SNIPPET_LENGTH = 200
+
+class SearchResult:
+    """A post that matched a search, with its rank and its title and content excerpt with the matches highlighted."""
+
+    def __init__(self, post, rank, title_html, headline_html):
+        self.post = post
+        self.rank = rank
+        self.title_html = title_html
+        self.headline_html = headline_html
+
+    def to_dict(self):
+        return {
+            "id": self.post.id,
+            "title": self.post.title,
+            "title_html": str(self.title_html),
+            "headline_html": str(self.headline_html),
+            "rank": self.rank,
+            "author": {"id": self.post.author.id, "name": self.post.author.get_full_name()},
+            "created_at": self.post.created_at.isoformat() if self.post.created_at else None,
+        }
+
+def highlight(text):
+    """Escapes text and turns the highlight marker characters in it into <mark> tags."""
+    html = str(escape(text or ""))
+    return Markup(html.replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_STOP, "</mark>"))
+
+def search_posts(query_text, tag_id=None, author_id=None, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+    """Returns a Page of SearchResults for the posts matching query_text, best match first. The results can be narrowed down to
+    the posts with a tag and/or by an author, and are paginated with keyset cursors on (rank, post id)."""
+    if db.engine.dialect.name == "postgresql":
+        query, rank, to_result = postgres_search(query_text)
+    else:
+        query, rank, to_result = fallback_search(query_text)
+    if tag_id is not None:
+        query = query.filter(Post.id.in_(select(PostTag.post_id).where(PostTag.tag_id == tag_id)))
+    if author_id is not None:
+        query = query.filter(Post.user_id == author_id)
+    query = query.options(joinedload(Post.author))
+
+    page = keyset_paginate(query, [rank, Post.id], after=after, before=before, per_page=per_page, descending=True,
+                           row_key=lambda row: [row.rank, row.Post.id])
+    page.items = [to_result(row) for row in page.items]
+    return page
+
+def postgres_search(query_text):
+    """Builds the full-text search query for Postgres, served by the GIN index on posts.search_vector."""
+    tsquery = func.websearch_to_tsquery("english", query_text)
+    search_vector = literal_column("posts.search_vector")
+    rank = func.ts_rank_cd(search_vector, tsquery, type_=Float)
+    query = db.session.query(
+        Post,
+        rank.label("rank"),
+        func.ts_headline("english", Post.title, tsquery, TITLE_HEADLINE_OPTIONS).label("title_headline"),
+        func.ts_headline("english", func.regexp_replace(Post.content, TAG_PATTERN, " ", "g"), tsquery,
+                         CONTENT_HEADLINE_OPTIONS).label("content_headline"),
+    ).filter(search_vector.op("@@")(tsquery))
+    to_result = lambda row: SearchResult(row.Post, row.rank, highlight(row.title_headline), highlight(row.content_headline))
+    return query, rank, to_result
+
+def fallback_search(query_text):
+    """Builds a portable search query that requires every word of the query to appear in the title or the content. Title matches
+    rank higher than content matches."""
+    terms = re.findall(r"\w+", query_text)[:MAX_FALLBACK_TERMS]
+    conditions = []
+    rank = type_coerce(0.0, Float)
+    for term in terms:
+        pattern = "%" + term.replace("\\", "\\\\").replace("_", "\\_") + "%"
+        in_title = Post.title.ilike(pattern, escape="\\")
+        in_content = Post.content.ilike(pattern, escape="\\")
+        conditions.append(or_(in_title, in_content))
+        rank = rank + case((in_title, 2.0), else_=0.0) + case((in_content, 1.0), else_=0.0)
+    rank = type_coerce(rank, Float)
+    query = db.session.query(Post, rank.label("rank")).filter(and_(*conditions) if conditions else false())
+
+    matcher = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE) if terms else None
+    to_result = lambda row: SearchResult(row.Post, row.rank, highlight(mark_matches(row.Post.title, matcher)),
+                                         highlight(mark_matches(snippet(strip_tags(row.Post.content), matcher), matcher)))
+    return query, rank, to_result
+
+def strip_tags(text):
+    """Replaces the HTML tags in text with spaces, like the Postgres search does before ts_headline."""
+    return re.sub(TAG_PATTERN, " ", text)
+
+def snippet(text, matcher):
+    """Returns about SNIPPET_LENGTH characters of text around the first match."""
+    match = matcher.search(text)
+    start = max(0, match.start() - SNIPPET_LENGTH // 4) if match else 0
+    excerpt = text[start:start + SNIPPET_LENGTH]
+    return ("..." if start > 0 else "") + excerpt + ("..." if start + SNIPPET_LENGTH < len(text) else "")
+
+def mark_matches(text, matcher):
+    """Surrounds every match in text with the highlight marker characters."""
+    return matcher.sub(lambda match: HIGHLIGHT_START + match.group(0) + HIGHLIGHT_STOP, text)
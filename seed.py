@@ -1,4 +1,5 @@
 # Seed file to make sample data for tables for Users and Posts so I can start off with some sample data on the first test.
+# For anything bigger than this handful of rows, generate a dataset with `flask --app app bloggit load` instead (see loader.py).
 
 from models import User, Post, Tag, PostTag, db, connect_db
 from app import create_app
@@ -22,36 +23,26 @@ franklin = User(first_name='Franklin', last_name='Kong', image_url='https://img.
 jeffrey = User(first_name='Jeffrey', last_name='Kong', image_url='https://t4.ftcdn.net/jpg/01/25/86/35/360_F_125863509_jaISqQt7MOfhOT3UxRTHZoEbMmmFYIr8.jpg')
 kenny = User(first_name='Kenny', last_name='Xu')
 
-# Create starting posts
-franklin_post1 = Post(title="My First Post", content="Hi Everyone! Welcome to my Blog! Nice to meet you!", user_id=1)
-franklin_post2 = Post(title="My Springboard Progress", content="I am currently working on the Blogly project in Springboard!", user_id=1)
-jeffrey_post1 = Post(title="Good Morning!", content="""I really enjoyed the weather this morning! There was a nice blue sky and I 
-                     got to enjoy the morning doves chirping as well!""", user_id=2)
-jeffrey_post2 = Post(title="Thoughts on Springboard", content="I think the bootcamp my brother is doing is really wonderful!", user_id=2)
-kenny_post1 = Post(title="Welcome to my Startup Blog!", content="""Hi friends! Welcome to my blog where I'll post continual
-                   developments over my recent startup! It's going to be lots of fun!""", user_id=3)
-
 # Create starting tags
 tag1 = Tag(name='Weather')
 tag2 = Tag(name='Startup')
 tag3 = Tag(name='First Post')
 tag4 = Tag(name='Springboard')
 
-# Create starting post tags:
-post_tag1 = PostTag(post_id=1, tag_id=3)
-post_tag2 = PostTag(post_id=2, tag_id=4)
-post_tag3 = PostTag(post_id=3, tag_id=3)
-post_tag4 = PostTag(post_id=3, tag_id=1)
-post_tag5 = PostTag(post_id=4, tag_id=4)
-post_tag6 = PostTag(post_id=5, tag_id=3)
-post_tag7 = PostTag(post_id=5, tag_id=2)
-
-# Add and commit starting users and posts to the database.
+# Add and commit starting users and tags to the database.
 db.session.add_all([franklin, jeffrey, kenny])
 db.session.commit()
 db.session.add_all([tag1, tag2, tag3, tag4])
 db.session.commit()
-db.session.add_all([franklin_post1, franklin_post2, jeffrey_post1, jeffrey_post2, kenny_post1])
-db.session.commit()
-db.session.add_all([post_tag1, post_tag2, post_tag3, post_tag4, post_tag5, post_tag6, post_tag7])
+
+# Create starting posts with their tags the way the add post form does, so they are rendered and counted, and get their related
+# posts and trending tag activity.
+kept = app.config['RELATED_POSTS_KEPT']
+Post.add("My First Post", "Hi Everyone! Welcome to my Blog! Nice to meet you!", franklin.id, [tag3.id], kept)
+Post.add("My Springboard Progress", "I am currently working on the Blogly project in Springboard!", franklin.id, [tag4.id], kept)
+Post.add("Good Morning!", """I really enjoyed the weather this morning! There was a nice blue sky and I 
+                     got to enjoy the morning doves chirping as well!""", jeffrey.id, [tag3.id, tag1.id], kept)
+Post.add("Thoughts on Springboard", "I think the bootcamp my brother is doing is really wonderful!", jeffrey.id, [tag4.id], kept)
+Post.add("Welcome to my Startup Blog!", """Hi friends! Welcome to my blog where I'll post continual
+                   developments over my recent startup! It's going to be lots of fun!""", kenny.id, [tag3.id, tag2.id], kept)
 db.session.commit()
@@ -0,0 +1,67 @@
+"""This file contains the shared test fixtures: which database a test module connects to, and a TestCase that runs every test inside
+a transaction that is rolled back when it ends, so tests never have to empty the tables and start from a clean database in
+milliseconds.
+
+Test modules built on RollbackTestCase can run against any database. TEST_DATABASE_URL picks it, with {name} standing for the
+database name, for example "sqlite:////tmp/{name}.db", or "sqlite://" for a fresh in-memory database per test module (where
+the benchmark's run from several threads is skipped, since they would all share one connection). It defaults to the local
+Postgres server. Under pytest-xdist (`pytest -n 4`) each worker gets its own databases, named after the worker."""
+import os
+from unittest import TestCase
+from sqlalchemy import create_engine, make_url, text
+from models import db
+
+# The statements RollbackTestCase turns commits into. They aren't the tested code's own, so tests that count queries skip them.
+SAVEPOINT_STATEMENTS = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+def database_uri(name):
+    """Returns the URI of the test database called name, creating the database first if it is a Postgres one that doesn't exist
+    yet."""
+    worker = os.environ.get("PYTEST_XDIST_WORKER")
+    if worker:
+        name = f"{name}_{worker}"
+    uri = os.environ.get("TEST_DATABASE_URL", "postgresql:///{name}").format(name=name)
+    url = make_url(uri)
+    if url.get_backend_name() == "postgresql":
+        engine = create_engine(url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+        with engine.connect() as connection:
+            exists = connection.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": url.database}).first()
+            if not exists:
+                connection.exec_driver_sql(f'CREATE DATABASE "{url.database}"')
+        engine.dispose()
+    return uri
+
+class RollbackTestCase(TestCase):
+    """Runs each test inside a transaction on a single connection, which is rolled back once the test is over. The session, of the
+    test and of every request it makes, is bound to that connection and turns each commit into the release of a savepoint, so the
+    code under test commits as usual without anything reaching the database. Subclasses set app, and call super().setUp() first
+    if they have a setUp of their own."""
+    app = None
+
+    def setUp(self):
+        self.enterContext(self.app.app_context())
+        connection = db.engine.connect()
+        self.addCleanup(connection.close)
+        if connection.dialect.name == "sqlite":
+            # pysqlite only starts a transaction before the first write, and releasing a savepoint outside of one commits it. Turn
+            # its own transaction handling off and start the transaction ourselves.
+            driver_connection = connection.connection.driver_connection
+            isolation_level = driver_connection.isolation_level
+            driver_connection.isolation_level = None
+            self.addCleanup(setattr, driver_connection, "isolation_level", isolation_level)
+            transaction = connection.begin()
+            connection.exec_driver_sql("BEGIN")
+        else:
+            transaction = connection.begin()
+        self.addCleanup(transaction.rollback)
+
+        session_factory = db.session.session_factory
+        self.addCleanup(setattr, session_factory, "kw", dict(session_factory.kw))
+        self.addCleanup(db.session.remove)
+        db.session.remove()
+        session_factory.configure(bind=connection, join_transaction_mode="create_savepoint")
+
+        # The tag catalog outlives the test, so it mustn't keep tags that are about to be rolled back.
+        catalog = self.app.extensions["tag_catalog"]
+        catalog.invalidate()
+        self.addCleanup(catalog.invalidate)
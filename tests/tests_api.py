@@ -0,0 +1,88 @@
+"""This file contains tests for the JSON API: the paginated lists of posts, users and tags, the single rows, and the NDJSON export."""
+import json
+from sqlalchemy import event, insert, select
+from app import create_app
+from models import db, connect_db, User, Post, Tag, PostTag
+from fixtures import RollbackTestCase, database_uri
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_api"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+class APITestCase(RollbackTestCase):
+    """Contains tests for reading posts, users and tags as JSON."""
+    app = app
+
+    def setUp(self):
+        """Add an author with 25 posts, every other one tagged Horses."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        horses = Tag(name="Horses")
+        db.session.add_all([lucky, horses])
+        db.session.flush()
+        db.session.execute(insert(Post), [{'title': f'Post {i}', 'content': 'Riding free', 'user_id': lucky.id} for i in range(25)])
+        post_ids = db.session.execute(select(Post.id).order_by(Post.id)).scalars().all()
+        db.session.execute(insert(PostTag), [{'post_id': post_id, 'tag_id': horses.id} for post_id in post_ids[::2]])
+        db.session.commit()
+
+        self.lucky_id = lucky.id
+        self.horses_id = horses.id
+        self.post_ids = post_ids
+
+    def test_list_posts(self):
+        """Ensures posts are listed newest first, one page at a time, with their tags."""
+        with app.test_client() as client:
+            first_page = client.get("/api/posts").get_json()
+            second_page = client.get(f"/api/posts?after={first_page['next_cursor']}").get_json()
+
+        self.assertEqual(len(first_page['results']), 20)
+        self.assertEqual(first_page['results'][0]['id'], self.post_ids[-1])
+        self.assertEqual(first_page['results'][0]['tag_ids'], [self.horses_id])
+        self.assertEqual(len(second_page['results']), 5)
+        self.assertIsNone(second_page['next_cursor'])
+
+    def test_filter_posts(self):
+        """Ensures posts can be narrowed down to the ones with a tag."""
+        with app.test_client() as client:
+            results = client.get(f"/api/posts?tag={self.horses_id}").get_json()['results']
+
+        self.assertEqual(len(results), 13)
+
+    def test_show_rows(self):
+        """Ensures single posts, users and tags can be read, and that missing ones are a JSON 404."""
+        with app.test_client() as client:
+            post = client.get(f"/api/posts/{self.post_ids[0]}").get_json()
+            user = client.get(f"/api/users/{self.lucky_id}").get_json()
+            tag = client.get(f"/api/tags/{self.horses_id}").get_json()
+            missing = client.get(f"/api/users/{self.lucky_id + 100}")
+
+        self.assertEqual(post['title'], 'Post 0')
+        self.assertEqual(user['first_name'], 'Lucky')
+        self.assertEqual(tag['name'], 'Horses')
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(missing.get_json(), {'error': 'Not found'})
+
+    def test_ndjson_export(self):
+        """Ensures the export streams every post as a line of JSON, fetched in batches rather than one query per post."""
+        app.config['API_EXPORT_BATCH_SIZE'] = 10
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            with app.test_client() as client:
+                resp = client.get("/api/posts?format=ndjson")
+                streamed = resp.is_streamed
+                lines = resp.get_data(as_text=True).splitlines()
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+            app.config['API_EXPORT_BATCH_SIZE'] = 1000
+
+        self.assertTrue(streamed)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['id'] for line in lines], self.post_ids)
+        self.assertLessEqual(len(statements), 4)
@@ -1,21 +1,45 @@
-"""This file contains unit tests and integration tests for the main SQLAlchemy Flask app in a testing databse called bloggit_test."""
-from unittest import TestCase
+"""This file contains unit tests and integration tests for the main SQLAlchemy Flask app in a testing database called bloggit_test_app."""
+import re
+from contextlib import contextmanager
+from sqlalchemy import event, insert, select
 from app import create_app
-from models import db, connect_db, User
+from models import db, connect_db, reconcile_post_counts, User, Post, Tag, PostTag
+from pagination import DEFAULT_PER_PAGE
+from fixtures import RollbackTestCase, SAVEPOINT_STATEMENTS, database_uri
 
-# Create another application instance that connects to the testing database (bloggit_test) instead fo the main database (bloggit).
-app = create_app("bloggit_test", testing=True)
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_app"), testing=True)
 connect_db(app)
-app.app_context().push()
+with app.app_context():
+    db.drop_all()
+    db.create_all()
 
-db.drop_all()
-db.create_all()
+class AppTestCase(RollbackTestCase):
+    app = app
 
-class UserViewsTestCase(TestCase):
+@contextmanager
+def count_queries():
+    """Collects every SQL statement sent to the database while the block runs, so tests can check how many queries a route makes.
+    The savepoints the test fixtures turn commits into are left out."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith(SAVEPOINT_STATEMENTS):
+            statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+class UserViewsTestCase(AppTestCase):
     """Contains tests concerning the User model integrated with the main SQLAlchemy Flask app."""
     def setUp(self):
-        """Delete current entries, and add 3 predefined Users as entries in the users table for testing."""
-        User.query.delete()
+        """Add 3 predefined Users as entries in the users table for testing."""
+        super().setUp()
 
         lucky = User(first_name="Lucky", last_name="Prescott")
         pru = User(first_name="Pru", last_name="Granger")
@@ -30,10 +54,6 @@ class UserViewsTestCase(TestCase):
         self.pru_id = pru.id
         self.abigail_id = abigail.id
 
-    def tearDown(self):
-        """Cleans up tests and empties the staging area for the database."""
-        db.session.rollback()
-
 
     def test_list_users(self):
         """Ensures sending a GET request to the form page redirects the user to the main /users page where each user in the database is listed."""
@@ -104,3 +124,332 @@ class UserViewsTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('Lucky Prescott', html)
+
+
+class QueryBudgetTestCase(AppTestCase):
+    """Ensures that the listing pages run a fixed number of queries no matter how many posts, authors and tags they show."""
+    def setUp(self):
+        """One author, one tag and one tagged post."""
+        super().setUp()
+
+        author = User(first_name="Lucky", last_name="Prescott")
+        tag = Tag(name="Horses")
+        db.session.add_all([author, tag])
+        db.session.commit()
+
+        self.author_id = author.id
+        self.tag_id = tag.id
+        self.post_id = self.add_tagged_posts(1)[0]
+
+
+    def add_tagged_posts(self, count):
+        """Adds count posts, each written by a new author and tagged with the test tag plus a new tag of its own."""
+        post_ids = []
+        for i in range(count):
+            author = User(first_name=f"Author{i}", last_name="Budget")
+            post = Post(title=f"Post {i}", content="Some content", author=author)
+            db.session.add_all([author, post])
+            db.session.flush()
+            tag = Tag(name=f"Tag for post {post.id}")
+            db.session.add(tag)
+            db.session.flush()
+            db.session.add_all([PostTag(post_id=post.id, tag_id=self.tag_id), PostTag(post_id=post.id, tag_id=tag.id)])
+            post_ids.append(post.id)
+        db.session.commit()
+        return post_ids
+
+    def route_query_counts(self):
+        """Returns the number of queries each listing route makes."""
+        urls = ["/", "/users", f"/users/{self.author_id}", f"/users/{self.author_id}/posts/new", f"/posts/{self.post_id}",
+                f"/posts/{self.post_id}/edit", "/tags", f"/tags/{self.tag_id}"]
+        counts = {}
+        app.extensions['tag_catalog'].invalidate()
+        with app.test_client() as client:
+            for url in urls:
+                db.session.expunge_all()
+                with count_queries() as statements:
+                    resp = client.get(url)
+                self.assertEqual(resp.status_code, 200, url)
+                counts[url] = len(statements)
+        return counts
+
+    def test_query_budget_does_not_grow_with_rows(self):
+        """Ensures every listing route makes the same number of queries with 1 post as with 8 posts by different authors."""
+        few_rows = self.route_query_counts()
+        self.add_tagged_posts(7)
+        many_rows = self.route_query_counts()
+
+        self.assertEqual(few_rows, many_rows)
+        for url, count in many_rows.items():
+            self.assertLessEqual(count, 3, url)
+
+
+class PaginationTestCase(AppTestCase):
+    """Ensures the users list can be walked forwards and backwards a page at a time with the Next and Previous cursor links."""
+    def setUp(self):
+        """5 users, shown 2 per page."""
+        super().setUp()
+        for first_name, last_name in [("Lucky", "Prescott"), ("Pru", "Granger"), ("Abigail", "Stone"), ("Bo", "Stone"),
+                                      ("Maricela", "Jones")]:
+            db.session.add(User(first_name=first_name, last_name=last_name))
+        db.session.commit()
+        app.config['PAGE_SIZE'] = 2
+
+    def tearDown(self):
+        """Restores the page size."""
+        app.config['PAGE_SIZE'] = DEFAULT_PER_PAGE
+
+    def test_walk_users_pages(self):
+        """Ensures following Next links visits every user once in name order, and Previous goes back to the page before."""
+        with app.test_client() as client:
+            html = client.get("/users").get_data(as_text=True)
+            self.assertIn('Pru Granger', html)
+            self.assertIn('Maricela Jones', html)
+            self.assertNotIn('Previous', html)
+
+            second_page = client.get(re.search(r'href="([^"]*after=[^"]*)"', html).group(1).replace('&amp;', '&'))
+            html = second_page.get_data(as_text=True)
+            self.assertIn('Lucky Prescott', html)
+            self.assertIn('Abigail Stone', html)
+
+            last_page = client.get(re.search(r'href="([^"]*after=[^"]*)"', html).group(1).replace('&amp;', '&'))
+            html = last_page.get_data(as_text=True)
+            self.assertIn('Bo Stone', html)
+            self.assertNotIn('Next', html)
+
+            previous_page = client.get(re.search(r'href="([^"]*before=[^"]*)"', html).group(1).replace('&amp;', '&'))
+            html = previous_page.get_data(as_text=True)
+            self.assertIn('Lucky Prescott', html)
+            self.assertIn('Abigail Stone', html)
+            self.assertNotIn('Bo Stone', html)
+
+    def test_invalid_cursor(self):
+        """Ensures a cursor that was tampered with is rejected instead of raising an error."""
+        with app.test_client() as client:
+            resp = client.get("/users?after=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.get(f"/users/{User.query.first().id}?after=WyJ4Il0")
+            self.assertEqual(resp.status_code, 400)
+
+
+class TagViewsTestCase(AppTestCase):
+    """Contains tests for adding and renaming tags, which must keep tag names unique."""
+    def setUp(self):
+        """The tags Horses and Ranch."""
+        super().setUp()
+        horses = Tag(name="Horses")
+        ranch = Tag(name="Ranch")
+        db.session.add_all([horses, ranch])
+        db.session.commit()
+        self.ranch_id = ranch.id
+
+    def tearDown(self):
+        """Restores case-sensitive tag names."""
+        app.config['TAG_NAMES_CASE_INSENSITIVE'] = False
+
+    def test_add_tag(self):
+        """Ensures a newly added tag shows up on the tags list page right away, even though the list of tags is cached."""
+        with app.test_client() as client:
+            client.get("/tags")
+            resp = client.post("/tags/new", data={'tag_name': 'Rodeo'}, follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Rodeo', html)
+
+    def test_add_duplicate_tag(self):
+        """Ensures adding a tag with a name that is already taken redirects back to the Add Tag form."""
+        with app.test_client() as client:
+            resp = client.post("/tags/new", data={'tag_name': 'Horses'})
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/tags/new")
+            self.assertEqual(Tag.query.filter_by(name='Horses').count(), 1)
+
+    def test_case_insensitive_tag_names(self):
+        """Ensures names that only differ in case are allowed by default, and rejected when tag names are case-insensitive."""
+        with app.test_client() as client:
+            resp = client.post(f"/tags/{self.ranch_id}/edit", data={'tag_name': 'horses'})
+            self.assertEqual(resp.location, "/tags")
+
+            app.config['TAG_NAMES_CASE_INSENSITIVE'] = True
+            resp = client.post("/tags/new", data={'tag_name': 'HORSES'})
+            self.assertEqual(resp.location, "/tags/new")
+
+
+class PostViewsTestCase(AppTestCase):
+    """Contains tests for adding and editing posts together with their tags."""
+    def setUp(self):
+        """An author and the tags Horses, Ranch and Rodeo."""
+        super().setUp()
+        author = User(first_name="Lucky", last_name="Prescott")
+        tags = [Tag(name="Horses"), Tag(name="Ranch"), Tag(name="Rodeo")]
+        db.session.add(author)
+        db.session.add_all(tags)
+        db.session.commit()
+        self.author_id = author.id
+        self.horses_id, self.ranch_id, self.rodeo_id = [tag.id for tag in tags]
+
+    def post_tag_ids(self, post_id):
+        return {post_tag.tag_id for post_tag in PostTag.query.filter_by(post_id=post_id)}
+
+    def test_add_post_with_tags(self):
+        """Ensures a new post and all its tags are written with one bulk insert and a single commit."""
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.post(f"/users/{self.author_id}/posts/new", data={
+                    'title': 'Spirit', 'content': 'Riding free', 'selected_tag_ids': [self.horses_id, self.ranch_id]})
+            post = Post.query.filter_by(title='Spirit').one()
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(self.post_tag_ids(post.id), {self.horses_id, self.ranch_id})
+            self.assertEqual(len([s for s in statements if s.startswith('INSERT INTO posts_tags')]), 1)
+
+    def test_edit_post_tags(self):
+        """Ensures editing a post's tags only inserts the added tags and deletes the removed ones, each as one statement."""
+        post = Post(title='Spirit', content='Riding free', user_id=self.author_id)
+        db.session.add(post)
+        db.session.flush()
+        db.session.add_all([PostTag(post_id=post.id, tag_id=self.horses_id), PostTag(post_id=post.id, tag_id=self.ranch_id)])
+        db.session.commit()
+        post_id = post.id
+
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.post(f"/posts/{post_id}/edit", data={
+                    'title': 'Spirit', 'content': 'Riding free', 'selected_tag_ids': [self.ranch_id, self.rodeo_id]})
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(self.post_tag_ids(post_id), {self.ranch_id, self.rodeo_id})
+            self.assertEqual(len([s for s in statements if s.startswith('INSERT INTO posts_tags')]), 1)
+            self.assertEqual(len([s for s in statements if s.startswith('DELETE FROM posts_tags')]), 1)
+            self.assertEqual(len([s for s in statements if s.startswith('SELECT tags')]), 1)
+
+    def test_add_post_with_missing_tag(self):
+        """Ensures a post isn't added if one of its tags doesn't exist."""
+        with app.test_client() as client:
+            resp = client.post(f"/users/{self.author_id}/posts/new", data={
+                'title': 'Spirit', 'content': 'Riding free', 'selected_tag_ids': [self.horses_id, self.rodeo_id + 100]})
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("We couldn't find the page you were looking for.", html)
+            self.assertEqual(Post.query.count(), 0)
+
+
+class DeleteCascadeTestCase(AppTestCase):
+    """Ensures deleting a user or a tag removes the rows that depend on it in the database, with a fixed number of statements."""
+    def setUp(self):
+        """An author with thousands of posts, each tagged with the same tag."""
+        super().setUp()
+        author = User(first_name="Lucky", last_name="Prescott")
+        tag = Tag(name="Horses")
+        db.session.add_all([author, tag])
+        db.session.commit()
+        self.author_id = author.id
+        self.tag_id = tag.id
+
+        db.session.execute(insert(Post), [{'title': f'Post {i}', 'content': 'Riding free', 'user_id': author.id}
+                                          for i in range(2000)])
+        post_ids = db.session.execute(select(Post.id).where(Post.user_id == author.id)).scalars()
+        db.session.execute(insert(PostTag), [{'post_id': post_id, 'tag_id': tag.id} for post_id in post_ids])
+        db.session.commit()
+
+    def test_delete_user_with_thousands_of_posts(self):
+        """Ensures deleting a user deletes all their posts and tag associations without loading them, in a few statements: the
+        user lookup, one UPDATE of the tags' post counts, one UPDATE of the archive's month counts and the DELETE."""
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.post(f"/users/{self.author_id}/delete")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertLessEqual(len(statements), 4)
+            self.assertEqual(Post.query.count(), 0)
+            self.assertEqual(PostTag.query.count(), 0)
+
+    def test_delete_popular_tag(self):
+        """Ensures deleting a tag removes it from every post without loading the posts, and keeps the posts, in a few statements:
+        the tag lookup, one UPDATE and one DELETE of the related posts sharing it, and the DELETE."""
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.post(f"/tags/{self.tag_id}/delete")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertLessEqual(len(statements), 4)
+            self.assertEqual(Post.query.count(), 2000)
+            self.assertEqual(PostTag.query.count(), 0)
+
+
+class PostCountTestCase(AppTestCase):
+    """Contains tests for the post counts kept on users and tags, and the lists sorted by them."""
+    def setUp(self):
+        """Two authors and the tags Horses and Ranch."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        pru = User(first_name="Pru", last_name="Granger")
+        horses = Tag(name="Horses")
+        ranch = Tag(name="Ranch")
+        db.session.add_all([lucky, pru, horses, ranch])
+        db.session.commit()
+        self.lucky_id, self.pru_id = lucky.id, pru.id
+        self.horses_id, self.ranch_id = horses.id, ranch.id
+
+    def counts(self):
+        """Returns the post counts of Lucky, Pru, Horses and Ranch, as stored in the database."""
+        db.session.expire_all()
+        return (db.session.get(User, self.lucky_id).post_count, db.session.get(User, self.pru_id).post_count,
+                db.session.get(Tag, self.horses_id).post_count, db.session.get(Tag, self.ranch_id).post_count)
+
+    def add_post(self, client, user_id, *tag_ids):
+        client.post(f"/users/{user_id}/posts/new", data={'title': 'Spirit', 'content': 'Riding free', 'selected_tag_ids': list(tag_ids)})
+        return db.session.execute(select(Post.id).order_by(Post.id.desc())).scalars().first()
+
+    def test_counts_follow_post_writes(self):
+        """Ensures adding, retagging and deleting posts keeps the authors' and tags' post counts right."""
+        with app.test_client() as client:
+            first = self.add_post(client, self.lucky_id, self.horses_id, self.ranch_id)
+            self.add_post(client, self.lucky_id, self.horses_id)
+            self.add_post(client, self.pru_id, self.horses_id)
+            self.assertEqual(self.counts(), (2, 1, 3, 1))
+
+            client.post(f"/posts/{first}/edit", data={'title': 'Spirit', 'content': 'Riding free', 'selected_tag_ids': [self.ranch_id]})
+            self.assertEqual(self.counts(), (2, 1, 2, 1))
+
+            client.post(f"/posts/{first}/delete")
+            self.assertEqual(self.counts(), (1, 1, 2, 0))
+
+    def test_counts_follow_user_deletes(self):
+        """Ensures deleting a user takes their posts off their tags' post counts."""
+        with app.test_client() as client:
+            self.add_post(client, self.lucky_id, self.horses_id, self.ranch_id)
+            self.add_post(client, self.pru_id, self.horses_id)
+            client.post(f"/users/{self.lucky_id}/delete")
+
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Tag, self.horses_id).post_count, 1)
+        self.assertEqual(db.session.get(Tag, self.ranch_id).post_count, 0)
+
+    def test_reconcile_post_counts(self):
+        """Ensures reconciling repairs only the counts that drifted."""
+        with app.test_client() as client:
+            self.add_post(client, self.lucky_id, self.horses_id)
+        db.session.execute(insert(Post), [{'title': 'Behind the app', 'content': 'Riding free', 'user_id': self.pru_id}])
+        db.session.commit()
+
+        fixed = reconcile_post_counts(db.session.connection())
+
+        self.assertEqual(fixed, (1, 0))
+        self.assertEqual(self.counts(), (1, 1, 1, 0))
+
+    def test_sort_by_popularity(self):
+        """Ensures the users and tags lists show the post counts and can put the ones with the most posts first."""
+        with app.test_client() as client:
+            self.add_post(client, self.pru_id, self.ranch_id)
+            self.add_post(client, self.pru_id, self.ranch_id)
+            self.add_post(client, self.lucky_id)
+            users_html = client.get("/users?sort=popular").get_data(as_text=True)
+            tags_html = client.get("/tags?sort=popular").get_data(as_text=True)
+
+            self.assertLess(users_html.index('Pru Granger'), users_html.index('Lucky Prescott'))
+            self.assertIn('(2 posts)', users_html)
+            self.assertLess(tags_html.index('Ranch'), tags_html.index('Horses'))
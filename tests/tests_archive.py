@@ -0,0 +1,131 @@
+"""This file contains tests for the chronological archive: creation times set by the database, the month counts kept in
+archive_months, the archive pages, and the backfill of creation times written before the fix."""
+import re
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select, update
+from app import create_app
+from models import db, connect_db, backfill_created_at, rebuild_archive_months, ArchiveMonth, User, Post
+from fixtures import RollbackTestCase, database_uri
+from pagination import encode_cursor
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_archive"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+class ArchiveTestCase(RollbackTestCase):
+    """Contains tests for browsing posts by the month they were created in."""
+    app = app
+
+    def setUp(self):
+        """Add an author with posts in two months."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        db.session.add(lucky)
+        db.session.flush()
+        march = [{'title': f'March {i}', 'content': 'Riding free', 'user_id': lucky.id,
+                  'created_at': datetime(2024, 3, 1) + timedelta(hours=i)} for i in range(25)]
+        db.session.execute(insert(Post), march + [{'title': 'April', 'content': 'Riding free', 'user_id': lucky.id,
+                                                   'created_at': datetime(2024, 4, 2)}])
+        rebuild_archive_months(db.session.connection())
+        db.session.commit()
+        self.lucky_id = lucky.id
+
+    def month_counts(self):
+        return db.session.execute(select(ArchiveMonth.year, ArchiveMonth.month, ArchiveMonth.posts)
+                                  .order_by(ArchiveMonth.year, ArchiveMonth.month)).all()
+
+    def test_new_posts_get_the_current_time(self):
+        """Ensures every new post is stamped by the database with the time it was created, and counted in that month."""
+        before = datetime.utcnow().replace(microsecond=0)
+        with app.test_client() as client:
+            client.post(f"/users/{self.lucky_id}/posts/new", data={'title': 'Spirit', 'content': 'Riding free'})
+        after = datetime.utcnow()
+        created_at = db.session.execute(select(Post.created_at).where(Post.title == 'Spirit')).scalar_one()
+
+        self.assertTrue(before <= created_at <= after, created_at)
+        self.assertIn((created_at.year, created_at.month, 1), self.month_counts())
+
+    def test_archive_lists_months(self):
+        """Ensures the archive lists every month with posts, newest first, with its number of posts."""
+        with app.test_client() as client:
+            html = client.get("/archive").get_data(as_text=True)
+
+        self.assertIn('<a href="/archive/2024/3">March 2024</a> (25 posts)', html)
+        self.assertLess(html.index('April 2024'), html.index('March 2024'))
+
+    def test_month_pages(self):
+        """Ensures a month's posts are listed newest first, one page at a time, and only that month's."""
+        with app.test_client() as client:
+            first = client.get("/archive/2024/3")
+            cursor = encode_cursor([datetime(2024, 3, 1, 5), db.session.execute(
+                select(Post.id).where(Post.title == 'March 5')).scalar_one()])
+            second = client.get(f"/archive/2024/3?after={cursor}").get_data(as_text=True)
+            tampered = client.get(f"/archive/2024/3?after={encode_cursor(['yesterday', 1])}")
+            missing = client.get("/archive/2024/13")
+
+        html = first.get_data(as_text=True)
+        self.assertIn('March 24', html)
+        self.assertNotIn('March 4<', html)
+        self.assertNotIn('April', html)
+        self.assertIn('Next', html)
+        self.assertIn('March 4', second)
+        self.assertIn('March 0', second)
+        self.assertNotIn('March 5<', second)
+        self.assertEqual(tampered.status_code, 400)
+        self.assertIn("We couldn't find the page", missing.get_data(as_text=True))
+
+    def test_month_pages_of_database_times(self):
+        """Ensures paging through posts stamped by the database, many of them in the same second, shows each post once and ends,
+        since their stored times must compare with the cursor and the month bounds like the times the app binds."""
+        db.session.execute(insert(Post), [{'title': f'Now {i}', 'content': 'Riding free', 'user_id': self.lucky_id}
+                                          for i in range(25)])
+        db.session.commit()
+        now = datetime.utcnow()
+
+        titles = []
+        url = f"/archive/{now.year}/{now.month}"
+        with app.test_client() as client:
+            for _ in range(5):
+                html = client.get(url).get_data(as_text=True)
+                titles += re.findall(r'>(Now \d+)</a>', html)
+                next_link = re.search(r'href="([^"]*after=[^"]*)"', html)
+                if not next_link:
+                    break
+                url = next_link.group(1).replace('&amp;', '&')
+
+        self.assertIsNone(next_link)
+        self.assertEqual(sorted(titles), sorted(f'Now {i}' for i in range(25)))
+
+    def test_deletes_lower_month_counts(self):
+        """Ensures deleting a post, or a user with all their posts, takes them off their months."""
+        april_post = db.session.execute(select(Post.id).where(Post.title == 'April')).scalar_one()
+        with app.test_client() as client:
+            client.post(f"/posts/{april_post}/delete")
+            self.assertEqual(self.month_counts(), [(2024, 3, 25), (2024, 4, 0)])
+            client.post(f"/users/{self.lucky_id}/delete")
+
+        self.assertEqual(self.month_counts(), [(2024, 3, 0), (2024, 4, 0)])
+
+    def test_backfill(self):
+        """Ensures backfilling raises creation times that are older than an earlier post's, and fills in missing ones."""
+        db.session.execute(insert(Post), [{'title': 'Stale', 'content': 'Riding free', 'user_id': self.lucky_id,
+                                           'created_at': datetime(2024, 1, 1)},
+                                          {'title': 'Missing', 'content': 'Riding free', 'user_id': self.lucky_id}])
+        db.session.execute(update(Post).where(Post.title == 'Missing').values(created_at=None))
+        db.session.commit()
+
+        connection = db.session.connection()
+        fixed = backfill_created_at(connection)
+        rebuild_archive_months(connection)
+        self.assertEqual(backfill_created_at(connection), 0)
+        db.session.commit()
+
+        times = dict(db.session.execute(select(Post.title, Post.created_at)).all())
+        self.assertEqual(fixed, 2)
+        self.assertEqual(times['Stale'], datetime(2024, 4, 2))
+        self.assertEqual(times['Missing'], datetime(2024, 4, 2))
+        self.assertEqual(times['March 0'], datetime(2024, 3, 1))
+        self.assertEqual(self.month_counts(), [(2024, 3, 25), (2024, 4, 3)])
@@ -0,0 +1,136 @@
+"""This file contains tests for the response compression in compression.py and the hashed, pre-compressed static assets in
+assets.py."""
+import gzip
+import os
+import tempfile
+from unittest import skipUnless
+from app import create_app
+from models import db, connect_db, User, Post
+from fixtures import RollbackTestCase, database_uri
+from assets import build_assets, read_manifest
+from compression import brotli
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_assets"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+class CompressionTestCase(RollbackTestCase):
+    """Contains tests for compressing responses for the clients that accept it."""
+    app = app
+
+    def setUp(self):
+        """Add a user with a post, so the pages have something to show."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        db.session.add(lucky)
+        db.session.flush()
+        db.session.add(Post(title="Spirit", content="Riding free " * 50, user_id=lucky.id))
+        db.session.commit()
+        self.lucky_id = lucky.id
+
+    def tearDown(self):
+        """Turns the page cache back off."""
+        app.config['RESPONSE_CACHE_ENABLED'] = False
+
+    def test_gzip(self):
+        """Ensures a page is gzipped for a client that accepts gzip, and sent as is to one that doesn't."""
+        with app.test_client() as client:
+            plain = client.get("/")
+            compressed = client.get("/", headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed.headers['Vary'])
+        self.assertEqual(gzip.decompress(compressed.get_data()), plain.get_data())
+        self.assertLess(len(compressed.get_data()), len(plain.get_data()))
+
+    @skipUnless(brotli, "brotli isn't installed")
+    def test_brotli_preferred(self):
+        """Ensures brotli is picked over gzip when the client accepts both."""
+        with app.test_client() as client:
+            plain = client.get("/")
+            compressed = client.get("/", headers={'Accept-Encoding': 'gzip, deflate, br'})
+
+        self.assertEqual(compressed.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(compressed.get_data()), plain.get_data())
+
+    def test_skipped_responses(self):
+        """Ensures small responses and streamed exports are never compressed."""
+        with app.test_client() as client:
+            small = client.get("/api/tags/0", headers={'Accept-Encoding': 'gzip'})
+            export = client.get("/api/posts?format=ndjson", headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', small.headers)
+        self.assertNotIn('Content-Encoding', export.headers)
+
+    def test_conditional_get(self):
+        """Ensures a compressed cached page gets a weak ETag, which still turns the next request into a 304."""
+        app.config['RESPONSE_CACHE_ENABLED'] = True
+        app.extensions['response_cache'].backend.clear()
+        with app.test_client() as client:
+            first = client.get(f"/users/{self.lucky_id}", headers={'Accept-Encoding': 'gzip'})
+            again = client.get(f"/users/{self.lucky_id}", headers={'Accept-Encoding': 'gzip',
+                                                                    'If-None-Match': first.headers['ETag']})
+
+        self.assertTrue(first.headers['ETag'].startswith('W/'))
+        self.assertEqual(again.status_code, 304)
+
+class AssetsTestCase(RollbackTestCase):
+    """Contains tests for building and serving the hashed static assets."""
+    app = app
+
+    def setUp(self):
+        """Build the assets into a temporary folder and point the app at it."""
+        super().setUp()
+        self.dist = tempfile.TemporaryDirectory()
+        self.assets = app.extensions['assets']
+        self.original = (self.assets.dist_folder, self.assets.manifest)
+        self.manifest = build_assets(app.static_folder, self.dist.name)
+        self.assets.dist_folder, self.assets.manifest = self.dist.name, read_manifest(self.dist.name)
+
+    def tearDown(self):
+        """Puts the app's own assets back."""
+        self.assets.dist_folder, self.assets.manifest = self.original
+        self.dist.cleanup()
+
+    def test_build(self):
+        """Ensures every static file gets a content-hashed copy, and compressible ones get compressed copies too."""
+        built = self.manifest['styles.css']
+        path = os.path.join(self.dist.name, built)
+
+        self.assertRegex(built, r'^styles\.[0-9a-f]{10}\.css$')
+        with open(os.path.join(app.static_folder, 'styles.css'), 'rb') as source, open(path + '.gz', 'rb') as compressed:
+            self.assertEqual(gzip.decompress(compressed.read()), source.read())
+        self.assertEqual(os.path.isfile(path + '.br'), brotli is not None)
+
+    def test_pages_link_to_built_assets(self):
+        """Ensures pages link to the hashed copy, and to the plain static file when the assets haven't been built."""
+        with app.test_client() as client:
+            html = client.get("/").get_data(as_text=True)
+            self.assets.manifest = {}
+            unbuilt = client.get("/").get_data(as_text=True)
+
+        self.assertIn(f'href="/assets/{self.manifest["styles.css"]}"', html)
+        self.assertIn('href="/static/styles.css"', unbuilt)
+
+    def test_serve_precompressed(self):
+        """Ensures built assets are cached for a year and sent pre-compressed to clients that accept it."""
+        url = f"/assets/{self.manifest['styles.css']}"
+        with app.test_client() as client:
+            plain = client.get(url)
+            compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+            plain_body, compressed_body = plain.get_data(), compressed.get_data()
+            plain.close()
+            compressed.close()
+            manifest = client.get("/assets/manifest.json")
+
+        self.assertEqual(plain.mimetype, 'text/css')
+        self.assertIn('max-age=31536000', plain.headers['Cache-Control'])
+        self.assertIn('immutable', plain.headers['Cache-Control'])
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed_body), plain_body)
+        self.assertNotEqual(manifest.mimetype, 'application/json')
@@ -0,0 +1,78 @@
+"""This file contains tests for the route benchmark in benchmark.py."""
+import os
+from unittest import TestCase, mock, skipIf
+from sqlalchemy import make_url
+from app import create_app
+from models import db, connect_db, reconcile_post_counts, ArchiveMonth, Post
+from fixtures import database_uri
+from benchmark import build_scenarios, dataset_ids, find_regressions, load_dataset, main, run_benchmark, uncovered_endpoints, \
+    Scenario, ServerError
+
+# This module's own testing database, see fixtures.py. The benchmark's threads can't share the rollback fixture's one connection,
+# so every test recreates the tables and loads its dataset instead.
+app = create_app(database_uri("bloggit_test_benchmark"), testing=True)
+connect_db(app)
+# Every connection to an in-memory SQLite database is the same one, which the benchmark's threads can't take turns on.
+database_url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+IN_MEMORY = database_url.get_backend_name() == "sqlite" and database_url.database in (None, "", ":memory:")
+
+class BenchmarkTestCase(TestCase):
+    """Contains tests for running the benchmark and comparing it against a baseline."""
+    def setUp(self):
+        """Recreate the tables and load a small synthetic dataset."""
+        self.enterContext(app.app_context())
+        self.addCleanup(db.session.remove)
+        load_dataset(users=10, tags=5, posts_per_user="constant:2", tags_per_post="constant:1", seed=1)
+        self.scenarios = build_scenarios(*dataset_ids())
+
+    def test_every_route_is_benchmarked(self):
+        """Ensures there is a scenario for every page and form POST in the app."""
+        self.assertEqual(uncovered_endpoints(app, self.scenarios), [])
+
+    @skipIf(IN_MEMORY, "the benchmark's threads need a database they can open connections of their own to")
+    def test_run_benchmark(self):
+        """Ensures every scenario runs without errors and reports its throughput, latency and queries per request."""
+        results = run_benchmark(app, self.scenarios, requests=4, concurrency=2, report=lambda line: None)
+
+        self.assertEqual(set(results), {scenario.name for scenario in self.scenarios})
+        for name, stats in results.items():
+            self.assertEqual(stats["requests"], 4, name)
+            self.assertEqual(stats["errors"], 0, name)
+            self.assertGreater(stats["p99_ms"], 0)
+        self.assertGreater(results["GET show_post_details"]["queries_per_request"], 0)
+
+    @skipIf(IN_MEMORY, "the benchmark's threads need a database they can open connections of their own to")
+    def test_deleting_scenarios_keep_counts(self):
+        """Ensures the posts the delete and moderation scenarios add for themselves are counted like any other post, so deleting
+        or retagging them leaves the users', tags' and archive months' post counts as they should be."""
+        names = {"POST delete_post", "POST bulk_delete_posts", "POST bulk_add_tags", "POST bulk_remove_tags"}
+        run_benchmark(app, [scenario for scenario in self.scenarios if scenario.name in names], requests=2, concurrency=1,
+                      report=lambda line: None)
+
+        self.assertEqual(reconcile_post_counts(db.session.connection()), (0, 0))
+        self.assertEqual(db.session.query(db.func.sum(ArchiveMonth.posts)).scalar(), Post.query.count())
+
+    def test_server_error_stops_the_run(self):
+        """Ensures a route failing with a server error stops the benchmark instead of being counted among the errors."""
+        failing = Scenario("show_homepage", "GET", lambda rng, row: "/")
+        with mock.patch.dict(app.view_functions, {"show_homepage": lambda: 1 / 0}), \
+             mock.patch.dict(app.config, {"PROPAGATE_EXCEPTIONS": False}):
+            with self.assertRaises(ServerError):
+                run_benchmark(app, [failing], requests=1, concurrency=1, report=lambda line: None)
+
+    def test_find_regressions(self):
+        """Ensures an endpoint that got slower or runs more queries than the baseline is reported, within the threshold."""
+        baseline = {"GET show_homepage": {"p99_ms": 10.0, "throughput": 100.0, "queries_per_request": 2.0, "errors": 0}}
+        within = {"GET show_homepage": {"requests": 10, "p99_ms": 11.0, "throughput": 90.0, "queries_per_request": 2.0, "errors": 0}}
+        slower = {"GET show_homepage": {"requests": 10, "p99_ms": 20.0, "throughput": 100.0, "queries_per_request": 4.0, "errors": 0}}
+
+        self.assertEqual(find_regressions(within, baseline, 0.25), [])
+        self.assertEqual(len(find_regressions(slower, baseline, 0.25)), 2)
+
+    def test_refuses_to_run_with_database_url(self):
+        """Ensures the benchmark won't start, and so won't drop any tables, while DATABASE_URL points at a real database."""
+        with mock.patch.dict(os.environ, {"DATABASE_URL": "postgresql:///bloggit"}), mock.patch("benchmark.load_dataset") as load:
+            with self.assertRaises(SystemExit):
+                main(["--requests", "1"])
+
+        load.assert_not_called()
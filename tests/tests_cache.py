@@ -0,0 +1,208 @@
+"""This file contains tests for the rendered page cache: storing and evicting pages, invalidating them from the write routes, and
+answering conditional requests with 304 Not Modified."""
+from time import time
+from unittest import TestCase, skipUnless
+from sqlalchemy import event
+from app import create_app
+from models import db, connect_db, User, Post
+from fixtures import RollbackTestCase, database_uri
+from cache import CachedPage, MemoryBackend, RedisBackend
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_cache"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+def page(body, *deps):
+    return CachedPage(body.encode(), "text/html", body, 0, set(deps))
+
+class MemoryBackendTestCase(TestCase):
+    """Contains tests for the in-process LRU backend."""
+
+    def test_evicts_least_recently_used(self):
+        """Ensures a full cache evicts the page that was read the longest time ago."""
+        backend = MemoryBackend(max_entries=2)
+        backend.set("/a", page("a"), 0)
+        backend.set("/b", page("b"), 0)
+        backend.get("/a")
+        backend.set("/c", page("c"), 0)
+
+        self.assertIsNotNone(backend.get("/a"))
+        self.assertIsNone(backend.get("/b"))
+        self.assertIsNotNone(backend.get("/c"))
+
+    def test_expires_pages(self):
+        """Ensures pages are dropped once they are older than the TTL."""
+        backend = MemoryBackend(ttl=-1)
+        backend.set("/a", page("a"), 0)
+
+        self.assertIsNone(backend.get("/a"))
+
+    def test_invalidates_only_dependent_pages(self):
+        """Ensures invalidating a row drops the pages that show it and keeps the others."""
+        backend = MemoryBackend()
+        backend.set("/posts/1", page("one", "post:1", "user:1"), 0)
+        backend.set("/posts/2", page("two", "post:2", "user:2"), 0)
+        backend.invalidate(["user:1"])
+
+        self.assertIsNone(backend.get("/posts/1"))
+        self.assertIsNotNone(backend.get("/posts/2"))
+
+    def test_skips_pages_rendered_before_an_invalidation(self):
+        """Ensures a page that started rendering before one of its rows changed isn't stored, since it may show the old row."""
+        backend = MemoryBackend()
+        sequence = backend.current_sequence()
+        backend.invalidate(["post:1"])
+        backend.set("/posts/1", page("stale", "post:1"), sequence)
+
+        self.assertIsNone(backend.get("/posts/1"))
+
+    def test_skips_replica_pages_older_than_an_invalidation(self):
+        """Ensures a page whose data may predate an invalidation, like one read from a lagging replica, isn't stored."""
+        backend = MemoryBackend()
+        backend.invalidate(["post:1"])
+        backend.set("/posts/1", page("stale", "post:1"), backend.current_sequence(), data_as_of=time() - 5)
+        backend.set("/posts/2", page("two", "post:2"), backend.current_sequence(), data_as_of=time() - 5)
+
+        self.assertIsNone(backend.get("/posts/1"))
+        self.assertIsNotNone(backend.get("/posts/2"))
+
+    @skipUnless(fakeredis, "fakeredis is not installed")
+    def test_redis_backend(self):
+        """Ensures the Redis backend stores and invalidates pages the same way, using a local stand-in for Redis."""
+        backend = RedisBackend(client=fakeredis.FakeRedis())
+        backend.set("/posts/1", page("one", "post:1"), backend.current_sequence())
+        backend.set("/posts/2", page("two", "post:2"), backend.current_sequence())
+        backend.invalidate(["post:1"])
+        backend.set("/posts/1?stale", page("stale", "post:1"), backend.current_sequence(), data_as_of=time() - 5)
+
+        self.assertIsNone(backend.get("/posts/1"))
+        self.assertIsNone(backend.get("/posts/1?stale"))
+        self.assertEqual(backend.get("/posts/2").body, b"two")
+
+    @skipUnless(fakeredis, "fakeredis is not installed")
+    def test_redis_invalidations_expire(self):
+        """Ensures the Redis backend records each invalidation under a key of its own that expires with the pages."""
+        client = fakeredis.FakeRedis()
+        backend = RedisBackend(client=client, ttl=60)
+        backend.invalidate([f"post:{number}" for number in range(100)])
+
+        invalidation_keys = list(client.scan_iter(backend.prefix + "inv:*"))
+        self.assertEqual(len(invalidation_keys), 100)
+        self.assertTrue(all(0 < client.ttl(key) <= 60 for key in invalidation_keys))
+
+    @skipUnless(fakeredis, "fakeredis is not installed")
+    def test_redis_skips_pages_invalidated_while_storing(self):
+        """Ensures a page isn't stored in Redis if another worker invalidates one of its rows after the rows were checked."""
+        server = fakeredis.FakeServer()
+        other_worker = RedisBackend(client=fakeredis.FakeRedis(server=server))
+
+        class InterruptedRedis(fakeredis.FakeRedis):
+            def pipeline(self, *args, **kwargs):
+                pipe = super().pipeline(*args, **kwargs)
+                check = pipe.mget
+                def mget(*args, **kwargs):
+                    invalidated = check(*args, **kwargs)
+                    other_worker.invalidate(["post:1"])
+                    return invalidated
+                pipe.mget = mget
+                return pipe
+
+        backend = RedisBackend(client=InterruptedRedis(server=server))
+        backend.set("/posts/1", page("stale", "post:1"), backend.current_sequence())
+
+        self.assertIsNone(backend.get("/posts/1"))
+
+class CachedViewsTestCase(RollbackTestCase):
+    """Contains tests for the cached post, user, tag and home pages."""
+    app = app
+
+    def setUp(self):
+        """Add a user with two posts and turn the page cache on."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        db.session.add(lucky)
+        db.session.flush()
+        spirit = Post(title="Spirit", content="Riding free", user_id=lucky.id)
+        chica = Post(title="Chica", content="The fastest", user_id=lucky.id)
+        db.session.add_all([spirit, chica])
+        db.session.commit()
+
+        self.lucky_id = lucky.id
+        self.spirit_id = spirit.id
+        self.chica_id = chica.id
+        app.config['RESPONSE_CACHE_ENABLED'] = True
+        app.extensions['response_cache'].backend.clear()
+
+    def tearDown(self):
+        """Turns the page cache back off."""
+        app.config['RESPONSE_CACHE_ENABLED'] = False
+
+    def count_queries(self, client, url, **kwargs):
+        """Requests url and returns the response along with the number of queries it took."""
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            resp = client.get(url, **kwargs)
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        return resp, len(statements)
+
+    def test_repeat_visits_skip_the_database(self):
+        """Ensures a second visit to a page is served from the cache without any queries."""
+        with app.test_client() as client:
+            first, first_queries = self.count_queries(client, f"/posts/{self.spirit_id}")
+            second, second_queries = self.count_queries(client, f"/posts/{self.spirit_id}")
+
+            self.assertGreater(first_queries, 0)
+            self.assertEqual(second_queries, 0)
+            self.assertEqual(first.get_data(), second.get_data())
+
+    def test_conditional_get(self):
+        """Ensures a reader that sends back the page's ETag gets a 304 Not Modified without any queries."""
+        with app.test_client() as client:
+            first = client.get(f"/users/{self.lucky_id}")
+            resp, queries = self.count_queries(client, f"/users/{self.lucky_id}", headers={'If-None-Match': first.headers['ETag']})
+
+            self.assertIn('Last-Modified', first.headers)
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(queries, 0)
+
+    def test_write_invalidates_affected_pages(self):
+        """Ensures editing a post refreshes the pages that show it and keeps the cached pages of other posts."""
+        with app.test_client() as client:
+            client.get(f"/posts/{self.spirit_id}")
+            client.get(f"/posts/{self.chica_id}")
+            client.get(f"/users/{self.lucky_id}")
+            client.post(f"/posts/{self.spirit_id}/edit", data={'title': 'Spirit Returns', 'content': 'Riding free'},
+                        follow_redirects=True)
+
+            post_page, post_queries = self.count_queries(client, f"/posts/{self.spirit_id}")
+            user_page, user_queries = self.count_queries(client, f"/users/{self.lucky_id}")
+            other_page, other_queries = self.count_queries(client, f"/posts/{self.chica_id}")
+
+            self.assertIn('Spirit Returns', post_page.get_data(as_text=True))
+            self.assertIn('Spirit Returns', user_page.get_data(as_text=True))
+            self.assertGreater(post_queries, 0)
+            self.assertEqual(other_queries, 0)
+
+    def test_flashed_messages_are_not_cached(self):
+        """Ensures the page shown right after a write, with its flashed message, isn't stored and shown to later readers."""
+        with app.test_client() as client:
+            client.post(f"/users/{self.lucky_id}/edit", data={'first_name': 'Fortuna', 'last_name': 'Prescott', 'image_url': ''})
+            flashed = client.get(f"/users/{self.lucky_id}").get_data(as_text=True)
+            later = client.get(f"/users/{self.lucky_id}").get_data(as_text=True)
+
+            self.assertIn('User successfully updated!', flashed)
+            self.assertNotIn('User successfully updated!', later)
+            self.assertIn('Fortuna Prescott', later)
@@ -0,0 +1,105 @@
+"""This file contains tests for the Atom feeds of the site, of each user and of each tag, and for serving them from the page cache."""
+import xml.etree.ElementTree as ElementTree
+from sqlalchemy import event
+from app import create_app
+from models import db, connect_db, User, Post, Tag, PostTag
+from fixtures import RollbackTestCase, database_uri
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_feeds"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+ATOM = "{http://www.w3.org/2005/Atom}"
+
+def entry_titles(resp):
+    """Parses an Atom feed and returns the titles of its entries, in order."""
+    feed = ElementTree.fromstring(resp.get_data())
+    return [entry.find(f"{ATOM}title").text for entry in feed.iter(f"{ATOM}entry")]
+
+class FeedsTestCase(RollbackTestCase):
+    """Contains tests for the Atom feeds."""
+    app = app
+
+    def setUp(self):
+        """Add two users with posts, some of them tagged Horses."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        pru = User(first_name="Pru", last_name="Granger")
+        horses = Tag(name="Horses")
+        db.session.add_all([lucky, pru, horses])
+        db.session.flush()
+        spirit = Post(title="Spirit", content="Riding free", user_id=lucky.id)
+        chica = Post(title="Chica Linda", content="The fastest", user_id=pru.id)
+        ranch = Post(title="Ranch & Rules", content="<b>Chores</b> first", user_id=lucky.id)
+        db.session.add_all([spirit, chica, ranch])
+        db.session.flush()
+        db.session.add_all([PostTag(post_id=spirit.id, tag_id=horses.id), PostTag(post_id=chica.id, tag_id=horses.id)])
+        db.session.commit()
+
+        self.lucky_id = lucky.id
+        self.horses_id = horses.id
+
+    def tearDown(self):
+        """Turns the page cache back off."""
+        app.config['RESPONSE_CACHE_ENABLED'] = False
+
+    def test_site_feed(self):
+        """Ensures the site feed is a valid Atom document listing every post newest first, with escaped content and tags."""
+        with app.test_client() as client:
+            resp = client.get("/feed")
+
+        self.assertEqual(resp.mimetype, 'application/atom+xml')
+        self.assertEqual(entry_titles(resp), ['Ranch & Rules', 'Chica Linda', 'Spirit'])
+        feed = ElementTree.fromstring(resp.get_data())
+        entry = feed.find(f"{ATOM}entry")
+        self.assertEqual(entry.find(f"{ATOM}content").text, '<b>Chores</b> first')
+        self.assertEqual(entry.find(f"{ATOM}author/{ATOM}name").text, 'Lucky Prescott')
+        self.assertEqual(feed.find(f"{ATOM}link[@rel='self']").get('href'), 'http://localhost/feed')
+
+    def test_user_and_tag_feeds(self):
+        """Ensures the user and tag feeds only list that user's or that tag's posts, and that unknown ones aren't found."""
+        with app.test_client() as client:
+            user_feed = client.get(f"/users/{self.lucky_id}/feed")
+            tag_feed = client.get(f"/tags/{self.horses_id}/feed")
+            missing = client.get("/tags/0/feed")
+
+        self.assertEqual(entry_titles(user_feed), ['Ranch & Rules', 'Spirit'])
+        self.assertEqual(entry_titles(tag_feed), ['Chica Linda', 'Spirit'])
+        self.assertNotEqual(missing.mimetype, 'application/atom+xml')
+
+    def test_cached_per_host(self):
+        """Ensures a feed cached for one host isn't served to another, since its links point at the host it was requested on."""
+        app.config['RESPONSE_CACHE_ENABLED'] = True
+        app.extensions['response_cache'].backend.clear()
+        with app.test_client() as client:
+            client.get("/feed", base_url="http://bloggit.example")
+            resp = client.get("/feed", base_url="https://blog.example")
+
+        feed = ElementTree.fromstring(resp.get_data())
+        self.assertEqual(feed.find(f"{ATOM}link[@rel='self']").get('href'), 'https://blog.example/feed')
+
+    def test_polls_are_answered_from_the_cache(self):
+        """Ensures polling a feed with its ETag gets a 304 without any queries, until a new post changes the feed."""
+        app.config['RESPONSE_CACHE_ENABLED'] = True
+        app.extensions['response_cache'].backend.clear()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        with app.app_context():
+            engine = db.engine
+        with app.test_client() as client:
+            etag = client.get(f"/users/{self.lucky_id}/feed").headers['ETag']
+            event.listen(engine, "before_cursor_execute", listener)
+            try:
+                poll = client.get(f"/users/{self.lucky_id}/feed", headers={'If-None-Match': etag})
+            finally:
+                event.remove(engine, "before_cursor_execute", listener)
+            client.post(f"/users/{self.lucky_id}/posts/new", data={'title': 'Boomerang', 'content': 'A new horse'})
+            changed = client.get(f"/users/{self.lucky_id}/feed", headers={'If-None-Match': etag})
+
+        self.assertEqual(poll.status_code, 304)
+        self.assertEqual(statements, [])
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(entry_titles(changed)[0], 'Boomerang')
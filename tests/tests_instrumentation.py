@@ -0,0 +1,154 @@
+"""This file contains tests for the per-request performance instrumentation: the Server-Timing header, the metrics endpoint, and
+the production profile that turns the SQL echo and the debug toolbar off."""
+import threading
+from unittest import mock, skipUnless
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from app import create_app, warm_up
+from models import db, connect_db, ensure_connected, User
+from fixtures import RollbackTestCase, database_uri
+from instrumentation import percentile, EndpointStats, RequestStats
+from config import engine_options, ProductionConfig
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_instrumentation"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+ON_POSTGRES = app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgresql")
+
+def production_app(db_name="bloggit_test"):
+    """Builds an app with the production profile, as if the SECRET_KEY environment variable were set."""
+    with mock.patch.object(ProductionConfig, "SECRET_KEY", "not-so-secret"):
+        return create_app(db_name, profile="production")
+
+class InstrumentationTestCase(RollbackTestCase):
+    """Contains tests for the timings reported on every response and aggregated at /metrics."""
+    app = app
+
+    def setUp(self):
+        """Add one user whose details page makes a couple of queries."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        db.session.add(lucky)
+        db.session.commit()
+        self.lucky_id = lucky.id
+
+    def test_server_timing_header(self):
+        """Ensures a page response reports its query count, SQL time, template time and total time."""
+        with app.test_client() as client:
+            resp = client.get(f"/users/{self.lucky_id}")
+            timing = resp.headers["Server-Timing"]
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('desc="2 queries"', timing)
+            self.assertIn('db-slowest;dur=', timing)
+            self.assertIn('tpl;dur=', timing)
+            self.assertIn('total;dur=', timing)
+
+    def test_metrics_endpoint(self):
+        """Ensures the metrics endpoint reports percentiles and the slowest statement for endpoints that have been hit."""
+        with app.test_client() as client:
+            for i in range(3):
+                client.get(f"/users/{self.lucky_id}")
+            resp = client.get("/metrics")
+            stats = resp.get_json()["endpoints"]["show_user_details"]
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertGreaterEqual(stats["count"], 3)
+            self.assertEqual(stats["queries"]["p99"], 2)
+            self.assertIn("p95", stats["total_ms"])
+            self.assertIn("SELECT", stats["slowest_statement"]["sql"])
+
+    def test_failed_statement(self):
+        """Ensures a statement that fails doesn't leave its start time behind to be taken for the next statement's."""
+        with app.test_request_context():
+            with self.assertRaises(DBAPIError):
+                db.session.execute(text("SELECT * FROM no_such_table"))
+            db.session.rollback()
+            db.session.execute(text("SELECT 1"))
+
+            self.assertNotIn("query_start_time", db.session.connection().info)
+
+    def test_concurrent_records(self):
+        """Ensures requests recorded from many threads at once are all counted."""
+        endpoint_stats = EndpointStats(window=100)
+        def record():
+            for i in range(1000):
+                endpoint_stats.record(RequestStats(), 0.001)
+        threads = [threading.Thread(target=record) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(endpoint_stats.summary()["count"], 8000)
+        self.assertEqual(endpoint_stats.summary()["window"], 100)
+
+    def test_percentile(self):
+        """Ensures percentiles use the nearest rank of the sorted samples."""
+        samples = list(range(1, 101))
+
+        self.assertEqual(percentile(samples, 0.50), 50)
+        self.assertEqual(percentile(samples, 0.99), 99)
+        self.assertIsNone(percentile([], 0.50))
+
+    def test_production_profile(self):
+        """Ensures the production profile doesn't echo SQL, attach the debug toolbar or serve the metrics unless asked to."""
+        production = production_app()
+
+        self.assertFalse(production.config['SQLALCHEMY_ECHO'])
+        self.assertNotIn('DEBUG_TB_ENABLED', production.config)
+        self.assertIn('instrumentation', production.extensions)
+        self.assertNotIn('metrics', production.view_functions)
+
+    def test_production_needs_secret_key(self):
+        """Ensures the production profile won't start with the development SECRET_KEY, which anyone could sign sessions with."""
+        with mock.patch.object(ProductionConfig, "SECRET_KEY", None):
+            with self.assertRaises(RuntimeError):
+                create_app("bloggit_test", profile="production")
+
+    def test_production_pool_settings(self):
+        """Ensures the production profile sizes the connection pool, checks connections before using them, sets a statement
+        timeout on Postgres and leaves creating the tables to `flask bloggit migrate`."""
+        production = production_app()
+        options = production.config['SQLALCHEMY_ENGINE_OPTIONS']
+
+        self.assertEqual(options['pool_size'], 10)
+        self.assertEqual(options['max_overflow'], 20)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertIn('statement_timeout=5000', options['connect_args']['options'])
+        self.assertFalse(production.config['CREATE_TABLES_ON_CONNECT'])
+        self.assertNotIn('pool_size', engine_options(production.config, 'sqlite:///:memory:'))
+        self.assertNotIn('connect_args', engine_options(production.config, 'sqlite:///:memory:'))
+
+    @skipUnless(ON_POSTGRES, "only Postgres has a statement timeout")
+    def test_commands_have_no_statement_timeout(self):
+        """Ensures the production app's connections have a statement timeout, except once a `flask bloggit` command has connected
+        through ensure_connected."""
+        production = production_app(app.config['SQLALCHEMY_DATABASE_URI'])
+        connect_db(production)
+        def show_timeout():
+            with db.engine.connect() as connection:
+                return connection.execute(text("SHOW statement_timeout")).scalar()
+        with production.app_context():
+            self.addCleanup(db.engine.dispose)
+            self.assertEqual(show_timeout(), "5s")
+            ensure_connected(production)
+            self.assertEqual(show_timeout(), "0")
+
+    def test_startup_metrics(self):
+        """Ensures warming up compiles the templates ahead of time and that the startup timings are reported at /metrics."""
+        # Warming up opens and closes the pool's connections, so it gets an app of its own instead of closing the connection this
+        # test runs on (an in-memory SQLite database only ever has that one).
+        warm_app = create_app(database_uri("bloggit_test_instrumentation"), testing=True)
+        connect_db(warm_app)
+        warm_up(warm_app)
+        with warm_app.test_client() as client:
+            client.get("/users")
+            startup = client.get("/metrics").get_json()["startup"]
+
+        self.assertIn('user_details.html', [template.name for template in warm_app.jinja_env.cache.values()])
+        self.assertGreater(startup["warm_up_ms"], 0)
+        self.assertGreater(startup["time_to_first_request_ms"], 0)
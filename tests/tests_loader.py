@@ -0,0 +1,128 @@
+"""This file contains tests for the bulk loader behind the `flask bloggit load` command."""
+import json
+import os
+import tempfile
+from unittest import skipUnless
+from sqlalchemy import select
+from app import create_app
+from loader import split_by_columns
+from models import db, connect_db, User, Post, Tag, PostTag, RelatedPost
+from fixtures import RollbackTestCase, database_uri
+from related import refresh_related_posts
+
+try:
+    import numpy, scipy
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_loader"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+class LoaderTestCase(RollbackTestCase):
+    """Contains tests for generating and importing data with the loader."""
+    app = app
+
+    def setUp(self):
+        """Get a runner for the load command."""
+        super().setUp()
+        self.runner = app.test_cli_runner()
+
+    def load(self, *args):
+        result = self.runner.invoke(args=["bloggit", "load", *args])
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result
+
+    def test_generate(self):
+        """Ensures the loader generates the requested number of rows, in batches, with every association pointing at real rows."""
+        self.load("--users", "20", "--tags", "5", "--posts-per-user", "constant:3", "--tags-per-post", "constant:2",
+                  "--seed", "1", "--batch-size", "7")
+
+        self.assertEqual(User.query.count(), 20)
+        self.assertEqual(Tag.query.count(), 5)
+        self.assertEqual(Post.query.count(), 60)
+        self.assertEqual(PostTag.query.count(), 120)
+        self.assertEqual(PostTag.query.join(Post).join(Tag).count(), 120)
+        self.assertEqual({len(user.posts) for user in User.query.all()}, {3})
+
+    @skipUnless(HAVE_NUMPY, "rebuilding the related posts needs numpy and scipy")
+    def test_generate_builds_related_posts(self):
+        """Ensures the loaded posts get their related posts, the same ones the write routes would have stored."""
+        result = self.load("--users", "5", "--tags", "4", "--posts-per-user", "constant:2", "--tags-per-post", "constant:2",
+                           "--seed", "1")
+        related_rows = lambda: set(db.session.execute(select(RelatedPost.post_id, RelatedPost.related_post_id,
+                                                             RelatedPost.shared_tags)).all())
+        loaded = related_rows()
+        for post_id in db.session.execute(select(Post.id)).scalars():
+            refresh_related_posts(post_id, app.config['RELATED_POSTS_KEPT'])
+
+        self.assertIn("related post rows", result.output)
+        self.assertTrue(loaded)
+        self.assertEqual(loaded, related_rows())
+
+    def test_generate_appends_to_existing_data(self):
+        """Ensures loading twice adds new rows after the existing ones instead of clashing with their ids."""
+        self.load("--users", "3", "--tags", "2", "--posts-per-user", "constant:1", "--seed", "1")
+        self.load("--users", "3", "--tags", "2", "--posts-per-user", "constant:1", "--seed", "1")
+
+        self.assertEqual(User.query.count(), 6)
+        self.assertEqual(Post.query.count(), 6)
+
+    def test_bad_distribution(self):
+        """Ensures a distribution spec that can't be parsed is reported instead of loading anything."""
+        result = self.runner.invoke(args=["bloggit", "load", "--users", "3", "--posts-per-user", "zigzag:2"])
+
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertEqual(User.query.count(), 0)
+
+    def test_import(self):
+        """Ensures rows are imported from CSV and NDJSON files."""
+        with tempfile.TemporaryDirectory() as directory:
+            users_path = os.path.join(directory, "users.csv")
+            with open(users_path, "w") as file:
+                file.write("id,first_name,last_name\n1,Lucky,Prescott\n2,Pru,Granger\n")
+            posts_path = os.path.join(directory, "posts.ndjson")
+            with open(posts_path, "w") as file:
+                for post_id, user_id in [(1, 1), (2, 1), (3, 2)]:
+                    file.write(json.dumps({"id": post_id, "title": f"Post {post_id}", "content": "Hi", "user_id": user_id,
+                                           "created_at": "2024-03-01T12:00:00"}) + "\n")
+
+            self.load("--import", users_path, "--table", "users")
+            self.load("--import", posts_path, "--table", "posts")
+
+        self.assertEqual([user.get_full_name() for user in User.query.order_by(User.id)], ["Lucky Prescott", "Pru Granger"])
+        self.assertEqual(len(User.query.get(1).posts), 2)
+        self.assertEqual(Post.query.get(3).created_at.year, 2024)
+
+    def test_import_rows_with_different_columns(self):
+        """Ensures NDJSON rows don't need the same keys: a column a row leaves out gets its default, a column only later rows
+        have is still written, and a key that isn't a column is reported with its row."""
+        with tempfile.TemporaryDirectory() as directory:
+            users_path = os.path.join(directory, "users.ndjson")
+            with open(users_path, "w") as file:
+                file.write(json.dumps({"id": 1, "first_name": "Lucky"}) + "\n")
+                file.write(json.dumps({"id": 2, "first_name": "Pru", "last_name": "Granger", "image_url": "pru.png"}) + "\n")
+            bad_path = os.path.join(directory, "bad.ndjson")
+            with open(bad_path, "w") as file:
+                file.write(json.dumps({"id": 3, "first_name": "Abigail"}) + "\n")
+                file.write(json.dumps({"id": 4, "first_name": "Bo", "nickname": "Bo"}) + "\n")
+
+            self.load("--import", users_path, "--table", "users")
+            result = self.runner.invoke(args=["bloggit", "load", "--import", bad_path, "--table", "users"])
+
+        self.assertEqual((User.query.get(1).last_name, User.query.get(2).image_url), ("", "pru.png"))
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("row 2: users has no column(s) nickname", result.output)
+        self.assertEqual(User.query.count(), 2)
+
+    def test_split_by_columns(self):
+        """Ensures rows are grouped by their columns, which are listed in the table's order, for COPY."""
+        rows = [{"first_name": "Lucky", "id": 1}, {"id": 2, "first_name": "Pru", "last_name": "Granger"},
+                {"id": 3, "first_name": "Bo"}]
+
+        self.assertEqual(split_by_columns("users", rows), [(["id", "first_name"], [rows[0], rows[2]]),
+                                                           (["id", "first_name", "last_name"], [rows[1]])])
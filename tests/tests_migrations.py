@@ -0,0 +1,145 @@
+"""This file contains tests for the versioned migrations in migrations.py, and a check of the query plans of every page so a query
+that stops using its index and falls back to scanning a whole table is caught."""
+import re
+from unittest import TestCase
+from sqlalchemy import event, insert, inspect
+from sqlalchemy.exc import IntegrityError
+from app import create_app
+from models import db, connect_db, User, Post, Tag, PostTag
+from fixtures import RollbackTestCase, database_uri
+from migrations import MIGRATIONS, migrate, schema_migrations
+from pagination import encode_cursor
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_migrations"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+# Full table scans that are expected. SQLite's search falls back to LIKE matching, which can't use an index.
+EXPECTED_SQLITE_SCANS = {"/search?q=horse": {"posts"}, "/api/search?q=horse": {"posts"}}
+
+def index_names(table):
+    return {index["name"] for index in inspect(db.engine).get_indexes(table)}
+
+def full_table_scans(connection, statement, parameters):
+    """Returns the tables the database would read from start to end to run statement. On Postgres sequential scans are turned
+    off first, so the planner only falls back to one when no index can serve the query at all."""
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql("SET enable_seqscan = off")
+        try:
+            plan = "\n".join(row[0] for row in connection.exec_driver_sql("EXPLAIN " + statement, parameters))
+        finally:
+            connection.exec_driver_sql("RESET enable_seqscan")
+        return set(re.findall(r"Seq Scan on (\w+)", plan))
+    plan = [row[-1] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+    return {match.group(1) for line in plan if (match := re.fullmatch(r"SCAN (\w+)(?: AS \w+)?", line))}
+
+class MigrationsTestCase(TestCase):
+    """Contains tests for bringing a database's schema up to date. Migrations drop and create tables on connections of their own,
+    outside of any transaction, so these tests can't be rolled back like the others and put the tables back themselves."""
+    def setUp(self):
+        """Start every test from a database without any tables."""
+        self.enterContext(app.app_context())
+        db.session.remove()
+        db.drop_all()
+        schema_migrations.drop(db.engine, checkfirst=True)
+
+    def tearDown(self):
+        """Put the tables back for the other tests."""
+        db.session.remove()
+        schema_migrations.drop(db.engine, checkfirst=True)
+        db.drop_all()
+        db.create_all()
+
+    def test_migrate_new_database(self):
+        """Ensures migrating an empty database creates the tables with their indexes, and that migrating again does nothing."""
+        applied = migrate(db.engine)
+
+        self.assertEqual([migration.version for migration in applied], [migration.version for migration in MIGRATIONS])
+        self.assertIn('ix_posts_user_id_id', index_names('posts'))
+        self.assertIn('ix_posts_tags_tag_id_post_id', index_names('posts_tags'))
+        self.assertIn('ix_users_name', index_names('users'))
+        self.assertEqual(migrate(db.engine), [])
+
+    def test_migrate_existing_database(self):
+        """Ensures a database created before the migrations existed gets the indexes it is missing."""
+        db.create_all()
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("DROP INDEX ix_posts_user_id_id")
+            connection.exec_driver_sql("DROP INDEX ix_posts_created_at_id")
+
+        migrate(db.engine)
+
+        self.assertIn('ix_posts_user_id_id', index_names('posts'))
+        self.assertIn('ix_posts_created_at_id', index_names('posts'))
+        self.assertNotIn('ix_posts_created_at', index_names('posts'))
+
+    def test_case_insensitive_tag_names(self):
+        """Ensures migrating with case-insensitive tag names makes the database reject names that only differ in case, refuses
+        while such names exist, and lets them in again once the setting is turned off."""
+        migrate(db.engine)
+        with db.engine.begin() as connection:
+            connection.execute(insert(Tag), [{"name": "Python"}, {"name": "python"}])
+        with self.assertRaises(ValueError):
+            migrate(db.engine, case_insensitive_tags=True)
+
+        with db.engine.begin() as connection:
+            connection.execute(Tag.__table__.delete().where(Tag.name == "python"))
+        migrate(db.engine, case_insensitive_tags=True)
+        with self.assertRaises(IntegrityError), db.engine.begin() as connection:
+            connection.execute(insert(Tag).values(name="PYTHON"))
+
+        migrate(db.engine)
+        with db.engine.begin() as connection:
+            connection.execute(insert(Tag).values(name="PYTHON"))
+
+class QueryPlanTestCase(RollbackTestCase):
+    """Contains a check that every page's queries are served by indexes."""
+    app = app
+
+    def setUp(self):
+        """Add a user with a tagged post."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        ranch = Tag(name="Ranch")
+        db.session.add_all([lucky, ranch])
+        db.session.flush()
+        spirit = Post(title="Spirit the horse", content="Spirit ran across the ranch.", user_id=lucky.id)
+        db.session.add(spirit)
+        db.session.flush()
+        db.session.add(PostTag(post_id=spirit.id, tag_id=ranch.id))
+        db.session.commit()
+
+        self.urls = [
+            "/", "/users", f"/users?after={encode_cursor(['Prescott', 'Lucky', lucky.id])}",
+            f"/users?sort=popular&after={encode_cursor([1, lucky.id])}", f"/tags?sort=popular&after={encode_cursor([1, ranch.id])}",
+            "/feed", f"/users/{lucky.id}/feed", f"/tags/{ranch.id}/feed", f"/users/{lucky.id}", f"/users/{lucky.id}?after={encode_cursor([spirit.id])}", f"/users/{lucky.id}/edit",
+            f"/users/{lucky.id}/posts/new", f"/posts/{spirit.id}", f"/posts/{spirit.id}/edit",
+            "/tags", f"/tags/{ranch.id}", f"/tags/{ranch.id}?after={encode_cursor([spirit.id])}", f"/tags/{ranch.id}/edit",
+            "/search?q=horse", "/api/search?q=horse", "/api/tags/trending?window=week", "/archive",
+            f"/archive/{spirit.created_at.year}/{spirit.created_at.month}",
+            f"/archive/{spirit.created_at.year}/{spirit.created_at.month}?after={encode_cursor([spirit.created_at, spirit.id])}",
+        ]
+
+    def test_pages_use_indexes(self):
+        """Ensures no query behind any page has to scan a whole table."""
+        for url in self.urls:
+            statements = []
+            listener = lambda conn, cursor, statement, parameters, context, executemany: statements.append((statement, parameters))
+            with app.app_context():
+                engine = db.engine
+            event.listen(engine, "before_cursor_execute", listener)
+            try:
+                with app.test_client() as client:
+                    self.assertEqual(client.get(url).status_code, 200, url)
+            finally:
+                event.remove(engine, "before_cursor_execute", listener)
+
+            connection = db.session.connection()
+            expected = EXPECTED_SQLITE_SCANS.get(url, set()) if connection.dialect.name == "sqlite" else set()
+            for statement, parameters in statements:
+                if statement.lstrip().upper().startswith("SELECT"):
+                    scans = full_table_scans(connection, statement, parameters) - expected
+                    self.assertEqual(scans, set(), f"{url} scans {', '.join(scans)}: {statement}")
@@ -1,24 +1,57 @@
 """This file contains some tests for the methods and class methods found inside the Model classes."""
-from unittest import TestCase
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
 from app import create_app
 from models import db, connect_db, User
+from fixtures import RollbackTestCase, database_uri
 
-# Create another application instance that connects to the testing database (bloggit_test) instead fo the main database (bloggit).
-app = create_app("bloggit_test", testing=True)
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_models"), testing=True)
 connect_db(app)
-app.app_context().push()
+with app.app_context():
+    db.drop_all()
+    db.create_all()
 
-db.drop_all()
-db.create_all()
+class UserModelTestCase(RollbackTestCase):
+    app = app
 
-class UserModelTestCase(TestCase):
+    def test_get_full_name(self):
+        user = User(first_name="TestUser", last_name="Zach")
+        self.assertEqual(user.get_full_name(), "TestUser Zach")
 
-    def setUp(self):
-        User.query.delete()
+    def test_last_name_never_null(self):
+        """Ensures a user without a last name gets an empty one, since the users list is paginated on it, and NULL is refused."""
+        cher = User(first_name="Cher")
+        db.session.add(cher)
+        db.session.commit()
+        self.assertEqual(cher.last_name, "")
 
-    def tearDown(self):
+        with self.assertRaises(IntegrityError):
+            db.session.execute(insert(User).values(first_name="Madonna", last_name=None))
         db.session.rollback()
 
-    def test_get_full_name(self):
-        user = User(first_name="TestUser", last_name="Zach")
-        self.assertEqual(user.get_full_name(), "TestUser Zach")
+    def test_commits_rolled_back(self):
+        """Ensures what a test commits, directly or through a route, is gone once the test is over."""
+        db.session.add(User(first_name="TestUser", last_name="Zach"))
+        db.session.commit()
+        with app.test_client() as client:
+            client.post("/users/new", data={'first_name': 'John', 'last_name': 'Smith', 'image_url': ''})
+        self.assertEqual(User.query.count(), 2)
+
+        self.doCleanups()
+        with app.app_context():
+            self.assertEqual(User.query.count(), 0)
+
+class DatabaseURITestCase(RollbackTestCase):
+    """Runs against an in-memory SQLite database, given to create_app as a full URI."""
+    app = create_app("sqlite://", testing=True)
+    connect_db(app)
+
+    def test_in_memory_database(self):
+        """Ensures every session and request share the one in-memory database."""
+        with self.app.test_client() as client:
+            client.post("/users/new", data={'first_name': 'John', 'last_name': 'Smith', 'image_url': ''})
+            html = client.get("/users").get_data(as_text=True)
+
+        self.assertIn('John Smith', html)
+        self.assertEqual(User.query.count(), 1)
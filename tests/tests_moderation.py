@@ -0,0 +1,140 @@
+"""This file contains tests for the bulk moderation endpoints in app.py and the chunked operations behind them in moderation.py."""
+import json
+from sqlalchemy import event, func, select
+from app import create_app
+from models import db, connect_db, ArchiveMonth, User, Post, Tag, RelatedPost
+from related import shared_tag_counts
+from fixtures import RollbackTestCase, SAVEPOINT_STATEMENTS, database_uri
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_moderation"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+class BulkModerationTestCase(RollbackTestCase):
+    """Contains tests for deleting and retagging many posts at once."""
+    app = app
+
+    def setUp(self):
+        """Add two authors and the tags Horses, Ranch and Spam, and posts written through the add post route so every count and
+        the related posts index are up to date: 5 spam posts by Lucky, and 2 posts by Pru."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        pru = User(first_name="Pru", last_name="Granger")
+        tags = [Tag(name="Horses"), Tag(name="Ranch"), Tag(name="Spam")]
+        db.session.add_all([lucky, pru, *tags])
+        db.session.commit()
+        self.lucky_id, self.pru_id = lucky.id, pru.id
+        self.horses_id, self.ranch_id, self.spam_id = [tag.id for tag in tags]
+        with app.test_client() as client:
+            for i in range(5):
+                self.add_post(client, self.lucky_id, self.horses_id, self.spam_id)
+            self.add_post(client, self.pru_id, self.horses_id, self.ranch_id)
+            self.add_post(client, self.pru_id, self.horses_id)
+        self.spam_ids = self.post_ids(Post.user_id == self.lucky_id)
+        self.pru_post_ids = self.post_ids(Post.user_id == self.pru_id)
+        app.config['BULK_CHUNK_SIZE'] = 2
+
+    def tearDown(self):
+        """Restores the chunk size."""
+        app.config['BULK_CHUNK_SIZE'] = 1000
+
+    def add_post(self, client, user_id, *tag_ids):
+        client.post(f"/users/{user_id}/posts/new", data={'title': 'Spirit', 'content': 'Riding free',
+                                                         'selected_tag_ids': list(tag_ids)})
+
+    def post_ids(self, *criteria):
+        return db.session.execute(select(Post.id).where(*criteria).order_by(Post.id)).scalars().all()
+
+    def tag_counts(self):
+        db.session.expire_all()
+        return {tag.id: tag.post_count for tag in Tag.query}
+
+    def assert_related_posts_consistent(self):
+        """Ensures every pair in the related posts index has the number of tags the two posts really share."""
+        for post_id, related_post_id, shared_tags in db.session.execute(
+                select(RelatedPost.post_id, RelatedPost.related_post_id, RelatedPost.shared_tags)):
+            self.assertEqual(dict(db.session.execute(shared_tag_counts(post_id)).all()).get(related_post_id), shared_tags,
+                             (post_id, related_post_id))
+
+    def test_delete_by_author(self):
+        """Ensures deleting by author deletes the posts chunk by chunk and keeps every count and the related posts right."""
+        with app.test_client() as client:
+            resp = client.post("/api/posts/bulk/delete", json={'author': self.lucky_id})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json, {'chunks': 3, 'posts': 5, 'deleted': 5, 'last_id': self.spam_ids[-1]})
+        self.assertEqual(self.post_ids(), self.pru_post_ids)
+        self.assertEqual(db.session.get(User, self.lucky_id).post_count, 0)
+        self.assertEqual(self.tag_counts(), {self.horses_id: 2, self.ranch_id: 1, self.spam_id: 0})
+        self.assertEqual(db.session.execute(select(func.sum(ArchiveMonth.posts))).scalar(), 2)
+        self.assertEqual(db.session.execute(select(func.count()).select_from(RelatedPost)
+                                            .where(RelatedPost.related_post_id.in_(self.spam_ids))).scalar(), 0)
+        self.assert_related_posts_consistent()
+
+    def test_delete_by_ids_and_filters(self):
+        """Ensures post ids are narrowed down by the filters, and ids of posts that don't exist are skipped."""
+        with app.test_client() as client:
+            resp = client.post("/api/posts/bulk/delete", json={'post_ids': [*self.pru_post_ids, self.spam_ids[0], 999999],
+                                                               'tag': self.ranch_id})
+
+        self.assertEqual(resp.json['deleted'], 1)
+        self.assertEqual(self.post_ids(Post.user_id == self.pru_id), self.pru_post_ids[1:])
+
+    def test_add_and_remove_tags(self):
+        """Ensures retagging only adds the missing associations and only removes existing ones, keeping the tags' post counts
+        and the shared tag counts of the related posts right."""
+        with app.test_client() as client:
+            resp = client.post("/api/posts/bulk/add-tags", json={'min_id': self.spam_ids[2],
+                                                                 'tag_ids': [self.ranch_id, self.spam_id]})
+            self.assertEqual(resp.json, {'chunks': 3, 'posts': 5, 'added': 6, 'last_id': self.pru_post_ids[-1]})
+            self.assertEqual(self.tag_counts(), {self.horses_id: 7, self.ranch_id: 5, self.spam_id: 7})
+            self.assert_related_posts_consistent()
+
+            resp = client.post("/api/posts/bulk/remove-tags", json={'tag': self.spam_id, 'tag_ids': [self.spam_id]})
+            self.assertEqual(resp.json['removed'], 7)
+            self.assertEqual(self.tag_counts(), {self.horses_id: 7, self.ranch_id: 5, self.spam_id: 0})
+            self.assert_related_posts_consistent()
+
+    def test_progress(self):
+        """Ensures ?format=ndjson reports the running totals after every chunk, then once more when done."""
+        with app.test_client() as client:
+            resp = client.post("/api/posts/bulk/delete?format=ndjson", json={'author': self.lucky_id})
+            lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+
+        self.assertEqual([line['deleted'] for line in lines], [2, 4, 5, 5])
+        self.assertEqual(lines[-1], {'chunks': 3, 'posts': 5, 'deleted': 5, 'last_id': self.spam_ids[-1], 'done': True})
+
+    def test_statements_per_chunk(self):
+        """Ensures a chunk takes the same number of statements however many posts it has."""
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not statement.startswith(SAVEPOINT_STATEMENTS):
+                statements.append(statement)
+
+        app.config['BULK_CHUNK_SIZE'] = 1000
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            with app.test_client() as client:
+                client.post("/api/posts/bulk/delete", json={'post_ids': self.spam_ids[:1]})
+                one_post = len(statements)
+                statements.clear()
+                client.post("/api/posts/bulk/delete", json={'post_ids': self.spam_ids[1:]})
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+        self.assertEqual(len(statements), one_post)
+
+    def test_invalid_requests(self):
+        """Ensures a body without ids or filters, with values that aren't ids, or with tags that don't exist is rejected."""
+        with app.test_client() as client:
+            self.assertEqual(client.post("/api/posts/bulk/delete", json={}).status_code, 400)
+            self.assertEqual(client.post("/api/posts/bulk/delete", json={'author': 'Lucky'}).status_code, 400)
+            self.assertEqual(client.post("/api/posts/bulk/delete", data={'author': self.lucky_id}).status_code, 400)
+            self.assertEqual(client.post("/api/posts/bulk/add-tags", json={'author': self.lucky_id}).status_code, 400)
+            resp = client.post("/api/posts/bulk/add-tags", json={'author': self.lucky_id, 'tag_ids': [self.spam_id + 100]})
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(len(self.post_ids()), 7)
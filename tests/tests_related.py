@@ -0,0 +1,192 @@
+"""This file contains tests for the related posts index in related.py: keeping it up to date as posts are tagged and tags deleted,
+showing it on the post details page, and rebuilding it from scratch."""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, mock, skipIf, skipUnless
+from sqlalchemy import make_url, select
+from app import create_app
+from models import db, connect_db, User, Post, Tag, RelatedPost
+from fixtures import RollbackTestCase, database_uri
+from related import rebuild_related_posts, refresh_related_posts
+
+try:
+    import numpy, scipy
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_related"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+# Every connection to an in-memory SQLite database is the same one, which concurrent requests can't take turns on.
+database_url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+IN_MEMORY = database_url.get_backend_name() == "sqlite" and database_url.database in (None, "", ":memory:")
+
+def related_rows():
+    """Returns every row of the index as (post_id, related_post_id, shared_tags) tuples."""
+    return set(db.session.execute(select(RelatedPost.post_id, RelatedPost.related_post_id, RelatedPost.shared_tags)).all())
+
+class RelatedPostsTestCase(RollbackTestCase):
+    """Contains tests for the related posts shown on a post's page."""
+    app = app
+
+    def setUp(self):
+        """Add an author and three tags."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        tags = [Tag(name="Horses"), Tag(name="Ranch"), Tag(name="Miradero")]
+        db.session.add_all([lucky, *tags])
+        db.session.commit()
+        app.extensions['tag_catalog'].invalidate()
+
+        self.lucky_id = lucky.id
+        self.horses_id, self.ranch_id, self.miradero_id = [tag.id for tag in tags]
+
+    def add_post(self, client, title, tag_ids):
+        client.post(f"/users/{self.lucky_id}/posts/new", data={'title': title, 'content': 'Riding free', 'selected_tag_ids': tag_ids})
+        return db.session.execute(select(Post.id).where(Post.title == title)).scalar_one()
+
+    def test_add_post(self):
+        """Ensures a new post is related, in both directions, to the posts sharing its tags, best match first."""
+        with app.test_client() as client:
+            spirit = self.add_post(client, 'Spirit', [self.horses_id, self.ranch_id])
+            chica = self.add_post(client, 'Chica Linda', [self.horses_id])
+            boomerang = self.add_post(client, 'Boomerang', [self.horses_id, self.ranch_id])
+            self.add_post(client, 'Untagged', [])
+            html = client.get(f"/posts/{spirit}").get_data(as_text=True)
+
+        self.assertEqual(related_rows(), {(spirit, chica, 1), (chica, spirit, 1), (spirit, boomerang, 2), (boomerang, spirit, 2),
+                                          (chica, boomerang, 1), (boomerang, chica, 1)})
+        self.assertIn('Related Posts', html)
+        self.assertLess(html.index('Boomerang'), html.index('Chica Linda'))
+
+    def test_update_post_tags(self):
+        """Ensures changing a post's tags updates its related posts and the pages that listed it."""
+        with app.test_client() as client:
+            spirit = self.add_post(client, 'Spirit', [self.horses_id])
+            chica = self.add_post(client, 'Chica Linda', [self.horses_id])
+            self.assertIn('Chica Linda', client.get(f"/posts/{spirit}").get_data(as_text=True))
+
+            client.post(f"/posts/{chica}/edit", data={'title': 'Chica Linda', 'content': 'Riding free',
+                                                     'selected_tag_ids': [self.miradero_id]})
+            html = client.get(f"/posts/{spirit}").get_data(as_text=True)
+
+        self.assertEqual(related_rows(), set())
+        self.assertNotIn('Chica Linda', html)
+
+    def test_neighbours_keep_their_best_matches(self):
+        """Ensures a post that matches many new posts is trimmed back to its best matches instead of listing all of them."""
+        app.config['RELATED_POSTS_KEPT'] = 2
+        try:
+            with app.test_client() as client:
+                spirit = self.add_post(client, 'Spirit', [self.horses_id, self.ranch_id])
+                chica = self.add_post(client, 'Chica Linda', [self.horses_id, self.ranch_id])
+                boomerang = self.add_post(client, 'Boomerang', [self.horses_id])
+                abigail = self.add_post(client, 'Abigail', [self.horses_id, self.ranch_id])
+        finally:
+            app.config['RELATED_POSTS_KEPT'] = 20
+
+        listed_by_spirit = {related for post_id, related, shared in related_rows() if post_id == spirit}
+        self.assertEqual(listed_by_spirit, {chica, abigail})
+        self.assertNotIn(boomerang, listed_by_spirit)
+
+    def test_delete_related_author(self):
+        """Ensures deleting a user takes their posts off the cached pages that listed them as related posts."""
+        pru = User(first_name="Pru", last_name="Granger")
+        db.session.add(pru)
+        db.session.commit()
+        app.config['RESPONSE_CACHE_ENABLED'] = True
+        app.extensions['response_cache'].backend.clear()
+        try:
+            # The writes flash messages, which keep the writer's pages out of the cache, so another client reads them.
+            reader = app.test_client()
+            with app.test_client() as client:
+                spirit = self.add_post(client, 'Spirit', [self.horses_id])
+                client.post(f"/users/{pru.id}/posts/new", data={'title': 'Chica Linda', 'content': 'Riding free',
+                                                                'selected_tag_ids': [self.horses_id]})
+                self.assertIn('Chica Linda', reader.get(f"/posts/{spirit}").get_data(as_text=True))
+
+                client.post(f"/users/{pru.id}/delete")
+                html = reader.get(f"/posts/{spirit}").get_data(as_text=True)
+        finally:
+            app.config['RESPONSE_CACHE_ENABLED'] = False
+
+        self.assertNotIn('Chica Linda', html)
+
+    def test_delete_tag(self):
+        """Ensures deleting a tag lowers the shared counts of the posts that had it, and drops pairs that only shared that tag."""
+        with app.test_client() as client:
+            spirit = self.add_post(client, 'Spirit', [self.horses_id, self.ranch_id])
+            self.add_post(client, 'Chica Linda', [self.horses_id])
+            boomerang = self.add_post(client, 'Boomerang', [self.horses_id, self.ranch_id])
+            client.post(f"/tags/{self.horses_id}/delete")
+
+        self.assertEqual(related_rows(), {(spirit, boomerang, 1), (boomerang, spirit, 1)})
+
+    @skipUnless(HAVE_NUMPY, "rebuilding the related posts needs numpy and scipy")
+    def test_rebuild_matches_incremental_updates(self):
+        """Ensures rebuilding the whole index, in blocks smaller than the number of posts, gives the rows kept up to date by the
+        routes."""
+        tag_sets = [[self.horses_id, self.ranch_id], [self.horses_id], [self.ranch_id, self.miradero_id], [self.miradero_id],
+                    [self.horses_id, self.ranch_id, self.miradero_id], []]
+        with app.test_client() as client:
+            for i, tag_ids in enumerate(tag_sets):
+                self.add_post(client, f'Post {i}', tag_ids)
+        expected = related_rows()
+
+        written = rebuild_related_posts(keep=app.config['RELATED_POSTS_KEPT'], block_size=2)
+
+        self.assertEqual(written, len(expected))
+        self.assertEqual(related_rows(), expected)
+
+@skipIf(IN_MEMORY, "concurrent requests need a database they can open connections of their own to")
+class ConcurrentUpdatesTestCase(TestCase):
+    """Contains tests for posts sharing tags being edited at the same time. The requests have to commit on connections of their
+    own, so these tests can't use the rollback fixture and empty the tables themselves."""
+
+    def setUp(self):
+        """Add an author, three tags and three posts sharing the first tag."""
+        self.enterContext(app.app_context())
+        self.addCleanup(db.session.remove)
+        self.addCleanup(app.extensions['tag_catalog'].invalidate)
+        for model in (User, Tag):
+            self.addCleanup(db.session.commit)
+            self.addCleanup(model.query.delete)
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        self.horses, self.ranch, self.miradero = Tag(name="Horses"), Tag(name="Ranch"), Tag(name="Miradero")
+        db.session.add_all([lucky, self.horses, self.ranch, self.miradero])
+        db.session.flush()
+        self.post_ids = [Post.add(title, 'Riding free', lucky.id, [self.horses.id], app.config['RELATED_POSTS_KEPT'])[0].id
+                         for title in ('Spirit', 'Chica Linda', 'Boomerang')]
+        db.session.commit()
+        app.extensions['tag_catalog'].invalidate()
+
+    def test_concurrent_updates(self):
+        """Ensures two posts sharing a tag can be given other tags at the same time, with the related posts refreshed by both."""
+        barrier = threading.Barrier(2)
+        def refresh_together(post_id, keep):
+            try:
+                barrier.wait(timeout=2)
+            except threading.BrokenBarrierError:
+                # SQLite lets one transaction write at a time, so there the other request is waiting for this one to commit.
+                pass
+            return refresh_related_posts(post_id, keep)
+
+        def retag(post_id, tag_ids):
+            with app.test_client() as client:
+                return client.post(f"/posts/{post_id}/edit", data={'title': 'Retagged', 'content': 'Riding free',
+                                                                  'selected_tag_ids': tag_ids}).status_code
+
+        with mock.patch("app.refresh_related_posts", refresh_together), ThreadPoolExecutor(2) as executor:
+            for extra_tag_ids in ([self.ranch.id], [self.miradero.id]), ([], []), ([self.miradero.id], [self.ranch.id]), ([], []):
+                statuses = list(executor.map(retag, self.post_ids[:2],
+                                             [[self.horses.id, *tag_ids] for tag_ids in extra_tag_ids]))
+                self.assertEqual(statuses, [302, 302])
+
+        spirit, chica, boomerang = self.post_ids
+        db.session.expire_all()
+        self.assertEqual(related_rows(), {(spirit, chica, 1), (spirit, boomerang, 1), (chica, spirit, 1), (chica, boomerang, 1),
+                                          (boomerang, spirit, 1), (boomerang, chica, 1)})
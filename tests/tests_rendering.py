@@ -0,0 +1,89 @@
+"""This file contains tests for the Markdown rendering of posts in rendering.py: sanitizing, excerpts, rendering at write time and
+re-rendering every post with a process pool."""
+from unittest import TestCase
+from sqlalchemy import insert, select
+from app import create_app
+from models import db, connect_db, User, Post
+from fixtures import RollbackTestCase, database_uri
+from rendering import RENDER_VERSION, render_markdown, rerender_posts
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_rendering"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+class RenderMarkdownTestCase(TestCase):
+    """Contains tests for turning Markdown into safe HTML and an excerpt."""
+
+    def test_formatting(self):
+        """Ensures Markdown formatting is rendered and the excerpt keeps only the text."""
+        content_html, excerpt = render_markdown("# Spirit\n\nRiding **free** on the [ranch](https://example.com).")
+
+        self.assertIn('<h1>Spirit</h1>', content_html)
+        self.assertIn('<strong>free</strong>', content_html)
+        self.assertIn('<a href="https://example.com" rel="nofollow noopener">ranch</a>', content_html)
+        self.assertEqual(excerpt, 'Spirit Riding free on the ranch.')
+
+    def test_sanitizing(self):
+        """Ensures raw HTML that could run scripts is removed from the rendered HTML."""
+        content_html, excerpt = render_markdown('<script>alert(1)</script>\n\n<a href="javascript:alert(1)" onclick="x()">hi</a>'
+                                                '\n\n<img src="https://example.com/a.png" onerror="x()">')
+
+        self.assertNotIn('<script', content_html)
+        self.assertNotIn('javascript:', content_html)
+        self.assertNotIn('onclick', content_html)
+        self.assertNotIn('onerror', content_html)
+        self.assertIn('<img src="https://example.com/a.png">', content_html)
+
+    def test_long_excerpt(self):
+        """Ensures long posts get an excerpt cut at a word boundary."""
+        content_html, excerpt = render_markdown("horse " * 100)
+
+        self.assertLessEqual(len(excerpt), 200)
+        self.assertTrue(excerpt.endswith('horse…'))
+
+class RenderedPostsTestCase(RollbackTestCase):
+    """Contains tests for storing the rendered HTML of posts."""
+    app = app
+
+    def setUp(self):
+        """Add an author."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        db.session.add(lucky)
+        db.session.commit()
+        self.lucky_id = lucky.id
+
+    def test_rendered_when_saved(self):
+        """Ensures adding and editing a post store its rendering, which the post page shows, and the home page shows the excerpt."""
+        with app.test_client() as client:
+            client.post(f"/users/{self.lucky_id}/posts/new", data={'title': 'Spirit', 'content': 'Riding *free*'})
+            post = Post.query.filter_by(title='Spirit').one()
+            self.assertEqual((post.content_html, post.excerpt, post.render_version),
+                             ('<p>Riding <em>free</em></p>', 'Riding free', RENDER_VERSION))
+
+            client.post(f"/posts/{post.id}/edit", data={'title': 'Spirit', 'content': 'Riding **fast**'})
+            details = client.get(f"/posts/{post.id}").get_data(as_text=True)
+            home = client.get("/").get_data(as_text=True)
+
+        self.assertIn('<p>Riding <strong>fast</strong></p>', details)
+        self.assertIn('<p>Riding fast</p>', home)
+
+    def test_rerender_posts(self):
+        """Ensures re-rendering renders the posts that were never rendered or rendered by an older version, in worker processes."""
+        db.session.execute(insert(Post), [{'title': f'Post {i}', 'content': f'Post *number* {i}', 'user_id': self.lucky_id,
+                                           'render_version': i % 2 and RENDER_VERSION} for i in range(7)])
+        db.session.commit()
+        reported = []
+
+        rendered = rerender_posts(workers=2, batch_size=2, report=reported.append)
+
+        self.assertEqual(rendered, 4)
+        self.assertEqual(reported[-1], 4)
+        rows = db.session.execute(select(Post.title, Post.content_html, Post.render_version).order_by(Post.id)).all()
+        self.assertEqual(rows[0], ('Post 0', '<p>Post <em>number</em> 0</p>', RENDER_VERSION))
+        self.assertEqual(rows[1], ('Post 1', None, RENDER_VERSION))
+        self.assertEqual(rerender_posts(workers=2, batch_size=2), 0)
+        self.assertEqual(rerender_posts(workers=2, batch_size=2, everything=True), 7)
@@ -0,0 +1,137 @@
+"""This file contains tests for the read replica routing in replicas.py. A second testing database, bloggit_test_replica, stands in
+for the replica: it holds the same users as the primary under different names, so every page shows which database it was read
+from."""
+from unittest import TestCase
+from sqlalchemy import insert
+from app import create_app
+from models import db, connect_db, User, Tag
+from fixtures import database_uri
+
+REPLICA_URL = database_uri("bloggit_test_replica")
+UNREACHABLE_URL = "sqlite:////nonexistent/bloggit_test_replica.db"
+
+# This module's own testing database, see fixtures.py, which reads from bloggit_test_replica. A session bound to the rollback
+# fixture's connection never reads from a replica, so these tests commit and empty the tables themselves.
+app = create_app(database_uri("bloggit_test_replicas"), testing=True, replica_urls=[REPLICA_URL])
+connect_db(app)
+replica_engine = app.extensions['replica_router'].engines['replica_0']
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+db.metadata.drop_all(replica_engine)
+db.metadata.create_all(replica_engine)
+
+class ReplicaRoutingTestCase(TestCase):
+    """Contains tests for sending reads to the replica and keeping writers on the primary."""
+    def setUp(self):
+        """Delete current entries, and add the same user to both databases under different first names."""
+        self.enterContext(app.app_context())
+        User.query.delete()
+        db.session.commit()
+        with replica_engine.begin() as connection:
+            connection.execute(User.__table__.delete())
+        lucky = User(first_name="Primary", last_name="Prescott")
+        db.session.add(lucky)
+        db.session.commit()
+        self.lucky_id = lucky.id
+        with replica_engine.begin() as connection:
+            connection.execute(insert(User), [{'id': lucky.id, 'first_name': "Replica", 'last_name': "Prescott"}])
+        db.session.close()
+        app.extensions['response_cache'].backend.clear()
+
+    def tearDown(self):
+        """Turns the page cache back off, and empties the staging area for the database."""
+        app.config['RESPONSE_CACHE_ENABLED'] = False
+        db.session.rollback()
+
+    def test_get_reads_from_replica(self):
+        """Ensures GET requests read from the replica, and queries outside of a request from the primary."""
+        with app.test_client() as client:
+            html = client.get(f"/users/{self.lucky_id}").get_data(as_text=True)
+
+        self.assertIn("Replica Prescott", html)
+        self.assertEqual(db.session.get(User, self.lucky_id).first_name, "Primary")
+
+    def test_writer_reads_own_writes(self):
+        """Ensures the write goes to the primary, and the page it redirects to, and the writer's next pages, are read from it too."""
+        with app.test_client() as client:
+            resp = client.post(f"/users/{self.lucky_id}/edit", data={'first_name': 'Edited', 'last_name': 'Prescott',
+                                                                    'image_url': ''}, follow_redirects=True)
+            self.assertIn("Edited Prescott", resp.get_data(as_text=True))
+
+            # Only the writer is kept on the primary.
+            self.assertIn("Edited Prescott", client.get(f"/users/{self.lucky_id}").get_data(as_text=True))
+            with app.test_client() as other_client:
+                self.assertIn("Replica Prescott", other_client.get(f"/users/{self.lucky_id}").get_data(as_text=True))
+
+            # And once the writer's window is over too, the writer reads from the replica again.
+            with client.session_transaction() as session:
+                session['_primary_until'] = 0
+            self.assertIn("Replica Prescott", client.get(f"/users/{self.lucky_id}").get_data(as_text=True))
+
+    def test_replica_pages_not_cached_after_write(self):
+        """Ensures a page read from the replica isn't stored in the page cache shared by every worker while the replica may not
+        have caught up with a write to one of its rows yet, and is stored again once the window is over."""
+        app.config['RESPONSE_CACHE_ENABLED'] = True
+        backend = app.extensions['response_cache'].backend
+        with app.test_client() as client:
+            client.post(f"/users/{self.lucky_id}/edit", data={'first_name': 'Edited', 'last_name': 'Prescott', 'image_url': ''})
+        with app.test_client() as client:
+            self.assertIn("Replica Prescott", client.get(f"/users/{self.lucky_id}").get_data(as_text=True))
+            self.assertIsNone(backend.get(f"http://localhost/users/{self.lucky_id}?"))
+
+            app.config['REPLICA_STICKY_SECONDS'] = 0
+            try:
+                client.get(f"/users/{self.lucky_id}")
+            finally:
+                app.config['REPLICA_STICKY_SECONDS'] = 5
+            self.assertIsNotNone(backend.get(f"http://localhost/users/{self.lucky_id}?"))
+
+    def test_writer_sees_own_tag_in_catalog(self):
+        """Ensures another visitor's read from the replica doesn't refill the shared tag catalog without the tag the writer just
+        added, while the writer is kept on the primary."""
+        self.addCleanup(app.extensions['tag_catalog'].invalidate)
+        self.addCleanup(db.session.commit)
+        self.addCleanup(Tag.query.filter_by(name="Replicated").delete)
+        with app.test_client() as client:
+            client.post("/tags/new", data={'tag_name': 'Replicated'})
+            with app.test_client() as other_client:
+                other_client.get(f"/users/{self.lucky_id}/posts/new")
+
+            self.assertIn("Replicated", client.get(f"/users/{self.lucky_id}/posts/new").get_data(as_text=True))
+
+class ReplicaHealthTestCase(TestCase):
+    """Contains tests for picking among the replicas."""
+
+    def build_router(self, replica_urls):
+        replica_app = create_app(database_uri("bloggit_test_replicas"), testing=True, replica_urls=replica_urls)
+        return replica_app.extensions['replica_router']
+
+    def test_round_robin(self):
+        """Ensures healthy replicas take turns."""
+        router = self.build_router([REPLICA_URL, REPLICA_URL])
+        engines = router.engines
+
+        self.assertEqual([router.choose() for i in range(4)],
+                         [engines['replica_0'], engines['replica_1'], engines['replica_0'], engines['replica_1']])
+
+    def test_unhealthy_replica_skipped(self):
+        """Ensures a replica that can't be reached is left out, and reads go to the primary when no replica can be reached."""
+        router = self.build_router([UNREACHABLE_URL, REPLICA_URL])
+        engines = router.engines
+
+        self.assertEqual([router.choose() for i in range(3)], [engines['replica_1']] * 3)
+        self.assertFalse(router.states['replica_0'].healthy)
+
+        router = self.build_router([UNREACHABLE_URL])
+        self.assertIsNone(router.choose())
+
+    def test_health_rechecked(self):
+        """Ensures a replica is only checked again once REPLICA_HEALTH_CHECK_INTERVAL has passed."""
+        router = self.build_router([REPLICA_URL])
+        router.choose()
+        router.states['replica_0'].healthy = False
+
+        self.assertIsNone(router.choose())
+        router.app.config['REPLICA_HEALTH_CHECK_INTERVAL'] = 0
+        self.assertIs(router.choose(), router.engines['replica_0'])
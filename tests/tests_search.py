@@ -0,0 +1,73 @@
+"""This file contains tests for searching posts through the /search page and the /api/search endpoint."""
+from app import create_app
+from models import db, connect_db, User, Post, Tag, PostTag
+from fixtures import RollbackTestCase, database_uri
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_search"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+class SearchViewsTestCase(RollbackTestCase):
+    """Contains tests for finding posts by the words in their title and content."""
+    app = app
+
+    def setUp(self):
+        """Add 2 authors with 3 posts between them, two of which mention horses."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        pru = User(first_name="Pru", last_name="Granger")
+        ranch = Tag(name="Ranch")
+        db.session.add_all([lucky, pru, ranch])
+        db.session.flush()
+        spirit = Post(title="Spirit the horse", content="Spirit ran across the ranch.", user_id=lucky.id)
+        chica = Post(title="Chica Bonita", content="<b>My horse</b> Chica is the fastest.", user_id=pru.id)
+        school = Post(title="School", content="Nothing about animals at all.", user_id=pru.id)
+        db.session.add_all([spirit, chica, school])
+        db.session.flush()
+        db.session.add(PostTag(post_id=chica.id, tag_id=ranch.id))
+        db.session.commit()
+
+        self.lucky_id = lucky.id
+        self.pru_id = pru.id
+        self.ranch_id = ranch.id
+
+    def test_search_page(self):
+        """Ensures searching shows the matching posts with the matches highlighted, title matches first, and the markup in their
+        content left out of the excerpts."""
+        with app.test_client() as client:
+            resp = client.get("/search?q=horse")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<mark>horse</mark>', html)
+            self.assertIn('Chica is the fastest', html)
+            self.assertNotIn('<b>', html)
+            self.assertNotIn('&lt;b&gt;', html)
+            self.assertNotIn('School', html)
+            self.assertLess(html.index('Spirit'), html.index('Chica'))
+
+    def test_search_filters(self):
+        """Ensures searches can be narrowed down to the posts with a tag or by an author."""
+        with app.test_client() as client:
+            by_tag = client.get(f"/api/search?q=horse&tag={self.ranch_id}").get_json()
+            by_author = client.get(f"/api/search?q=horse&author={self.lucky_id}").get_json()
+
+            self.assertEqual([result['title'] for result in by_tag['results']], ['Chica Bonita'])
+            self.assertEqual([result['title'] for result in by_author['results']], ['Spirit the horse'])
+
+    def test_search_api_pages(self):
+        """Ensures the search results can be walked one page at a time with the next cursor."""
+        app.config['PAGE_SIZE'] = 1
+        try:
+            with app.test_client() as client:
+                first_page = client.get("/api/search?q=horse").get_json()
+                second_page = client.get(f"/api/search?q=horse&after={first_page['next_cursor']}").get_json()
+        finally:
+            app.config['PAGE_SIZE'] = 20
+
+        self.assertEqual([result['title'] for result in first_page['results']], ['Spirit the horse'])
+        self.assertEqual([result['title'] for result in second_page['results']], ['Chica Bonita'])
+        self.assertIsNone(second_page['next_cursor'])
@@ -0,0 +1,98 @@
+"""This file contains tests for the trending tags in trending.py: the hourly activity kept by the write routes, the windows read from
+it, the home page sidebar and the JSON endpoint."""
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select
+from app import create_app
+from models import db, connect_db, User, Post, Tag, TagActivity
+from fixtures import RollbackTestCase, database_uri
+from trending import current_hour, prune_tag_activity, record_tag_activity, trending_tags
+
+# This module's own testing database, see fixtures.py.
+app = create_app(database_uri("bloggit_test_trending"), testing=True)
+connect_db(app)
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+class TrendingTagsTestCase(RollbackTestCase):
+    """Contains tests for counting recent posts per tag over the trending windows."""
+    app = app
+
+    def setUp(self):
+        """Add an author and three tags."""
+        super().setUp()
+        lucky = User(first_name="Lucky", last_name="Prescott")
+        tags = [Tag(name="Horses"), Tag(name="Ranch"), Tag(name="Miradero")]
+        db.session.add_all([lucky, *tags])
+        db.session.commit()
+        app.extensions['tag_catalog'].invalidate()
+
+        self.lucky_id = lucky.id
+        self.horses_id, self.ranch_id, self.miradero_id = [tag.id for tag in tags]
+
+    def activity(self):
+        return {(tag_id, posts) for tag_id, posts in db.session.execute(select(TagActivity.tag_id, TagActivity.posts))}
+
+    def test_write_routes_count_activity(self):
+        """Ensures adding a tagged post, and adding tags to a post, count towards the current hour, one row per tag."""
+        with app.test_client() as client:
+            client.post(f"/users/{self.lucky_id}/posts/new", data={'title': 'Spirit', 'content': 'Riding free',
+                                                                  'selected_tag_ids': [self.horses_id, self.ranch_id]})
+            client.post(f"/users/{self.lucky_id}/posts/new", data={'title': 'Chica Linda', 'content': 'Riding free',
+                                                                  'selected_tag_ids': [self.horses_id]})
+            post_id = db.session.execute(select(Post.id).where(Post.title == 'Chica Linda')).scalar_one()
+            client.post(f"/posts/{post_id}/edit", data={'title': 'Chica Linda', 'content': 'Riding free',
+                                                        'selected_tag_ids': [self.miradero_id]})
+
+        self.assertEqual(self.activity(), {(self.horses_id, 2), (self.ranch_id, 1), (self.miradero_id, 1)})
+
+    def test_windows(self):
+        """Ensures each window only counts the hours it covers, most active tag first and ties in the order the tags were added."""
+        now = datetime(2024, 3, 20, 12, 30)
+        record_tag_activity([self.horses_id], now=now - timedelta(days=3))
+        record_tag_activity([self.horses_id], now=now - timedelta(days=3))
+        record_tag_activity([self.ranch_id], now=now - timedelta(hours=5))
+        record_tag_activity([self.miradero_id, self.ranch_id], now=now)
+        db.session.commit()
+
+        def names(hours):
+            return [(tag.name, posts) for tag, posts in trending_tags(hours, 10, now=now)]
+
+        self.assertEqual(names(1), [("Ranch", 1), ("Miradero", 1)])
+        self.assertEqual(names(24), [("Ranch", 2), ("Miradero", 1)])
+        self.assertEqual(names(24 * 7), [("Horses", 2), ("Ranch", 2), ("Miradero", 1)])
+
+    def test_prune(self):
+        """Ensures pruning deletes only the hours older than the window."""
+        now = datetime(2024, 3, 20, 12, 30)
+        record_tag_activity([self.horses_id], now=now - timedelta(days=8))
+        record_tag_activity([self.ranch_id], now=now - timedelta(days=6))
+        db.session.commit()
+
+        self.assertEqual(prune_tag_activity(24 * 7, now=now), 1)
+        self.assertEqual(self.activity(), {(self.ranch_id, 1)})
+
+    def test_home_page_sidebar(self):
+        """Ensures the home page lists the tags trending today."""
+        record_tag_activity([self.ranch_id])
+        db.session.commit()
+        with app.test_client() as client:
+            html = client.get("/").get_data(as_text=True)
+
+        self.assertIn('Trending This Day', html)
+        self.assertIn(f'<a href="/tags/{self.ranch_id}">Ranch</a> (1 posts)', html)
+
+    def test_api(self):
+        """Ensures the JSON endpoint lists the trending tags of the requested window, and rejects unknown windows."""
+        db.session.execute(insert(TagActivity), [{'tag_id': self.horses_id, 'hour': current_hour() - timedelta(hours=30), 'posts': 4},
+                                                 {'tag_id': self.ranch_id, 'hour': current_hour(), 'posts': 1}])
+        db.session.commit()
+        with app.test_client() as client:
+            day = client.get("/api/tags/trending").get_json()
+            week = client.get("/api/tags/trending?window=week").get_json()
+            resp = client.get("/api/tags/trending?window=year")
+
+        self.assertEqual(day['window'], 'day')
+        self.assertEqual([(tag['name'], tag['recent_posts']) for tag in day['results']], [('Ranch', 1)])
+        self.assertEqual([(tag['name'], tag['recent_posts']) for tag in week['results']], [('Horses', 4), ('Ranch', 1)])
+        self.assertEqual(resp.status_code, 400)
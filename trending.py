@@ -0,0 +1,46 @@
+"""This file contains the trending tags: how many posts were given each tag in the last hour, day or week. Every time posts are
+tagged, the count for the current hour is bumped in the tag_activity table (record_tag_activity), in the same transaction. Reading
+the trending tags of a window then sums at most one row per tag and hour from an index, however many posts there are.
+
+Activity is history: taking a tag off a post, or deleting the post, doesn't lower the counts of the hour it was tagged in.
+`flask bloggit prune-activity` deletes the hours that have fallen out of every window."""
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import delete, func, select
+from models import db, upsert_counts, Tag, TagActivity
+
+def current_hour(now=None):
+    """Returns the start of the hour now falls in, as a naive UTC datetime like the ones stored in tag_activity."""
+    now = now or datetime.now(timezone.utc)
+    if now.tzinfo is not None:
+        now = now.astimezone(timezone.utc).replace(tzinfo=None)
+    return now.replace(minute=0, second=0, microsecond=0)
+
+def window_start(hours, now=None):
+    """Returns the first hour counted by a window of the given number of hours. The current hour has only just begun, so the
+    window reaches back over the hours full hours before it."""
+    return current_hour(now) - timedelta(hours=hours)
+
+def record_tag_activity(tag_ids, now=None):
+    """Counts one more post for each of the tags in the current hour, with a single upsert, in the current transaction."""
+    if not tag_ids:
+        return
+    hour = current_hour(now)
+    upsert_counts(TagActivity, [{"tag_id": tag_id, "hour": hour, "posts": 1} for tag_id in tag_ids], "posts")
+
+def trending_tags(hours, limit, now=None):
+    """Returns the limit tags given to the most posts within a window of the given number of hours, as (tag, posts) pairs, most
+    active first. Tags without any activity in the window are left out."""
+    posts = func.sum(TagActivity.posts).label("posts")
+    return db.session.execute(select(Tag, posts)
+                              .join(TagActivity, TagActivity.tag_id == Tag.id)
+                              .where(TagActivity.hour >= window_start(hours, now))
+                              .group_by(Tag.id)
+                              .order_by(posts.desc(), Tag.id)
+                              .limit(limit)).all()
+
+def prune_tag_activity(hours, now=None):
+    """Deletes the activity that is older than a window of the given number of hours. Returns how many rows were deleted."""
+    result = db.session.execute(delete(TagActivity).where(TagActivity.hour < window_start(hours, now)),
+                                execution_options={"synchronize_session": False})
+    db.session.commit()
+    return result.rowcount
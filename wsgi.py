@@ -0,0 +1,12 @@
+"""Entry point for WSGI servers, for example `gunicorn --workers 4 wsgi:app`. Builds the app with the production profile (unless
+BLOGGIT_PROFILE says otherwise) and warms it up before the worker accepts traffic. The tables aren't created here; run
+`flask --app app bloggit migrate` before each deploy. Don't load it with gunicorn's --preload, which would open the
+pool's connections in the master process and share them with every forked worker."""
+import os
+from app import create_app, warm_up
+from models import connect_db
+
+app = create_app(os.environ.get('BLOGGIT_DB', 'bloggit'), profile=os.environ.get('BLOGGIT_PROFILE', 'production'))
+connect_db(app)
+if app.config['WARM_UP']:
+    warm_up(app)